@@ -0,0 +1,6 @@
+# backend/__init__.py
+from dotenv import load_dotenv
+
+# 各模块在导入时读取环境变量配置，.env 必须在导入任何 backend 模块之前加载
+# （包括 python -m backend.xxx 的命令行工具）；已存在的环境变量优先
+load_dotenv()
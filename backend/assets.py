@@ -0,0 +1,370 @@
+# backend/assets.py
+"""
+前端静态资源流水线
+
+构建：
+    python -m backend.assets build
+
+将 frontend/{static,assets,vendor} 复制到 frontend/dist，为每个文件生成带内容哈希的副本
+（style.css -> style.3f2a9c1d.css），为文本类资源预压缩 .gz（安装了 brotli 时还有 .br），
+改写 CSS 中的 url() 与 index.html 中的引用，并生成 nginx 直接提供静态文件的配置片段。
+未构建或 dist 早于源文件时后端直接提供源文件，行为与之前一致。
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import re
+import shutil
+from email.utils import formatdate
+from functools import lru_cache
+from typing import Dict, Optional
+
+from fastapi.responses import FileResponse, HTMLResponse, Response
+from fastapi.staticfiles import StaticFiles
+from starlette.staticfiles import NotModifiedResponse
+from starlette.datastructures import Headers
+
+from .metrics import record_cache
+
+logger = logging.getLogger(__name__)
+
+def _brotli():
+    """
+    brotli为可选依赖，只在构建时用到，worker启动时不导入；缺失时只生成gzip
+    """
+    try:
+        import brotli
+        return brotli
+    except ImportError:
+        return None
+
+
+FRONTEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "frontend"))
+DIST_DIR = os.path.join(FRONTEND_DIR, "dist")
+MANIFEST_PATH = os.path.join(DIST_DIR, "manifest.json")
+TEMPLATE_PATH = os.path.join(FRONTEND_DIR, "templates", "index.html")
+NGINX_SNIPPET_PATH = os.path.join(DIST_DIR, "nginx-assets.conf")
+ASSET_DIRS = ("static", "assets", "vendor")
+# nginx镜像中dist目录的位置，见 backend/dockerfile 的 nginx 阶段
+NGINX_DIST_ROOT = "/usr/share/nginx/ragflow"
+
+COMPRESSIBLE = {".css", ".js", ".json", ".map", ".svg", ".html", ".txt", ".ico", ".ttf"}
+SKIPPED = {".py", ".pyc"}
+HASHED_NAME = re.compile(r"\.[0-9a-f]{8}\.[A-Za-z0-9]+$")
+CSS_URL = re.compile(r"url\(\s*(['\"]?)([^)'\"]+)\1\s*\)")
+HTML_REF = re.compile(r"""((?:src|href)=["'])(/(?:static|assets|vendor)/[^"'?#]+)""")
+
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+
+
+def _hashed_name(name: str, content: bytes) -> str:
+    root, ext = os.path.splitext(name)
+    return f"{root}.{hashlib.sha256(content).hexdigest()[:8]}{ext}"
+
+
+def _rewrite_css(content: bytes, css_url: str, manifest: Dict[str, str]) -> bytes:
+    """
+    将CSS中的相对url()改写为带哈希的文件名
+    :param css_url: CSS文件自身的URL，例如 /vendor/fonts/inter/inter.css
+    """
+    base = css_url.rsplit("/", 1)[0]
+
+    def replace(match):
+        quote, ref = match.group(1), match.group(2)
+        if ref.startswith(("data:", "http:", "https:", "//", "#")):
+            return match.group(0)
+        path, suffix = re.match(r"([^?#]*)(.*)", ref).groups()
+        target = os.path.normpath(f"{base}/{path}").replace(os.sep, "/") if not path.startswith("/") else path
+        hashed = manifest.get(target)
+        if not hashed:
+            return match.group(0)
+        new_ref = os.path.relpath(hashed, base).replace(os.sep, "/") if not path.startswith("/") else hashed
+        return f"url({quote}{new_ref}{suffix}{quote})"
+
+    return CSS_URL.sub(replace, content.decode("utf-8")).encode("utf-8")
+
+
+def _write_compressed(path: str, content: bytes):
+    """
+    预压缩文本类资源，压缩收益不足10%时不生成
+    """
+    if os.path.splitext(path)[1] not in COMPRESSIBLE:
+        return
+    gz = gzip.compress(content, compresslevel=9, mtime=0)
+    if len(gz) < len(content) * 0.9:
+        with open(path + ".gz", "wb") as f:
+            f.write(gz)
+    brotli = _brotli()
+    if brotli is not None:
+        br = brotli.compress(content, quality=11)
+        if len(br) < len(content) * 0.9:
+            with open(path + ".br", "wb") as f:
+                f.write(br)
+
+
+def _emit(url: str, content: bytes, manifest: Dict[str, str]):
+    """
+    写出原名和带哈希两份文件（原名供JS中硬编码的路径使用）
+    """
+    hashed_url = url.rsplit("/", 1)[0] + "/" + _hashed_name(url.rsplit("/", 1)[1], content)
+    for target in (url, hashed_url):
+        path = os.path.join(DIST_DIR, target.lstrip("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+        _write_compressed(path, content)
+    manifest[url] = hashed_url
+
+
+def build_assets() -> Dict[str, str]:
+    """
+    构建 frontend/dist
+    :return: 原始URL -> 带哈希URL 的清单
+    """
+    shutil.rmtree(DIST_DIR, ignore_errors=True)
+    manifest: Dict[str, str] = {}
+    css_files = []
+    for directory in ASSET_DIRS:
+        source_root = os.path.join(FRONTEND_DIR, directory)
+        for dirpath, _, filenames in os.walk(source_root):
+            for filename in sorted(filenames):
+                if os.path.splitext(filename)[1] in SKIPPED:
+                    continue
+                source = os.path.join(dirpath, filename)
+                url = "/" + os.path.relpath(source, FRONTEND_DIR).replace(os.sep, "/")
+                if filename.endswith(".css"):
+                    css_files.append((url, source))
+                    continue
+                with open(source, "rb") as f:
+                    _emit(url, f.read(), manifest)
+
+    # CSS最后处理，以便引用的字体/图片已经有哈希名
+    for url, source in css_files:
+        with open(source, "rb") as f:
+            _emit(url, _rewrite_css(f.read(), url, manifest), manifest)
+
+    with open(TEMPLATE_PATH, encoding="utf-8") as f:
+        html = f.read()
+    html = HTML_REF.sub(lambda m: m.group(1) + manifest.get(m.group(2), m.group(2)), html)
+    index_path = os.path.join(DIST_DIR, "index.html")
+    with open(index_path, "w", encoding="utf-8") as f:
+        f.write(html)
+
+    with open(MANIFEST_PATH, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    with open(NGINX_SNIPPET_PATH, "w", encoding="utf-8") as f:
+        f.write(render_nginx_snippet())
+    return manifest
+
+
+def render_nginx_snippet(root: str = NGINX_DIST_ROOT) -> str:
+    """
+    生成nginx配置片段：静态资源由nginx直接提供，不再经过gunicorn worker
+    :param root: nginx容器中dist目录的路径
+    """
+    lines = [
+        "# 由 python -m backend.assets build 生成，请勿手工修改",
+        "gzip_static on;",
+        "# 安装了 ngx_brotli 模块时可开启：brotli_static on;",
+        "",
+    ]
+    for directory in ASSET_DIRS:
+        lines += [
+            f"location ~ ^/{directory}/.+\\.[0-9a-f]{{8}}\\.[A-Za-z0-9]+$ {{",
+            f"    root {root};",
+            f'    add_header Cache-Control "{IMMUTABLE_CACHE}";',
+            "    etag on;",
+            "}",
+            "",
+            f"location /{directory}/ {{",
+            f"    root {root};",
+            f'    add_header Cache-Control "{REVALIDATE_CACHE}";',
+            "    etag on;",
+            "}",
+            "",
+        ]
+    return "\n".join(lines)
+
+
+def _newest_source_mtime() -> float:
+    """
+    首页模板和各资源目录中最新的源文件修改时间
+    """
+    newest = os.stat(TEMPLATE_PATH).st_mtime if os.path.exists(TEMPLATE_PATH) else 0.0
+    for directory in ASSET_DIRS:
+        for dirpath, _, filenames in os.walk(os.path.join(FRONTEND_DIR, directory)):
+            for filename in filenames:
+                if os.path.splitext(filename)[1] not in SKIPPED:
+                    newest = max(newest, os.stat(os.path.join(dirpath, filename)).st_mtime)
+    return newest
+
+
+@lru_cache(maxsize=None)
+def use_dist() -> bool:
+    """
+    是否使用构建好的 dist（每个进程只判断一次，静态目录和首页保持一致）
+    dist 比源文件旧时（修改了前端文件但没有重新构建）改为提供源文件并记录警告
+    """
+    if not os.path.exists(MANIFEST_PATH):
+        return False
+    if _newest_source_mtime() > os.stat(MANIFEST_PATH).st_mtime:
+        logger.warning("frontend/dist 早于前端源文件，改为提供源文件；"
+                       "请执行 python -m backend.assets build 重新构建")
+        return False
+    return True
+
+
+def asset_directory(name: str) -> str:
+    """
+    使用 dist 时返回 dist 下的目录，否则返回源目录
+    :param name: static / assets / vendor
+    """
+    if use_dist():
+        return os.path.join(DIST_DIR, name)
+    return os.path.join(FRONTEND_DIR, name)
+
+
+def accepted_encodings(header: str) -> Dict[str, float]:
+    """
+    解析 Accept-Encoding 请求头
+    :param header: 例如 "gzip;q=0.8, br, *;q=0"
+    :return: 编码 -> q值（小写编码名，q=0 表示不接受）
+    """
+    result: Dict[str, float] = {}
+    for item in header.split(","):
+        name, _, params = item.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        result[name] = q
+    return result
+
+
+class CachedStaticFiles(StaticFiles):
+    """
+    StaticFiles扩展：
+    - 带内容哈希的文件返回 Cache-Control: immutable，其余文件要求用ETag重新验证（304）
+    - 客户端接受br/gzip且存在预压缩文件时直接返回压缩版本，压缩版本有各自的ETag（"<原ETag>-br"）
+    """
+    ENCODINGS = (("br", ".br", "br"), ("gzip", ".gz", "gz"))
+
+    def _pick_encoding(self, full_path: Optional[str], accept: str):
+        """
+        :return: 按q值（相同时br优先）选出的 (编码, 文件后缀, ETag后缀)，不压缩时为None
+        """
+        if not full_path or not accept:
+            return None
+        accepted = accepted_encodings(accept)
+        best, best_q = None, 0.0
+        for encoding, suffix, tag in self.ENCODINGS:
+            q = accepted.get(encoding, accepted.get("*", 0.0))
+            if q > best_q and os.path.exists(full_path + suffix):
+                best, best_q = (encoding, suffix, tag), q
+        return best
+
+    async def get_response(self, path: str, scope):
+        response = await super().get_response(path, scope)
+        if response.status_code not in (200, 304):
+            return response
+
+        request_headers = Headers(scope=scope)
+        full_path, _ = self.lookup_path(path)
+        picked = self._pick_encoding(full_path, request_headers.get("accept-encoding", ""))
+        if picked:
+            encoding, suffix, tag = picked
+            compressed_path = full_path + suffix
+            compressed = FileResponse(compressed_path, stat_result=os.stat(compressed_path),
+                                      media_type=mimetypes.guess_type(full_path)[0] or "text/plain")
+            compressed.headers["etag"] = response.headers["etag"][:-1] + f'-{tag}"'
+            compressed.headers["content-encoding"] = encoding
+            # 原文件的304是针对未压缩版本的ETag，压缩版本需按自己的ETag重新判断
+            response = NotModifiedResponse(compressed.headers) \
+                if self.is_not_modified(compressed.headers, request_headers) else compressed
+
+        # 304 也要带上 Vary，否则缓存可能用未压缩版本的条目响应接受压缩的客户端
+        response.headers["vary"] = "Accept-Encoding"
+        response.headers["cache-control"] = IMMUTABLE_CACHE if HASHED_NAME.search(path) else REVALIDATE_CACHE
+        return response
+
+
+class IndexPage:
+    """
+    首页HTML的内存缓存，文件修改（mtime/大小变化）后自动重新读取
+    运行期间修改了首页模板而没有重新构建时，提供模板本身，不继续返回过期的 dist/index.html
+    """
+
+    def __init__(self):
+        self._key = None
+        self._body: Optional[bytes] = None
+        self._etag: Optional[str] = None
+        self._last_modified: Optional[str] = None
+        self._warned_stale = False
+
+    def _path(self) -> str:
+        built = os.path.join(DIST_DIR, "index.html")
+        if not use_dist() or not os.path.exists(built):
+            return TEMPLATE_PATH
+        if os.stat(TEMPLATE_PATH).st_mtime > os.stat(built).st_mtime:
+            if not self._warned_stale:
+                logger.warning("首页模板已修改但 frontend/dist 未重新构建，改为提供模板；"
+                               "请执行 python -m backend.assets build")
+                self._warned_stale = True
+            return TEMPLATE_PATH
+        return built
+
+    def _load(self) -> bool:
+        """
+        :return: 是否命中缓存
+        """
+        path = self._path()
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        if key == self._key:
+            return True
+        with open(path, "rb") as f:
+            self._body = f.read()
+        self._etag = '"' + hashlib.md5(self._body).hexdigest() + '"'
+        self._last_modified = formatdate(stat.st_mtime, usegmt=True)
+        self._key = key
+        return False
+
+    def response(self, if_none_match: Optional[str] = None) -> Response:
+        """
+        :param if_none_match: 请求头 If-None-Match
+        :raises FileNotFoundError: 首页文件不存在
+        """
+        record_cache("index_html", self._load())
+        headers = {"ETag": self._etag, "Last-Modified": self._last_modified, "Cache-Control": REVALIDATE_CACHE}
+        if if_none_match and self._etag in [tag.strip() for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+        return HTMLResponse(content=self._body, status_code=200, headers=headers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="前端静态资源流水线")
+    parser.add_argument("command", choices=["build", "nginx"],
+                        help="build: 构建frontend/dist；nginx: 输出nginx配置片段")
+    parser.add_argument("--root", default=NGINX_DIST_ROOT, help="nginx中dist目录路径")
+    args = parser.parse_args()
+    if args.command == "build":
+        manifest = build_assets()
+        print(f"已构建 {len(manifest)} 个资源到 {DIST_DIR}" + ("" if _brotli() else "（未安装brotli，仅生成gzip）"))
+    else:
+        print(render_nginx_snippet(args.root))
+
+
+if __name__ == "__main__":
+    main()
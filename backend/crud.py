@@ -1,16 +1,27 @@
 # backend/crud.py
-from sqlalchemy.orm import Session
-from .models import ChatSession, ChatMessage
-from typing import List, Optional
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy import func, update, delete, select, and_
+from sqlalchemy.exc import IntegrityError
+from .models import ChatSession, ChatMessage, MessageUsage, UsageDaily, QuestionStat, StatsState
+from . import stats
+from .serialization import SHANGHAI_OFFSET, shanghai_datetime, shanghai_text
+from typing import List, Optional, Dict, Any
 import csv
+import hashlib
+import re
 from io import StringIO
-from datetime import datetime
-import pytz
+from datetime import datetime, date, timedelta, timezone
+import os
+import time
 import uuid
 import logging
 
 logger = logging.getLogger(__name__)
 
+# 批量删除每批处理的行数，以及批次之间让出写锁的间隔（秒），避免长时间阻塞聊天写入
+DELETE_BATCH_SIZE = int(os.getenv("DELETE_BATCH_SIZE", "500"))
+DELETE_BATCH_PAUSE = float(os.getenv("DELETE_BATCH_PAUSE", "0.05"))
+
 def create_chat_session(db: Session, title: str = None):
     """
     创建新的聊天会话
@@ -21,6 +32,7 @@ def create_chat_session(db: Session, title: str = None):
     try:
         session = ChatSession(title=title)
         db.add(session)
+        stats.record_session(db)
         db.commit()
         db.refresh(session)
         logger.info(f"创建新的聊天会话: {session.session_id}")
@@ -30,7 +42,78 @@ def create_chat_session(db: Session, title: str = None):
         db.rollback()
         raise
 
-def save_chat_message(db: Session, session_id: int, role: str, content: str, thinking_content: str = None):
+def normalize_question(question: str) -> str:
+    """
+    规范化问题文本：去除首尾空白、合并连续空白、统一小写
+    """
+    return re.sub(r"\s+", " ", question or "").strip().lower()
+
+def question_hash(question: str) -> str:
+    """
+    规范化问题文本的哈希
+    """
+    return hashlib.sha256(normalize_question(question).encode("utf-8")).hexdigest()
+
+def shanghai_today() -> date:
+    """
+    上海时区的当前日期，用于按天汇总
+    """
+    return datetime.now(SHANGHAI_OFFSET).date()
+
+def claim_lease(db: Session, key: str, hold_seconds: float) -> bool:
+    """
+    抢占后台任务的执行租约（保存在 stats_state 中，值为租约到期的时间戳）
+    租约过期后第一个更新成功的worker获得执行权，其余worker跳过本轮
+    :param key: 租约键
+    :param hold_seconds: 持有时长（秒）
+    :return: 是否获得租约
+    """
+    now = int(time.time())
+    until = now + int(hold_seconds)
+    claimed = db.execute(update(StatsState).where(StatsState.key == key, StatsState.value <= now)
+                         .values(value=until)).rowcount
+    if not claimed and db.get(StatsState, key) is None:
+        try:
+            db.add(StatsState(key=key, value=until))
+            db.flush()
+            claimed = 1
+        except IntegrityError:
+            db.rollback()
+            return False
+    db.commit()
+    return bool(claimed)
+
+def _record_question(db: Session, content: str):
+    """
+    累加问题的提问次数（与消息在同一事务中提交）
+    """
+    now = datetime.utcnow()
+    stats.increment(db, QuestionStat, {"question_hash": question_hash(content)}, {"asks": 1},
+                    assign={"last_asked": now}, insert_only={"question": content[:500], "first_asked": now})
+
+def _record_usage(db: Session, message: ChatMessage, reasoning_effort: str, usage: Dict[str, Any]):
+    """
+    保存消息的token用量并增量更新当天汇总（与消息在同一事务中提交）
+    """
+    db.flush()
+    db.add(MessageUsage(
+        message_id=message.id,
+        reasoning_effort=reasoning_effort,
+        prompt_tokens=usage.get("prompt_tokens"),
+        completion_tokens=usage.get("completion_tokens"),
+        reasoning_tokens=usage.get("reasoning_tokens"),
+        source=usage.get("source")
+    ))
+    stats.increment(db, UsageDaily, {"day": shanghai_today(), "reasoning_effort": reasoning_effort or "unknown"}, {
+        "messages": 1,
+        "prompt_tokens": usage.get("prompt_tokens") or 0,
+        "completion_tokens": usage.get("completion_tokens") or 0,
+        "reasoning_tokens": usage.get("reasoning_tokens") or 0,
+    })
+
+def save_chat_message(db: Session, session_id: int, role: str, content: str, thinking_content: str = None,
+                      reasoning_effort: str = None, usage: Dict[str, Any] = None,
+                      latency_ms: float = None, ttft_ms: float = None):
     """
     保存聊天消息到指定会话
     :param db: 数据库会话
@@ -38,6 +121,10 @@ def save_chat_message(db: Session, session_id: int, role: str, content: str, thi
     :param role: 消息角色 ("user" 或 "assistant")
     :param content: 消息内容
     :param thinking_content: 思考过程内容
+    :param reasoning_effort: 生成该回复时使用的推理努力程度
+    :param usage: token用量（prompt_tokens/completion_tokens/reasoning_tokens/source）
+    :param latency_ms: 回复耗时，计入按小时汇总的统计
+    :param ttft_ms: 首个回复token耗时
     :return: 新保存的消息对象
     """
     try:
@@ -48,6 +135,11 @@ def save_chat_message(db: Session, session_id: int, role: str, content: str, thi
             thinking_content=thinking_content
         )
         db.add(message)
+        if role == "user":
+            _record_question(db, content)
+        elif usage:
+            _record_usage(db, message, reasoning_effort, usage)
+        stats.record_message(db, role, content, reasoning_effort, latency_ms, ttft_ms)
         # 更新会话的更新时间
         session = db.query(ChatSession).filter(ChatSession.id == session_id).first()
         if session:
@@ -63,24 +155,83 @@ def save_chat_message(db: Session, session_id: int, role: str, content: str, thi
         db.rollback()
         raise
 
-def get_chat_sessions(db: Session, keyword: str = None, page: int = 1, page_size: int = 10):
+def get_usage_daily(db: Session, start: date = None, end: date = None):
     """
-    获取聊天会话列表
+    获取按天和reasoning_effort汇总的token用量
+    :param db: 数据库会话
+    :param start: 起始日期（含）
+    :param end: 结束日期（含）
+    :return: UsageDaily列表，按日期升序
+    """
+    try:
+        query = db.query(UsageDaily)
+        if start:
+            query = query.filter(UsageDaily.day >= start)
+        if end:
+            query = query.filter(UsageDaily.day <= end)
+        return query.order_by(UsageDaily.day, UsageDaily.reasoning_effort).all()
+    except Exception as e:
+        logger.error(f"获取token用量汇总失败: {e}")
+        raise
+
+def get_tokens_used(db: Session, day: date) -> int:
+    """
+    获取某天（上海时区）消耗的token总数（prompt + completion）
+    :param db: 数据库会话
+    :param day: 日期
+    :return: token数
+    """
+    try:
+        total = db.query(func.sum(UsageDaily.prompt_tokens + UsageDaily.completion_tokens)) \
+            .filter(UsageDaily.day == day).scalar()
+        return int(total or 0)
+    except Exception as e:
+        logger.error(f"获取当日token用量失败: {e}")
+        raise
+
+def get_stats(db: Session, start: date = None, end: date = None, granularity: str = "day"):
+    """
+    获取按小时/按天汇总的使用统计（只查询汇总表）
+    :param db: 数据库会话
+    :param start: 起始日期（含）
+    :param end: 结束日期（含）
+    :param granularity: hour 或 day
+    :return: 各时间段统计和区间合计
+    """
+    try:
+        return stats.query_stats(db, start, end, granularity)
+    except Exception as e:
+        logger.error(f"获取使用统计失败: {e}")
+        raise
+
+def get_history_rows(db: Session, keyword: str = None, page: int = 1, page_size: int = 10):
+    """
+    获取历史会话列表的一页：会话和最新一条消息的预览在同一条查询中取出，
+    预览截取在SQL中完成，只返回需要的列，不构造ORM对象
     :param db: 数据库会话
     :param keyword: 搜索关键词
     :param page: 页码
     :param page_size: 每页大小
-    :return: 会话列表
+    :return: 行列表（id, session_id, title, updated_at, preview, content_length），
+             外连接保证分页与逐个会话查询时一致，没有消息的会话 preview 为None，由调用方跳过
     """
     try:
-        query = db.query(ChatSession)
+        latest = aliased(ChatMessage)
+        latest_id = select(latest.id).where(latest.session_id == ChatSession.id) \
+            .order_by(latest.timestamp.desc(), latest.id.desc()).limit(1) \
+            .correlate(ChatSession).scalar_subquery()
+        query = select(
+            ChatSession.id, ChatSession.session_id, ChatSession.title,
+            func.coalesce(ChatSession.updated_at, ChatSession.created_at).label("updated_at"),
+            func.substr(ChatMessage.content, 1, 100).label("preview"),
+            func.length(ChatMessage.content).label("content_length"),
+        ).outerjoin(ChatMessage, ChatMessage.id == latest_id).where(ChatSession.deleted_at.is_(None))
         if keyword:
-            query = query.filter(ChatSession.title.contains(keyword))
-        
-        # 使用中国上海时区，按更新时间倒序排列（最新的在前）
-        result = query.order_by(ChatSession.updated_at.desc()).offset((page - 1) * page_size).limit(page_size).all()
-        logger.debug(f"获取聊天会话列表，关键词: {keyword}, 页码: {page}, 结果数: {len(result)}")
-        return result
+            query = query.where(ChatSession.title.contains(keyword))
+        rows = db.execute(query.order_by(ChatSession.updated_at.desc())
+                          .offset((page - 1) * page_size).limit(page_size)).all()
+        logger.debug(f"获取聊天会话列表，关键词: {keyword}, 页码: {page}, 结果数: {len(rows)}")
+        return rows
     except Exception as e:
         logger.error(f"获取聊天会话列表失败: {e}")
         raise
@@ -108,58 +259,195 @@ def get_chat_session_by_uuid(db: Session, session_uuid: str):
     :return: 会话对象或None
     """
     try:
-        result = db.query(ChatSession).filter(ChatSession.session_id == session_uuid).first()
+        result = db.query(ChatSession).filter(ChatSession.session_id == session_uuid,
+                                              ChatSession.deleted_at.is_(None)).first()
         logger.debug(f"根据UUID获取聊天会话: {session_uuid}")
         return result
     except Exception as e:
         logger.error(f"根据UUID获取聊天会话失败: {e}")
         raise
 
-def get_chat_messages_by_session(db: Session, session_id: int):
+def get_message_rows(db: Session, session_id: int):
     """
-    获取指定会话的所有消息
+    获取指定会话的所有消息，只查询接口需要的列
     :param db: 数据库会话
     :param session_id: 会话ID
-    :return: 消息列表
+    :return: 行列表（role, content, thinking_content, timestamp）
     """
     try:
-        result = db.query(ChatMessage).filter(ChatMessage.session_id == session_id).order_by(ChatMessage.timestamp).all()
-        logger.debug(f"获取会话的所有消息: {session_id}")
-        return result
+        return db.execute(
+            select(ChatMessage.role, ChatMessage.content, ChatMessage.thinking_content, ChatMessage.timestamp)
+            .where(ChatMessage.session_id == session_id)
+            .order_by(ChatMessage.timestamp)
+        ).all()
     except Exception as e:
         logger.error(f"获取会话消息失败: {e}")
         raise
 
-def get_chat_messages_by_session_uuid(db: Session, session_uuid: str):
+def _shanghai_day_start(day: date) -> datetime:
+    """
+    上海时区某天0点对应的UTC时间（不带时区，与数据库中保存的时间一致）
+    """
+    local = datetime.combine(day, datetime.min.time(), tzinfo=SHANGHAI_OFFSET)
+    return local.astimezone(timezone.utc).replace(tzinfo=None)
+
+def soft_delete_sessions(db: Session, session_ids: List[int] = None, start: date = None, end: date = None,
+                         keyword: str = None, batch_size: int = DELETE_BATCH_SIZE) -> int:
+    """
+    按条件软删除聊天会话：只设置 deleted_at，消息由后台清理任务分批物理删除
+    按ID分批更新并逐批提交，批次之间短暂让出写锁，大批量删除时聊天写入不会被长时间阻塞
+    不传任何条件时删除全部会话
+    :param db: 数据库会话
+    :param session_ids: 会话ID列表
+    :param start: 创建日期起始（含，上海时区）
+    :param end: 创建日期结束（含，上海时区）
+    :param keyword: 标题关键词
+    :param batch_size: 每批更新的会话数
+    :return: 删除的会话数
+    """
+    try:
+        query = db.query(ChatSession.id).filter(ChatSession.deleted_at.is_(None))
+        if session_ids is not None:
+            query = query.filter(ChatSession.id.in_(session_ids))
+        if start:
+            query = query.filter(ChatSession.created_at >= _shanghai_day_start(start))
+        if end:
+            query = query.filter(ChatSession.created_at < _shanghai_day_start(end + timedelta(days=1)))
+        if keyword:
+            query = query.filter(ChatSession.title.contains(keyword))
+
+        deleted = 0
+        last_id = 0
+        while True:
+            ids = [row[0] for row in query.filter(ChatSession.id > last_id).order_by(ChatSession.id).limit(batch_size)]
+            if not ids:
+                break
+            now = datetime.utcnow()
+            deleted += db.execute(update(ChatSession).where(ChatSession.id.in_(ids)).values(deleted_at=now)).rowcount
+            db.commit()
+            last_id = ids[-1]
+            if len(ids) == batch_size:
+                time.sleep(DELETE_BATCH_PAUSE)
+        logger.info(f"软删除聊天会话: {deleted} 个")
+        return deleted
+    except Exception as e:
+        logger.error(f"批量删除聊天会话失败: {e}")
+        db.rollback()
+        raise
+
+def _message_count(session_column):
+    # 使用别名，避免与外层查询连接的chat_messages互相关联
+    counted = aliased(ChatMessage)
+    return select(func.count(counted.id)).where(counted.session_id == session_column) \
+        .correlate(ChatSession).scalar_subquery()
+
+def get_transcript_version(db: Session, session_uuid: str):
+    """
+    获取会话的版本信息（更新时间和消息数），用于在不读取消息的情况下校验ETag
+    :param db: 数据库会话
+    :param session_uuid: 会话UUID
+    :return: (updated_at, message_count)，会话不存在或已删除时为None
+    """
+    try:
+        return db.execute(
+            select(ChatSession.updated_at, _message_count(ChatSession.id))
+            .where(ChatSession.session_id == session_uuid, ChatSession.deleted_at.is_(None))
+        ).first()
+    except Exception as e:
+        logger.error(f"获取会话版本失败: {e}")
+        raise
+
+def get_transcript(db: Session, session_uuid: str, after_id: int = 0, limit: int = 50,
+                   include_thinking: bool = False) -> Optional[Dict[str, Any]]:
     """
-    根据会话UUID获取所有消息
+    分页获取会话记录：会话信息、消息数和一页消息在同一条查询中取出
+    默认不返回思考内容，只标记是否存在，需要时通过 get_message_thinking 单独获取
     :param db: 数据库会话
     :param session_uuid: 会话UUID
-    :return: 消息列表或None
+    :param after_id: 游标，只返回ID大于该值的消息
+    :param limit: 每页消息数
+    :param include_thinking: 是否返回思考内容
+    :return: 会话记录字典（时间为上海时区的datetime，由响应统一序列化），会话不存在或已删除时为None
     """
     try:
-        session = db.query(ChatSession).filter(ChatSession.session_id == session_uuid).first()
-        if not session:
-            logger.warning(f"未找到会话UUID: {session_uuid}")
+        columns = [
+            ChatSession.session_id, ChatSession.title, ChatSession.updated_at,
+            _message_count(ChatSession.id).label("message_count"),
+            ChatMessage.id, ChatMessage.role, ChatMessage.content, ChatMessage.timestamp,
+            (func.coalesce(func.length(ChatMessage.thinking_content), 0) > 0).label("has_thinking"),
+        ]
+        if include_thinking:
+            columns.append(ChatMessage.thinking_content)
+        rows = db.execute(
+            select(*columns)
+            .select_from(ChatSession)
+            .outerjoin(ChatMessage, and_(ChatMessage.session_id == ChatSession.id, ChatMessage.id > after_id))
+            .where(ChatSession.session_id == session_uuid, ChatSession.deleted_at.is_(None))
+            .order_by(ChatMessage.id)
+            .limit(limit + 1)
+        ).all()
+        if not rows:
             return None
-        result = db.query(ChatMessage).filter(ChatMessage.session_id == session.id).order_by(ChatMessage.timestamp).all()
-        logger.debug(f"根据UUID获取会话消息: {session_uuid}")
-        return result
+
+        first = rows[0]
+        messages = []
+        for row in rows[:limit]:
+            if row.id is None:
+                break
+            message = {
+                "id": row.id,
+                "role": row.role,
+                "content": row.content,
+                "timestamp": shanghai_datetime(row.timestamp),
+                "has_thinking": bool(row.has_thinking),
+            }
+            if include_thinking:
+                message["thinking_content"] = row.thinking_content
+            messages.append(message)
+        return {
+            "session_id": first.session_id,
+            "title": first.title,
+            "updated_at": first.updated_at,
+            "message_count": first.message_count,
+            "messages": messages,
+            "next_cursor": messages[-1]["id"] if len(rows) > limit else None,
+        }
     except Exception as e:
-        logger.error(f"根据UUID获取会话消息失败: {e}")
+        logger.error(f"获取会话记录失败: {e}")
+        raise
+
+def get_message_thinking(db: Session, session_uuid: str, message_id: int) -> Optional[str]:
+    """
+    获取单条消息的思考内容
+    :param db: 数据库会话
+    :param session_uuid: 会话UUID（校验消息属于该会话）
+    :param message_id: 消息ID
+    :return: 思考内容（可能为空字符串），消息不存在时为None
+    """
+    try:
+        row = db.execute(
+            select(ChatMessage.thinking_content)
+            .join(ChatSession, ChatSession.id == ChatMessage.session_id)
+            .where(ChatMessage.id == message_id, ChatSession.session_id == session_uuid,
+                   ChatSession.deleted_at.is_(None))
+        ).first()
+        if row is None:
+            return None
+        return row[0] or ""
+    except Exception as e:
+        logger.error(f"获取思考内容失败: {e}")
         raise
 
 def delete_chat_session(db: Session, session_id: int):
     """
-    删除聊天会话及其所有消息
+    删除聊天会话（软删除，立即从列表中消失，消息由后台清理任务物理删除）
     :param db: 数据库会话
     :param session_id: 会话ID
     """
     try:
-        # 先删除所有相关消息
-        db.query(ChatMessage).filter(ChatMessage.session_id == session_id).delete()
-        # 再删除会话
-        db.query(ChatSession).filter(ChatSession.id == session_id).delete()
+        db.execute(update(ChatSession)
+                   .where(ChatSession.id == session_id, ChatSession.deleted_at.is_(None))
+                   .values(deleted_at=datetime.utcnow()))
         db.commit()
         logger.info(f"删除聊天会话: {session_id}")
     except Exception as e:
@@ -169,18 +457,42 @@ def delete_chat_session(db: Session, session_id: int):
 
 def delete_all_chat_sessions(db: Session):
     """
-    删除所有聊天会话和消息
+    删除所有聊天会话和消息（分批软删除）
     :param db: 数据库会话
     :return: 操作是否成功
     """
+    soft_delete_sessions(db)
+    logger.info("删除所有聊天会话和消息")
+    return True
+
+def purge_deleted_batch(db: Session, deleted_before: datetime, batch_size: int = DELETE_BATCH_SIZE):
+    """
+    物理删除一批已软删除的数据：先删除消息（message_usage 随外键级联删除），
+    会话下已没有消息后再删除会话，每次调用只处理一批并提交
+    :param db: 数据库会话
+    :param deleted_before: 只处理在此时间（UTC）之前软删除的会话
+    :param batch_size: 每批删除的行数
+    :return: (删除的会话数, 删除的消息数)，均为0表示已清理完毕
+    """
     try:
-        db.query(ChatMessage).delete()
-        db.query(ChatSession).delete()
+        expired = db.query(ChatSession.id).filter(ChatSession.deleted_at.isnot(None),
+                                                  ChatSession.deleted_at < deleted_before)
+        message_ids = [row[0] for row in db.query(ChatMessage.id)
+                       .filter(ChatMessage.session_id.in_(expired.scalar_subquery()))
+                       .limit(batch_size)]
+        if message_ids:
+            messages = db.execute(delete(ChatMessage).where(ChatMessage.id.in_(message_ids))).rowcount
+            db.commit()
+            return 0, messages
+
+        session_ids = [row[0] for row in expired.limit(batch_size)]
+        if not session_ids:
+            return 0, 0
+        sessions = db.execute(delete(ChatSession).where(ChatSession.id.in_(session_ids))).rowcount
         db.commit()
-        logger.info("删除所有聊天会话和消息")
-        return True
+        return sessions, 0
     except Exception as e:
-        logger.error(f"删除所有聊天会话失败: {e}")
+        logger.error(f"清理已删除会话失败: {e}")
         db.rollback()
         raise
 
@@ -191,25 +503,22 @@ def export_chats(db: Session):
     :return: CSV格式的聊天记录
     """
     try:
-        sessions = db.query(ChatSession).order_by(ChatSession.created_at).all()
+        # 会话和消息在同一条查询中按顺序取出，只读取需要的列
+        rows = db.execute(
+            select(ChatSession.session_id, ChatSession.title, ChatMessage.role, ChatMessage.content,
+                   ChatMessage.thinking_content, ChatMessage.timestamp)
+            .join(ChatMessage, ChatMessage.session_id == ChatSession.id)
+            .where(ChatSession.deleted_at.is_(None))
+            .order_by(ChatSession.created_at, ChatSession.id, ChatMessage.timestamp)
+        )
         output = StringIO()
         writer = csv.writer(output)
         writer.writerow(["session_id", "session_title", "role", "content", "thinking_content", "timestamp"])
-        
-        shanghai_tz = pytz.timezone('Asia/Shanghai')
-        for session in sessions:
-            messages = db.query(ChatMessage).filter(ChatMessage.session_id == session.id).order_by(ChatMessage.timestamp).all()
-            for message in messages:
-                # 转换为上海时区
-                local_timestamp = message.timestamp.replace(tzinfo=pytz.utc).astimezone(shanghai_tz)
-                writer.writerow([
-                    session.session_id, 
-                    session.title or "", 
-                    message.role, 
-                    message.content, 
-                    message.thinking_content or "",
-                    local_timestamp
-                ])
+        # 转换为上海时区
+        writer.writerows(
+            (session_id, title or "", role, content, thinking_content or "", shanghai_text(timestamp))
+            for session_id, title, role, content, thinking_content, timestamp in rows
+        )
         output.seek(0)
         
         # 添加BOM以支持Excel正确显示中文
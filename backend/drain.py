@@ -0,0 +1,142 @@
+# backend/drain.py
+import asyncio
+import logging
+import os
+import signal
+import time
+from typing import Any, AsyncIterator, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# 收到 SIGTERM 后进行中的聊天流最多继续的秒数，需小于 gunicorn 的 GRACEFUL_TIMEOUT，
+# 留出保存未完成回答和关闭连接池的时间
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "270"))
+# 建议客户端重连前等待的秒数
+DRAIN_RETRY_AFTER = 1
+# 截止时间到达时保存的回答末尾追加的说明
+PARTIAL_ANSWER_NOTE = "\n\n（服务重启，回答未完成，请重新提问）"
+
+
+class DrainController:
+    """
+    优雅停机（排空）
+    收到 SIGTERM 后不再接受新的聊天请求（返回503并通过SSE通知客户端重连到其他实例），
+    进行中的流继续输出到截止时间；超过截止时间的流保存已生成的部分回答后结束，
+    最后才由 shutdown 事件关闭上游客户端和数据库连接池
+    """
+
+    def __init__(self, timeout: float = DRAIN_TIMEOUT):
+        """
+        :param timeout: 排空截止时间（秒）
+        """
+        self.timeout = timeout
+        self.started_at: Optional[float] = None
+        self.deadline: Optional[float] = None
+        self.active_streams = 0
+        self.completed_streams = 0
+        self.interrupted_streams = 0
+
+    @property
+    def draining(self) -> bool:
+        return self.deadline is not None
+
+    def begin(self) -> bool:
+        """
+        进入排空状态；只修改状态、不写日志，可在信号处理函数中调用
+        :return: 是否是本次调用开始的排空
+        """
+        if self.deadline is not None:
+            return False
+        self.started_at = time.time()
+        self.deadline = time.monotonic() + self.timeout
+        return True
+
+    def _log_begin(self):
+        logger.info(f"开始排空：不再接受新的聊天请求，{self.active_streams} 个进行中的流最多继续 {self.timeout:.0f} 秒")
+
+    def remaining(self) -> Optional[float]:
+        """
+        距离排空截止时间的秒数，未在排空时为None
+        """
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def install_signal_handlers(self):
+        """
+        在服务器已有的 SIGTERM/SIGINT 处理函数之前进入排空状态
+        需在服务器安装信号处理之后（startup事件中）于主线程调用；
+        服务器随后停止监听并等待进行中的请求结束，再执行 shutdown 事件
+        """
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            previous = signal.getsignal(sig)
+            if not callable(previous):
+                continue
+
+            def handler(signum, frame, previous=previous):
+                if self.begin():
+                    # 信号处理函数中写日志可能与被打断的日志调用争用同一把锁，交给事件循环执行
+                    loop.call_soon_threadsafe(self._log_begin)
+                previous(signum, frame)
+
+            try:
+                signal.signal(sig, handler)
+            except ValueError:
+                # 不在主线程（例如测试客户端）时无法安装，停机时不排空
+                logger.warning("无法安装排空信号处理函数：不在主线程")
+                return
+
+    async def guard(self, stream: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+        """
+        包装上游流：正常时原样转发；排空截止时间到达后输出 {"type": "drain"} 并结束，
+        由调用方保存已生成的内容并通知客户端重连
+        只有排空期间才为每个chunk设置超时，平时没有额外开销
+        """
+        self.active_streams += 1
+        iterator = stream.__aiter__()
+        try:
+            while True:
+                remaining = self.remaining()
+                try:
+                    if remaining is None:
+                        chunk = await iterator.__anext__()
+                    else:
+                        chunk = await asyncio.wait_for(iterator.__anext__(), remaining)
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    self.interrupted_streams += 1
+                    logger.warning("排空截止时间已到，结束进行中的聊天流")
+                    yield {"type": "drain"}
+                    return
+                if chunk.get("type") == "complete":
+                    self.completed_streams += 1
+                yield chunk
+        finally:
+            self.active_streams -= 1
+            aclose = getattr(iterator, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    async def wait_idle(self, timeout: Optional[float] = None):
+        """
+        等待所有进行中的流结束
+        :param timeout: 最多等待的秒数，默认到排空截止时间
+        """
+        limit = time.monotonic() + (timeout if timeout is not None else (self.remaining() or 0))
+        while self.active_streams > 0 and time.monotonic() < limit:
+            await asyncio.sleep(0.1)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "draining": self.draining,
+            "started_at": self.started_at,
+            "remaining_s": round(self.remaining(), 1) if self.draining else None,
+            "active_streams": self.active_streams,
+            "completed_streams": self.completed_streams,
+            "interrupted_streams": self.interrupted_streams,
+        }
+
+
+drain = DrainController()
@@ -0,0 +1,107 @@
+# backend/effort_policy.py
+import logging
+import os
+import threading
+import time
+from typing import Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from .crud import get_tokens_used, question_hash, shanghai_today
+from .ratelimit import UPSTREAM_MAX_STREAMS, limiter
+
+logger = logging.getLogger(__name__)
+
+EFFORT_POLICY_ENABLED = os.getenv("EFFORT_POLICY_ENABLED", "0") == "1"
+# 上游并发流占用比例达到该值时降级
+EFFORT_DOWNGRADE_LOAD = float(os.getenv("EFFORT_DOWNGRADE_LOAD", "0.8"))
+# 每日token预算（上海时区，prompt + completion），0表示不限制；用量达到90%后降级
+DAILY_TOKEN_BUDGET = int(os.getenv("DAILY_TOKEN_BUDGET", "0"))
+# 同一客户端在窗口（秒）内此前至少提过这么多次同一问题（视为用户在重试）时升级
+EFFORT_RETRY_THRESHOLD = int(os.getenv("EFFORT_RETRY_THRESHOLD", "1"))
+EFFORT_RETRY_WINDOW = float(os.getenv("EFFORT_RETRY_WINDOW", "600"))
+# 当日用量缓存时间（秒），避免每个请求都查询汇总表
+BUDGET_CACHE_SECONDS = 30.0
+
+EFFORT_LEVELS = ("low", "medium", "high")
+
+
+def _step(effort: str, delta: int) -> str:
+    index = EFFORT_LEVELS.index(effort) if effort in EFFORT_LEVELS else 0
+    return EFFORT_LEVELS[max(0, min(len(EFFORT_LEVELS) - 1, index + delta))]
+
+
+class EffortPolicy:
+    """
+    根据负载、预算和提问历史调整 reasoning_effort
+    - 上游负载高或当日预算将尽时降一级
+    - 同一客户端短时间内重复提问（上次回答可能不满意）升一级，但预算将尽时不升级
+    """
+
+    def __init__(self, enabled: bool = EFFORT_POLICY_ENABLED):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._budget_day = None
+        self._budget_used = 0
+        self._budget_checked = 0.0
+
+    def _tokens_used_today(self, db: Session) -> int:
+        now = time.monotonic()
+        today = shanghai_today()
+        with self._lock:
+            if self._budget_day == today and now - self._budget_checked < BUDGET_CACHE_SECONDS:
+                return self._budget_used
+        used = get_tokens_used(db, today)
+        with self._lock:
+            self._budget_day, self._budget_used, self._budget_checked = today, used, now
+        return used
+
+    def _under_load(self) -> bool:
+        if UPSTREAM_MAX_STREAMS <= 0:
+            return False
+        return limiter.active_streams() >= UPSTREAM_MAX_STREAMS * EFFORT_DOWNGRADE_LOAD
+
+    def _over_budget(self, db: Session) -> bool:
+        if DAILY_TOKEN_BUDGET <= 0:
+            return False
+        return self._tokens_used_today(db) >= DAILY_TOKEN_BUDGET * 0.9
+
+    def _is_retry(self, client: Optional[str], question: str) -> bool:
+        """
+        记录本次提问，并判断同一客户端是否在窗口内重复提出同一问题
+        """
+        if EFFORT_RETRY_THRESHOLD <= 0 or not client:
+            return False
+        previous = limiter.record_ask(client, question_hash(question), EFFORT_RETRY_WINDOW)
+        return previous >= EFFORT_RETRY_THRESHOLD
+
+    def decide(self, requested: str, question: str, db: Session,
+               client: Optional[str] = None) -> Tuple[str, Optional[str]]:
+        """
+        决定本次请求实际使用的 reasoning_effort
+        :param requested: 前端请求的努力程度
+        :param question: 用户问题
+        :param db: 数据库会话
+        :param client: client_key() 的结果，用于识别同一客户端的重试；为None时不升级
+        :return: (实际努力程度, 调整原因)，未调整时原因为None
+        """
+        if not self.enabled:
+            return requested, None
+        effort, reason = requested, None
+        try:
+            retry = self._is_retry(client, question)
+            if self._over_budget(db):
+                effort, reason = _step(requested, -1), "budget"
+            elif self._under_load():
+                effort, reason = _step(requested, -1), "load"
+            elif retry:
+                effort, reason = _step(requested, 1), "retry"
+        except Exception as e:
+            # 策略只是优化，查询失败时按用户选择执行
+            logger.warning(f"reasoning_effort策略判断失败，使用请求值: {e}")
+        if effort == requested:
+            return requested, None
+        return effort, reason
+
+
+effort_policy = EffortPolicy()
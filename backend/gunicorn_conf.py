@@ -0,0 +1,118 @@
+# backend/gunicorn_conf.py
+# gunicorn 配置文件：gunicorn -c backend/gunicorn_conf.py backend.main:app
+import os
+import shutil
+import sys
+import time
+
+worker_class = "uvicorn.workers.UvicornWorker"
+
+
+def prepare_multiproc_dir():
+    """
+    准备Prometheus多进程目录：必须在导入应用之前完成，preload 时master导入 backend.metrics
+    就会在该目录中创建mmap文件，目录不存在会直接启动失败
+    只在首次加载配置时清空上次运行遗留的指标文件；SIGHUP重新加载配置时master已打开目录中的文件，不再清理
+    """
+    multiproc_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if not multiproc_dir:
+        return
+    if os.environ.get("PROMETHEUS_MULTIPROC_PREPARED") != "1":
+        shutil.rmtree(multiproc_dir, ignore_errors=True)
+        os.environ["PROMETHEUS_MULTIPROC_PREPARED"] = "1"
+    os.makedirs(multiproc_dir, exist_ok=True)
+
+
+prepare_multiproc_dir()
+bind = os.getenv("BIND", "0.0.0.0:8000")
+
+
+def available_cpus() -> int:
+    """
+    当前进程可用的CPU数：取CPU亲和性和 cgroup v2 cpu.max 配额中的较小值
+    容器中 os.cpu_count() 返回宿主机核数，按它计算会启动过多worker
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def default_workers(cpus: int) -> int:
+    """
+    聊天请求是等待上游的长时间SSE流，单个异步worker即可同时处理大量流；
+    CPU开销主要在JSON编解码和SQLite写入，因此每核一个worker再加一个备用，
+    至少两个（一个worker重启时仍可服务），上限避免多核机器上内存和SQLite写锁竞争成倍增加
+    """
+    max_workers = int(os.getenv("GUNICORN_MAX_WORKERS", "8"))
+    return max(2, min(cpus + 1, max_workers))
+
+
+workers = int(os.getenv("GUNICORN_WORKERS", "0")) or default_workers(available_cpus())
+
+# master导入应用后再fork：openai/fastapi/sqlalchemy等模块只导入一次，worker共享这些内存页，
+# 建表和迁移也只在master执行一次；fork后在 post_fork 中重建连接类资源
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+# worker心跳超时；UvicornWorker由事件循环发送心跳，长时间的SSE流不会触发超时，
+# 只有事件循环被阻塞这么久才会被master重启
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+# 收到 SIGTERM 后等待进行中请求完成的时间，与上游流的读取超时（300秒）一致，
+# 避免重新部署时截断正在生成的长回答；docker-compose 的 stop_grace_period 需大于该值
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "300"))
+# 大于 nginx 到后端的空闲连接超时，避免nginx复用一个后端刚关闭的连接
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "75"))
+
+
+def pre_fork(server, worker):
+    """
+    记录fork时间，worker初始化完成后据此计算启动耗时；
+    分配日志槽位：取存活worker未占用的最小序号，重启的worker接替退出worker的槽位
+    """
+    worker.fork_started = time.monotonic()
+    used = {getattr(other, "log_slot", None) for other in server.WORKERS.values()}
+    worker.log_slot = next(slot for slot in range(len(used) + 1) if slot not in used)
+
+
+def post_fork(server, worker):
+    """
+    preload 时应用已在master中导入：丢弃从master继承的连接池、HTTP客户端和日志线程，
+    在worker进程中重新创建，避免多个进程共用同一个socket或SQLite连接
+    日志槽位通过环境变量传给 logging_setup（未preload时应用在此之后才导入）
+    """
+    os.environ["LOG_WORKER_SLOT"] = str(worker.log_slot)
+    if "backend.main" in sys.modules:
+        sys.modules["backend.main"].reinit_after_fork()
+
+
+def post_worker_init(worker):
+    """
+    worker就绪后记录启动耗时和常驻内存
+    """
+    elapsed_ms = (time.monotonic() - getattr(worker, "fork_started", time.monotonic())) * 1000
+    rss_kb = None
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss_kb = int(line.split()[1])
+    except OSError:
+        pass
+    worker.log.info(f"worker {worker.pid} 启动耗时 {elapsed_ms:.0f}ms，RSS {rss_kb}KB，preload={worker.cfg.preload_app}")
+
+
+def child_exit(server, worker):
+    """
+    worker退出时清理它的livesum仪表（在途流、连接池）
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,254 @@
+# backend/logging_setup.py
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+from typing import Dict, Optional
+
+# 当前请求/会话ID，由中间件和聊天接口设置，日志记录时自动带上
+request_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+session_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("session_id", default=None)
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE", "app.log")
+# json: 文件写结构化JSON；text: 与控制台相同的文本格式
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# gunicorn 多worker部署时每个worker写自己的文件（app.<槽位>.log），每个文件只有一个进程写入和轮转；
+# 槽位由 gunicorn_conf.py 分配（0 ~ workers-1），worker重启后沿用空出的槽位，文件数不随重启增长
+LOG_PER_WORKER = os.getenv("LOG_PER_WORKER", "1") == "1"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_listener: Optional[QueueListener] = None
+_listener_pid: Optional[int] = None
+
+
+class ContextFilter(logging.Filter):
+    """
+    在产生日志的线程/协程中读取上下文变量，写入记录的 request_id / session_id 字段
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        record.session_id = session_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    每条日志输出为一行JSON
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "pid": record.process,
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            payload["request_id"] = request_id
+        session_id = getattr(record, "session_id", None)
+        if session_id:
+            payload["session_id"] = session_id
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload["exc"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    队列满时丢弃日志而不是阻塞请求，丢弃数在下一条成功入队的日志中补记
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._exc_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        合并消息参数、提前格式化异常栈，使记录可以安全地跨线程传递，
+        同时保留异常栈为独立字段供JSON格式输出
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            warning = logging.LogRecord(self.name or __name__, logging.WARNING, __file__, 0,
+                                        f"日志队列已满，丢弃 {dropped} 条日志", None, None)
+            try:
+                self.queue.put_nowait(warning)
+            except queue.Full:
+                self.dropped += dropped
+
+
+class LogSampler:
+    """
+    高频调试日志的按key限速采样（令牌桶），例如流式chunk日志
+    """
+
+    def __init__(self, per_second: float = 1.0, burst: int = 5):
+        self.per_second = per_second
+        self.burst = burst
+        self._buckets: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def allow(self, key: str) -> bool:
+        """
+        :param key: 采样键
+        :return: 本次是否允许输出
+        """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.burst), now]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.per_second)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                return False
+            bucket[0] = tokens - 1
+            return True
+
+
+log_sampler = LogSampler()
+
+
+def _log_file_path() -> str:
+    # 不在gunicorn worker中（单进程运行、preload时的master）时没有槽位，写 LOG_FILE
+    slot = os.getenv("LOG_WORKER_SLOT")
+    if not LOG_PER_WORKER or slot is None:
+        return LOG_FILE
+    root, ext = os.path.splitext(LOG_FILE)
+    return f"{root}.{slot}{ext or '.log'}"
+
+
+def _build_handlers():
+    text_formatter = logging.Formatter(TEXT_FORMAT)
+
+    # 控制台处理器
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(text_formatter)
+
+    # 每日轮转的文件处理器，保留30天，后缀例如 app.log.2023-10-01
+    log_path = _log_file_path()
+    log_dir = os.path.dirname(log_path)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+    file_handler = TimedRotatingFileHandler(
+        log_path,
+        when='midnight',
+        interval=1,
+        backupCount=30,
+        encoding='utf-8'
+    )
+    file_handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else text_formatter)
+    file_handler.suffix = "%Y-%m-%d"
+    return [console_handler, file_handler]
+
+
+def setup_logging():
+    """
+    配置根日志：请求路径上只把记录放入内存队列，
+    由后台 QueueListener 线程负责格式化和写控制台/文件
+    fork 之后（gunicorn preload）需在子进程内再次调用以重建监听线程和文件句柄
+    """
+    global _listener, _listener_pid
+    if _listener is not None and _listener_pid == os.getpid():
+        return
+    if _listener is not None:
+        # 从父进程继承的监听线程在子进程中不存在，直接丢弃
+        _listener = None
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+
+    _listener = QueueListener(log_queue, *_build_handlers(), respect_handler_level=True)
+    _listener.start()
+    _listener_pid = os.getpid()
+
+
+def shutdown_logging():
+    """
+    刷新队列中剩余的日志并停止后台线程
+    """
+    global _listener
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+    _listener = None
+
+
+atexit.register(shutdown_logging)
+
+
+class RequestContextMiddleware:
+    """
+    纯ASGI中间件：为每个请求生成（或沿用 X-Request-ID 头中的）请求ID，
+    写入上下文变量供日志使用，并在响应头中返回
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope.get("headers", []):
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex
+        request_token = request_id_var.set(request_id)
+        session_token = session_id_var.set(None)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_id_var.reset(request_token)
+            session_id_var.reset(session_token)
@@ -1,79 +1,84 @@
 # backend/main.py
 import os
-import sys
-from fastapi import FastAPI, HTTPException, Depends, Query
+from fastapi import FastAPI, HTTPException, Depends, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, StreamingResponse, Response, JSONResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import HTMLResponse, StreamingResponse, Response, JSONResponse, PlainTextResponse
 from pydantic import BaseModel
+from sqlalchemy import text
 from sqlalchemy.orm import Session
 from .rag_client import RagflowClient
-from .models import SessionLocal, ChatMessage, Base, engine
+from .timing import RequestTimer, format_server_timing, latency_stats
+from .metrics import (
+    PrometheusMiddleware, CHAT_STREAMS_IN_FLIGHT, CHAT_ERRORS,
+    instrument_engine, record_chat, render_metrics, update_pool_gauges
+)
+from .models import SessionLocal, ChatMessage, Base, engine, create_tables
+from .probes import UpstreamProber
+from .assets import CachedStaticFiles, IndexPage, asset_directory
+from .ratelimit import client_key, limiter
+from .effort_policy import effort_policy
+from .purger import DeletedSessionPurger, PURGE_ENABLED
+from .drain import drain, DRAIN_RETRY_AFTER, PARTIAL_ANSWER_NOTE
+from .suggestions import SuggestionPrecomputer, SUGGEST_ENABLED, find_answer, list_suggestions, replay_answer
+from .profiling import (
+    ProfilerBusy, SlowRequestMiddleware, attach_timer, check_admin_token,
+    loop_lag_monitor, profiler, slow_requests, trace_engine, ADMIN_TOKEN, PROFILE_MAX_SECONDS
+)
 from .crud import (
-    create_chat_session, save_chat_message, get_chat_sessions, 
+    create_chat_session, save_chat_message, get_history_rows,
     delete_chat_session, export_chats, delete_all_chat_sessions,
-    get_chat_session_by_uuid, get_chat_messages_by_session_uuid,
-    get_chat_session_by_id
+    get_chat_session_by_uuid, get_message_rows,
+    get_chat_session_by_id, get_usage_daily, get_stats, soft_delete_sessions,
+    get_transcript, get_transcript_version, get_message_thinking
 )
-from typing import Optional
-import json
-from dotenv import load_dotenv
+from .serialization import FastJSONResponse, SSE_DONE, shanghai_datetime, sse_event
+from .stats import mark_incremental_start
+from datetime import date
+from typing import List, Optional
+import anyio
+import asyncio
+import hashlib
 
 import logging
-from logging.handlers import TimedRotatingFileHandler
+from .logging_setup import setup_logging, shutdown_logging, session_id_var, RequestContextMiddleware
 # 注意：确保你已经正确导入了settings
 # from your_project import settings
 
 # 设置环境变量确保 UTF-8 编码
 os.environ['PYTHONIOENCODING'] = 'utf-8'
 
-# 配置日志
-log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-
-# 控制台处理器
-console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setFormatter(log_formatter)
-
-# 每日轮转的文件处理器
-# when='midnight' 表示每天午夜轮转
-# interval=1 表示间隔1天
-# backupCount=30 表示保留30天的日志文件
-file_handler = TimedRotatingFileHandler(
-    "app.log",
-    when='midnight',
-    interval=1,
-    backupCount=30,
-    encoding='utf-8'
-)
-file_handler.setFormatter(log_formatter)
-# 为轮转的日志文件添加后缀，例如 app.log.2023-10-01
-file_handler.suffix = "%Y-%m-%d"
-
-# 设置日志级别
-log_level = logging.INFO
-
-# 配置根日志
-logging.basicConfig(
-    level=log_level,
-    handlers=[console_handler, file_handler]
-)
+# 配置日志：请求路径只入队，后台线程负责写控制台和按天轮转的文件
+setup_logging()
 
 logger = logging.getLogger(__name__)
 
-# 加载.env文件
-load_dotenv()
-
 # 初始化RAG客户端
 rag = RagflowClient()
+prober = UpstreamProber(rag)
+purger = DeletedSessionPurger()
+suggestion_precomputer = SuggestionPrecomputer(rag)
 
 app = FastAPI(title="RAGFlow Chatbot API", 
               description="基于RAGFlow的聊天机器人API服务",
-              version="1.0.0")
+              version="1.0.0",
+              # 返回字典的接口也用 orjson 编码
+              default_response_class=FastJSONResponse)
+
+# 挂载静态文件目录（执行过 python -m backend.assets build 时使用带哈希和预压缩的 frontend/dist）
+app.mount("/static", CachedStaticFiles(directory=asset_directory("static")), name="static")
+app.mount("/assets", CachedStaticFiles(directory=asset_directory("assets")), name="assets")
+app.mount("/vendor", CachedStaticFiles(directory=asset_directory("vendor")), name="vendor")
+index_page = IndexPage()
 
-# 挂载静态文件目录
-app.mount("/static", StaticFiles(directory=os.path.join(os.path.dirname(__file__), "..", "frontend", "static")), name="static")
-app.mount("/assets", StaticFiles(directory=os.path.join(os.path.dirname(__file__), "..", "frontend", "assets")), name="assets")
-app.mount("/vendor", StaticFiles(directory=os.path.join(os.path.dirname(__file__), "..", "frontend", "vendor")), name="vendor")
+# 慢请求时间线采集（未设置阈值时不挂载）
+if slow_requests.enabled:
+    app.add_middleware(SlowRequestMiddleware, recorder=slow_requests)
+    trace_engine(engine)
+# 请求数、状态码与耗时统计
+app.add_middleware(PrometheusMiddleware)
+# 请求ID写入日志上下文
+app.add_middleware(RequestContextMiddleware)
+instrument_engine(engine)
 
 # 允许跨域
 app.add_middleware(
@@ -82,10 +87,20 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["X-Session-ID"],
+    expose_headers=["X-Session-ID", "X-Request-ID", "Server-Timing", "X-Cache"],
     max_age=86400
 )
 
+def reinit_after_fork():
+    """
+    gunicorn preload 时在每个worker的 post_fork 中调用
+    重建日志监听线程、数据库连接池和RAG客户端，这些资源不能在fork后的进程间共享
+    """
+    setup_logging()
+    # close=False：不关闭继承来的连接（它们仍属于master），只让本进程的连接池重新建立连接
+    engine.dispose(close=False)
+    rag.reset_after_fork()
+
 # 依赖注入数据库会话
 def get_db():
     """
@@ -98,11 +113,21 @@ def get_db():
     finally:
         db.close()
 
+def require_admin(request: Request):
+    """
+    管理接口鉴权：校验 X-Admin-Token 请求头；未配置 ADMIN_TOKEN 时接口不存在
+    """
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not check_admin_token(request.headers.get("x-admin-token")):
+        raise HTTPException(status_code=403, detail="管理令牌无效")
+
 @app.on_event("startup")
 async def startup_event():
     """
     应用启动时的预热任务
-    包括数据库表创建、数据库连接预热和RAG客户端预热
+    数据库表检查和连接预热在本地完成；RAG上游的预热和健康探测放到后台任务，
+    worker无需等待上游即可开始接受请求，就绪状态通过 /health/ready 暴露
     """
     logger.info("应用正在启动...")
 
@@ -119,6 +144,8 @@ async def startup_event():
         # 执行一个简单的查询来预热数据库
         db.query(ChatMessage).first()
         logger.info("数据库连接预热完成")
+        # 记录统计回填边界，之前的历史记录由 python -m backend.stats backfill 补齐
+        mark_incremental_start(db)
     except Exception as e:
         logger.error(f"数据库预热失败: {e}")
         # 尝试重新创建表
@@ -130,18 +157,22 @@ async def startup_event():
     finally:
         db.close()
     
-    # 预热RAG客户端
-    if rag.is_initialized:
-        try:
-            # 发送一个测试请求来预热RAG服务
-            test_messages = [{"role": "user", "content": "你好"}]
-            # 使用低优先级的推理进行预热
-            response = rag.chat("你好", stream=False, reasoning_effort="low")
-            logger.info("RAG客户端预热完成")
-        except Exception as e:
-            logger.error(f"RAG客户端预热失败: {e}")
-    else:
-        logger.warning("RAG客户端未初始化，跳过预热")
+    # 后台预热并周期探测RAG上游（多个worker中每轮只有一个访问上游）
+    prober.start()
+
+    # 后台分批物理删除已软删除的会话
+    if PURGE_ENABLED:
+        purger.start()
+
+    # 后台挖掘推荐问题，低峰期预计算回答
+    if SUGGEST_ENABLED:
+        suggestion_precomputer.start()
+
+    # 收到 SIGTERM 时先进入排空状态，再交给服务器停止监听
+    drain.install_signal_handlers()
+
+    # 事件循环阻塞监控（LOOP_LAG_MS 为0时不启动）
+    loop_lag_monitor.start()
     
     logger.info("应用启动完成")
 
@@ -149,56 +180,81 @@ async def startup_event():
 async def shutdown_event():
     """
     应用关闭时的清理任务
-    关闭所有打开的客户端连接
+    等待进行中的聊天流结束（最多到排空截止时间），再停止后台任务并关闭客户端和数据库连接池
     """
     logger.info("应用正在关闭...")
+    drain.begin()
+    await drain.wait_idle()
+    await prober.stop()
+    await purger.stop()
+    await suggestion_precomputer.stop()
+    loop_lag_monitor.stop()
     if rag.client:
         rag.client.close()
     if rag.async_client:
         await rag.async_client.close()
+    engine.dispose()
     logger.info("应用关闭完成")
+    shutdown_logging()
 
-@app.get("/health", 
-         summary="健康检查",
-         description="检查服务健康状态，包括数据库和RAG服务")
-async def health_check():
-    """健康检查端点"""
-    db_healthy = False
-    rag_healthy = False
+def _check_database():
+    """
+    检查数据库连接
+    :return: (是否健康, 详情)
+    """
     db_details = {}
-    
-    # 检查数据库连接
-    from .models import SessionLocal, ChatMessage
     db = SessionLocal()
     try:
-        db.query(ChatMessage).first()
-        db_healthy = True
+        db.execute(text("SELECT 1"))
         db_details["status"] = "connected"
+        return True, db_details
     except Exception as e:
         logger.error(f"数据库健康检查失败: {e}")
         db_details["status"] = "disconnected"
         db_details["error"] = str(e)
         # 尝试重新创建表
         try:
-            from .models import create_tables
             if create_tables():
                 db_details["recreate_tables"] = "success"
             else:
                 db_details["recreate_tables"] = "failed"
         except Exception as e2:
             db_details["recreate_error"] = str(e2)
+        return False, db_details
     finally:
         db.close()
-    
-    # 检查RAG服务
-    if rag.is_initialized:
-        try:
-            # 简单测试RAG服务可用性
-            rag_healthy = True
-        except Exception as e:
-            logger.error(f"RAG服务健康检查失败: {e}")
-    else:
-        rag_healthy = False
+
+@app.get("/health/live",
+         summary="存活探针",
+         description="进程和事件循环可以响应即视为存活，不访问数据库和上游")
+async def liveness_probe():
+    """存活探针"""
+    return {"status": "alive"}
+
+@app.get("/health/ready",
+         summary="就绪探针",
+         description="数据库可用且最近一次RAGFlow后台探测成功时返回200，否则返回503")
+def readiness_probe():
+    """就绪探针，只读取缓存的上游探测结果；排空期间返回503，负载均衡不再分配新请求"""
+    db_healthy, db_details = _check_database()
+    ready = db_healthy and prober.ready and not drain.draining
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "status": "ready" if ready else ("draining" if drain.draining else
+                                             "not_configured" if prober.state == "not_configured" else "not_ready"),
+            "database": {"status": "ok" if db_healthy else "error", "details": db_details},
+            "rag_service": prober.snapshot(),
+        }
+    )
+
+@app.get("/health", 
+         summary="健康检查",
+         description="检查服务健康状态，包括数据库和RAG服务（RAG状态来自后台探测缓存）")
+def health_check():
+    """健康检查端点"""
+    db_healthy, db_details = _check_database()
+    rag_healthy = prober.ready
     
     status_code = 200 if (db_healthy and rag_healthy) else 503
     
@@ -210,23 +266,81 @@ async def health_check():
                 "status": "ok" if db_healthy else "error",
                 "details": db_details
             },
-            "rag_service": "ok" if rag_healthy else "error"
+            "rag_service": "ok" if rag_healthy else "error",
+            "rag_probe": prober.snapshot(),
+            "purger": purger.snapshot(),
+            "drain": drain.snapshot(),
+            "suggestions": suggestion_precomputer.snapshot()
         }
     )
 
+@app.get("/metrics/latency",
+         summary="延迟直方图",
+         description="按reasoning_effort聚合的聊天请求阶段耗时直方图（当前worker）")
+async def latency_metrics():
+    """延迟直方图快照"""
+    return latency_stats.snapshot()
+
+@app.get("/metrics",
+         summary="Prometheus指标",
+         description="Prometheus文本格式指标，多worker部署时汇总所有worker")
+def prometheus_metrics():
+    """Prometheus抓取端点"""
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
+
+@app.get("/admin/profile", dependencies=[Depends(require_admin)], include_in_schema=False)
+async def profile_endpoint(seconds: float = Query(10, gt=0, le=PROFILE_MAX_SECONDS),
+                           interval_ms: float = Query(10, ge=1, le=1000),
+                           include_idle: bool = Query(False)):
+    """
+    对处理本请求的worker采样指定秒数，返回折叠栈文件（可用 flamegraph.pl 或 speedscope 打开）
+    :param seconds: 采样时长（秒）
+    :param interval_ms: 采样间隔（毫秒）
+    :param include_idle: 是否包含空闲等待的线程栈
+    """
+    try:
+        collapsed, summary = await asyncio.to_thread(profiler.run, seconds, interval_ms, include_idle)
+    except ProfilerBusy:
+        raise HTTPException(status_code=409, detail="当前worker正在采样，请稍后重试")
+    logger.info(f"采样完成: {summary}")
+    filename = f"profile-{summary['pid']}-{int(summary['finished_at'])}.collapsed"
+    return PlainTextResponse(collapsed, headers={
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "X-Worker-PID": str(summary["pid"]),
+        "X-Profile-Samples": str(summary["samples"]),
+    })
+
+@app.get("/admin/loop-lag", dependencies=[Depends(require_admin)], include_in_schema=False)
+def loop_lag_endpoint():
+    """当前worker的事件循环阻塞监控状态和最近的阻塞调用栈"""
+    return {"pid": os.getpid(), **loop_lag_monitor.snapshot()}
+
+@app.post("/admin/loop-lag", dependencies=[Depends(require_admin)], include_in_schema=False)
+async def loop_lag_toggle_endpoint(threshold_ms: float = Query(..., ge=0)):
+    """
+    在当前worker上开启（或调整）事件循环阻塞监控，0表示关闭
+    :param threshold_ms: 阻塞阈值（毫秒）
+    """
+    loop_lag_monitor.stop()
+    loop_lag_monitor.start(threshold_ms)
+    return {"pid": os.getpid(), **loop_lag_monitor.snapshot()}
+
+@app.get("/admin/slow-requests", dependencies=[Depends(require_admin)], include_in_schema=False)
+def slow_requests_endpoint(limit: int = Query(20, ge=1, le=50)):
+    """当前worker最近采集到的慢请求时间线（新的在前）"""
+    return {"pid": os.getpid(), **slow_requests.snapshot(limit)}
+
 # 根路径路由，返回前端页面
 @app.get("/", response_class=HTMLResponse)
-async def read_root():
+async def read_root(request: Request):
     """
     根路径路由，返回前端页面
+    页面内容缓存在内存中，文件变化时自动重新读取，支持ETag/304
     如果找不到前端文件则返回默认欢迎页面
     """
-    # 读取前端HTML文件
-    frontend_path = os.path.join(os.path.dirname(__file__), "..", "frontend", "templates", "index.html")
     try:
-        with open(frontend_path, "r", encoding="utf-8") as file:
-            html_content = file.read()
-        return HTMLResponse(content=html_content, status_code=200)
+        return index_page.response(request.headers.get("if-none-match"))
     except FileNotFoundError:
         logger.warning("前端文件未找到，返回默认页面")
         return HTMLResponse(content="<h1>Welcome to RAGFlow Chatbot</h1><p>Frontend files not found.</p>", status_code=200)
@@ -246,107 +360,293 @@ class SaveChatRequest(BaseModel):
     answer: str
     thinking_content: Optional[str] = None
 
+class BulkDeleteRequest(BaseModel):
+    """
+    批量删除请求模型，条件之间为“且”的关系，至少需要一个条件
+    """
+    session_ids: Optional[List[int]] = None
+    start: Optional[date] = None  # 创建日期起始（含，上海时区）
+    end: Optional[date] = None  # 创建日期结束（含，上海时区）
+    keyword: Optional[str] = None  # 标题关键词
+
+def _reconnect_event(partial: bool, session_id: Optional[str] = None) -> bytes:
+    """
+    通知客户端本实例即将停止，稍后重新连接（由nginx分配到其他实例）
+    :param partial: 是否已输出并保存了部分回答
+    """
+    return sse_event({'type':'reconnect','message':'服务正在重启，请稍后重试','retry_after':DRAIN_RETRY_AFTER,'partial':partial,'session_id':session_id})
+
+def _reconnect_response() -> StreamingResponse:
+    """
+    排空期间拒绝新的聊天请求：返回 reconnect 事件，客户端按 retry_after 重新连接，由 nginx 分配到其他后端
+    状态码保持200：浏览器 EventSource 不解析非200响应的内容，503 会让 reconnect 事件无法送达
+    """
+    def reconnect_stream():
+        yield _reconnect_event(partial=False)
+        yield SSE_DONE
+    return StreamingResponse(reconnect_stream(), media_type="text/event-stream",
+                             headers={"Retry-After": str(DRAIN_RETRY_AFTER), "Connection": "close"})
+
 @app.get("/chat")
-async def chat_sse(message: str, deep_thinking: bool = False, db: Session = Depends(get_db)):
+async def chat_sse(request: Request, message: str, deep_thinking: bool = False, db: Session = Depends(get_db)):
     """
     聊天接口，支持SSE流式响应
+    按客户端限流（令牌桶 + 并发流上限），上游饱和时加权公平排队；命中预计算回答时只受令牌桶限制
     """
     if not rag:
         def error_stream():
-            yield f"data: {json.dumps({'type':'error','message':'RAG client not configured properly. Check environment variables.'})}\n\n"
-            yield f"data: [DONE]\n\n"
+            yield sse_event({'type':'error','message':'RAG client not configured properly. Check environment variables.'})
+            yield SSE_DONE
         return StreamingResponse(error_stream(), media_type="text/event-stream")
+
+    if drain.draining:
+        return _reconnect_response()
     
+    admission = None
     try:
+        # 根据深度思考选项设置reasoning_effort参数（启用策略时可能再按负载/预算调整）
+        reasoning_effort = "high" if deep_thinking else "low"
+        timer = RequestTimer(reasoning_effort)
+        attach_timer(timer)
+        effort_reason = None
+
+        # 热门问题的预计算回答：命中时直接回放，不访问上游，也不再按策略调整 reasoning_effort
+        cached_answer = None
+        if SUGGEST_ENABLED:
+            try:
+                cached_answer = find_answer(db, message, reasoning_effort)
+            except Exception as e:
+                logger.warning(f"查询预计算回答失败: {e}")
+
+        # 客户端准入：超出速率或并发上限时返回 code 429 的错误事件，排队超时为 code 503；回放预计算回答只扣令牌
+        client = client_key(request.headers, request.client.host if request.client else None)
+        admission = await limiter.admit(client, upstream=not cached_answer)
+        if not admission.allowed:
+            logger.info(f"聊天请求被限流: {admission.reason}")
+            limit_message = "请求过于频繁，请稍后重试" if admission.reason != "queue_timeout" else "服务繁忙，请稍后重试"
+            retry_after = int(admission.retry_after) + 1
+            def limited_stream():
+                yield sse_event({'type':'error','message':limit_message,'code':429 if admission.reason != 'queue_timeout' else 503,'retry_after':retry_after})
+                yield SSE_DONE
+            # HTTP状态码保持200：浏览器 EventSource 遇到非200响应不解析响应体，只会触发 onerror 并自动重试，
+            # 用户看不到限流提示，重试还会继续消耗令牌；限流原因通过事件的 code 传达
+            return StreamingResponse(
+                limited_stream(), media_type="text/event-stream",
+                headers={"Retry-After": str(retry_after)}
+            )
+        timer.mark("admitted")
+        # 排队期间可能已开始排空
+        if drain.draining:
+            await limiter.release(admission.lease_id)
+            return _reconnect_response()
+
+        if cached_answer:
+            # 命中的请求单独计入延迟直方图，不影响上游请求的分位数
+            timer.reasoning_effort = "cached"
+        else:
+            # 重试按同一客户端在短时间内重复提问识别，不看问题的全局提问次数
+            # 决策要读写限流库和统计表（含 BEGIN IMMEDIATE），放到线程里执行，避免阻塞事件循环
+            reasoning_effort, effort_reason = await asyncio.to_thread(
+                effort_policy.decide, reasoning_effort, message, db, client)
+            if effort_reason:
+                logger.info(f"reasoning_effort调整为 {reasoning_effort}（{effort_reason}）")
+                timer.reasoning_effort = reasoning_effort
+
         # 立即创建新的聊天会话并保存用户消息，提升响应速度
         session = create_chat_session(db, title=message[:50])
         session_id = session.id
+        session_id_var.set(session.session_id)
         save_chat_message(db, session_id, "user", message)
-        
-        # 根据深度思考选项设置reasoning_effort参数
-        reasoning_effort = "high" if deep_thinking else "low"
+        timer.mark("db_prepared")
         
         # 构造消息
         messages = [{"role": "user", "content": message}]
         
-        # 立即获取异步生成器，不等待
-        response_stream = rag.async_chat(messages, reasoning_effort=reasoning_effort)
+        # 立即获取异步生成器，不等待；排空截止时间到达后 guard 输出 drain 事件并结束
+        upstream = replay_answer(cached_answer, timer) if cached_answer else \
+            rag.async_chat(messages, reasoning_effort=reasoning_effort, timer=timer)
+        response_stream = drain.guard(upstream)
         
         # 用于存储完整响应以保存到数据库
         full_content = ""
         thinking_content = ""
+        saved = False
+
+        def save_partial():
+            """保存排空时未完成的回答"""
+            nonlocal saved
+            saved = True
+            if not full_content and not thinking_content:
+                return
+            save_chat_message(db, session_id, "assistant", full_content + PARTIAL_ANSWER_NOTE, thinking_content,
+                              reasoning_effort=reasoning_effort, latency_ms=timer.elapsed_ms(),
+                              ttft_ms=timer.phases().get("ttft_answer"))
+            logger.info(f"已保存未完成的回答（{len(full_content)} 字）")
         
         async def event_stream():
-            nonlocal full_content, thinking_content
+            nonlocal full_content, thinking_content, saved
+            CHAT_STREAMS_IN_FLIGHT.inc()
+            if rag.async_client:
+                update_pool_gauges(rag.async_client)
             try:
                 # 立即开始处理流
                 async for chunk in response_stream:
                     if chunk["type"] == "thinking":
                         thinking_content += chunk["content"]
-                        yield f"data: {json.dumps({'type':'thinking','content':chunk['content']})}\n\n"
+                        yield sse_event({'type':'thinking','content':chunk['content']})
                     elif chunk["type"] == "content":
                         full_content += chunk["content"]
-                        yield f"data: {json.dumps({'type':'content','content':chunk['content']})}\n\n"
+                        yield sse_event({'type':'content','content':chunk['content']})
                     elif chunk["type"] == "complete":
                         thinking_content = chunk.get("thinking_content", thinking_content)
                         full_content = chunk.get("response_content", full_content)
                         
                         # 异步保存助手回复到数据库
-                        save_chat_message(db, session_id, "assistant", full_content, thinking_content)
+                        timer.mark("persist_start")
+                        usage = chunk.get("usage")
+                        saved = True
+                        save_chat_message(db, session_id, "assistant", full_content, thinking_content,
+                                          reasoning_effort=reasoning_effort, usage=usage,
+                                          latency_ms=timer.elapsed_ms(), ttft_ms=timer.phases().get("ttft_answer"))
+                        timer.mark("db_persisted")
                         
                         # 重新获取session对象，确保它与当前数据库会话绑定
                         updated_session = get_chat_session_by_id(db, session_id)
                         
                         # 发送完成信号，包含完整的思考和回复内容
-                        yield f"data: {json.dumps({'type':'complete','thinking_content':thinking_content,'response_content':full_content, 'session_id': updated_session.session_id if updated_session else session.session_id})}\n\n"
+                        yield sse_event({'type':'complete','thinking_content':thinking_content,'response_content':full_content, 'session_id': updated_session.session_id if updated_session else session.session_id})
+
+                        # 发送本次请求的阶段耗时，并计入按reasoning_effort聚合的直方图
+                        timer.mark("end")
+                        latency_stats.record(timer)
+                        record_chat(timer)
+                        yield sse_event({'type':'metrics', **timer.summary(), 'usage': usage, 'effort_reason': effort_reason})
                         break
                     elif chunk["type"] == "error":
-                        yield f"data: {json.dumps({'type':'error','message':chunk['message']})}\n\n"
-                        yield f"data: [DONE]\n\n"
+                        CHAT_ERRORS.labels(str(chunk.get("code", 500))).inc()
+                        yield sse_event({'type':'error','message':chunk['message']})
+                        yield SSE_DONE
+                        return
+                    elif chunk["type"] == "drain":
+                        # 服务即将停止：保存已生成的部分，通知客户端到其他实例重新提问
+                        save_partial()
+                        yield _reconnect_event(partial=bool(full_content or thinking_content),
+                                               session_id=session.session_id)
+                        yield SSE_DONE
                         return
                 
                 # 发送最终完成信号
-                yield f"data: [DONE]\n\n"
+                yield SSE_DONE
             except Exception as e:
                 logger.error(f"处理聊天流时发生错误: {str(e)}", exc_info=True)
-                yield f"data: {json.dumps({'type':'error','message':str(e)})}\n\n"
-                yield f"data: [DONE]\n\n"
+                CHAT_ERRORS.labels("500").inc()
+                yield sse_event({'type':'error','message':str(e)})
+                yield SSE_DONE
+            finally:
+                # 排空期间流被取消（客户端断开或超过停机时限）时也保留已生成的内容
+                if drain.draining and not saved:
+                    try:
+                        save_partial()
+                    except Exception as e:
+                        logger.error(f"保存未完成的回答失败: {e}")
+                # 客户端断开时任务会再次被取消：同步的计数先做，需要等待的清理放在屏蔽取消的范围内，
+                # 并且关闭上游流失败时也要释放租约，否则并发流名额和在途流仪表都会泄漏
+                CHAT_STREAMS_IN_FLIGHT.dec()
+                with anyio.CancelScope(shield=True):
+                    try:
+                        await response_stream.aclose()
+                    finally:
+                        await limiter.release(admission.lease_id)
+                if rag.async_client:
+                    update_pool_gauges(rag.async_client)
 
-        return StreamingResponse(event_stream(), media_type="text/event-stream")
+        # 流开始前只有数据库准备阶段已知，完整时间线通过SSE metrics事件下发
+        return StreamingResponse(event_stream(), media_type="text/event-stream",
+                                 headers={"Server-Timing": format_server_timing(timer.phases()),
+                                          "X-Cache": "hit" if cached_answer else "miss"})
     except Exception as e:
         logger.error(f"处理聊天请求时发生错误: {str(e)}", exc_info=True)
+        if admission:
+            await limiter.release(admission.lease_id)
+        # except 块结束后 e 会被删除，生成器执行时不能再引用它
+        error_message = str(e)
         def error_stream():
-            yield f"data: {json.dumps({'type':'error','message':str(e)})}\n\n"
-            yield f"data: [DONE]\n\n"
+            yield sse_event({'type':'error','message':error_message})
+            yield SSE_DONE
         return StreamingResponse(error_stream(), media_type="text/event-stream")
 
+@app.get("/suggestions")
+def suggestions_endpoint(db: Session = Depends(get_db)):
+    """
+    欢迎页的推荐问题：从聊天记录中挖掘的高频和近期热门问题，cached 表示已有预计算回答，点击后立即返回
+    """
+    try:
+        items = list_suggestions(db)
+    except Exception as e:
+        logger.error(f"获取推荐问题失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"获取推荐问题失败: {str(e)}")
+    return FastJSONResponse(content={"suggestions": items}, headers={"Cache-Control": "private, max-age=60"})
+
+@app.get("/usage")
+def usage_endpoint(db: Session = Depends(get_db), start: Optional[date] = Query(None), end: Optional[date] = Query(None)):
+    """
+    按天（上海时区）和reasoning_effort汇总的token用量
+    :param start: 起始日期（含），例如 2024-01-01
+    :param end: 结束日期（含）
+    """
+    try:
+        rows = get_usage_daily(db, start, end)
+        days = [{
+            "day": row.day.isoformat(),
+            "reasoning_effort": row.reasoning_effort,
+            "messages": row.messages,
+            "prompt_tokens": row.prompt_tokens,
+            "completion_tokens": row.completion_tokens,
+            "reasoning_tokens": row.reasoning_tokens,
+        } for row in rows]
+        totals = {}
+        for item in days:
+            total = totals.setdefault(item["reasoning_effort"], {"messages": 0, "prompt_tokens": 0, "completion_tokens": 0, "reasoning_tokens": 0})
+            for key in total:
+                total[key] += item[key]
+        return {"days": days, "totals": totals}
+    except Exception as e:
+        logger.error(f"获取token用量失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"获取token用量失败: {str(e)}")
+
+@app.get("/stats")
+def stats_endpoint(db: Session = Depends(get_db), start: Optional[date] = Query(None), end: Optional[date] = Query(None),
+                   granularity: str = Query("day", pattern="^(hour|day)$")):
+    """
+    按小时或按天（上海时区）汇总的使用统计：会话数、消息数、平均回复长度、深度思考占比、延迟分位数
+    只读取汇总表，不扫描聊天记录表
+    :param start: 起始日期（含），例如 2024-01-01
+    :param end: 结束日期（含）
+    :param granularity: hour 或 day
+    """
+    try:
+        return get_stats(db, start, end, granularity)
+    except Exception as e:
+        logger.error(f"获取使用统计失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"获取使用统计失败: {str(e)}")
+
 @app.get("/history")
 def history_endpoint(db: Session = Depends(get_db), q: str = Query(None), page: int = Query(1, ge=1), page_size: int = Query(10, ge=1, le=50)):
     """
     获取聊天历史记录列表
     支持关键词搜索和分页
     """
-    sessions = get_chat_sessions(db, keyword=q, page=page, page_size=page_size)
-    # 转换为上海时区
-    import pytz
-    shanghai_tz = pytz.timezone('Asia/Shanghai')
-    
-    result = []
-    for session in sessions:
-        # 获取会话的最新消息作为预览
-        latest_message = db.query(ChatMessage).filter(ChatMessage.session_id == session.id).order_by(ChatMessage.timestamp.desc()).first()
-        
-        if latest_message:
-            local_timestamp = session.updated_at.replace(tzinfo=pytz.utc).astimezone(shanghai_tz) if session.updated_at else session.created_at.replace(tzinfo=pytz.utc).astimezone(shanghai_tz)
-            result.append({
-                "id": session.id,
-                "session_id": session.session_id,
-                "title": session.title or "无标题对话",
-                "preview": latest_message.content[:100] + ("..." if len(latest_message.content) > 100 else ""),
-                "timestamp": local_timestamp.isoformat()
-            })
-    
-    return result
+    # 会话和最新消息的预览在同一条查询中取出，行直接编码为JSON，不经过 jsonable_encoder；
+    # 与原实现一致，先分页再跳过没有消息的会话
+    rows = get_history_rows(db, keyword=q, page=page, page_size=page_size)
+    return FastJSONResponse(content=[{
+        "id": row.id,
+        "session_id": row.session_id,
+        "title": row.title or "无标题对话",
+        "preview": row.preview + "..." if row.content_length > 100 else row.preview,
+        # 转换为上海时区
+        "timestamp": shanghai_datetime(row.updated_at)
+    } for row in rows if row.preview is not None])
 
 @app.post("/history")
 def save_chat_endpoint(chat: SaveChatRequest, db: Session = Depends(get_db)):
@@ -379,30 +679,76 @@ def get_chat_history_endpoint(session_uuid: str, db: Session = Depends(get_db)):
         if not session:
             return JSONResponse(status_code=404, content={"message": "Chat session not found"})
         
-        # 获取会话中的所有消息
-        messages = get_chat_messages_by_session_uuid(db, session_uuid)
-        if messages is None:
-            return JSONResponse(status_code=404, content={"message": "Chat session not found"})
-        
-        # 转换为上海时区
-        import pytz
-        shanghai_tz = pytz.timezone('Asia/Shanghai')
+        # 获取会话中的所有消息（分页和按需加载思考内容请使用 /history/{session_uuid}/transcript）
+        messages = get_message_rows(db, session.id)
         
-        result_messages = []
-        for message in messages:
-            local_timestamp = message.timestamp.replace(tzinfo=pytz.utc).astimezone(shanghai_tz)
-            result_messages.append({
-                "role": message.role,
-                "content": message.content,
-                "thinking_content": message.thinking_content,
-                "timestamp": local_timestamp.isoformat()
-            })
+        result_messages = [{
+            "role": role,
+            "content": content,
+            "thinking_content": thinking_content,
+            "timestamp": shanghai_datetime(timestamp)
+        } for role, content, thinking_content, timestamp in messages]
         
-        return {"messages": result_messages, "session_id": session.session_id, "title": session.title}
+        return FastJSONResponse(content={"messages": result_messages, "session_id": session.session_id, "title": session.title})
     except Exception as e:
         logger.error(f"获取聊天历史记录时发生错误: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail="获取聊天历史记录失败")
 
+def _transcript_etag(session_uuid: str, updated_at, message_count: int, *params) -> str:
+    """
+    会话记录的ETag：会话更新时间和消息数不变时，同一分页参数的结果不变
+    """
+    version = f"{session_uuid}:{updated_at.isoformat() if updated_at else ''}:{message_count}:" + ":".join(map(str, params))
+    return 'W/"' + hashlib.sha1(version.encode("utf-8")).hexdigest()[:20] + '"'
+
+@app.get("/history/{session_uuid}/transcript")
+def transcript_endpoint(session_uuid: str, request: Request, db: Session = Depends(get_db),
+                        cursor: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=200),
+                        include_thinking: bool = Query(False)):
+    """
+    分页获取会话记录
+    默认不返回思考内容（消息中的 has_thinking 标记是否存在，按需通过 thinking 接口获取），
+    按消息ID游标分页（next_cursor 为空表示已到最后一页），
+    带 If-None-Match 且会话未变化时返回304
+    """
+    params = (cursor, limit, int(include_thinking))
+    headers = {"Cache-Control": "private, no-cache"}
+    try:
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            version = get_transcript_version(db, session_uuid)
+            if version is None:
+                return JSONResponse(status_code=404, content={"message": "Chat session not found"})
+            etag = _transcript_etag(session_uuid, version[0], version[1], *params)
+            if etag in [tag.strip() for tag in if_none_match.split(",")]:
+                return Response(status_code=304, headers={**headers, "ETag": etag})
+
+        transcript = get_transcript(db, session_uuid, after_id=cursor, limit=limit, include_thinking=include_thinking)
+        if transcript is None:
+            return JSONResponse(status_code=404, content={"message": "Chat session not found"})
+        headers["ETag"] = _transcript_etag(session_uuid, transcript["updated_at"], transcript["message_count"], *params)
+        transcript["updated_at"] = shanghai_datetime(transcript["updated_at"])
+        return FastJSONResponse(content=transcript, headers=headers)
+    except Exception as e:
+        logger.error(f"获取会话记录时发生错误: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail="获取会话记录失败")
+
+@app.get("/history/{session_uuid}/messages/{message_id}/thinking")
+def message_thinking_endpoint(session_uuid: str, message_id: int, db: Session = Depends(get_db)):
+    """
+    获取单条消息的思考内容（会话记录接口默认不返回）
+    消息保存后不再修改，允许浏览器缓存
+    """
+    try:
+        thinking_content = get_message_thinking(db, session_uuid, message_id)
+        if thinking_content is None:
+            return JSONResponse(status_code=404, content={"message": "Message not found"})
+        return FastJSONResponse(content={"id": message_id, "thinking_content": thinking_content},
+                            headers={"Cache-Control": "private, max-age=86400"})
+    except Exception as e:
+        logger.error(f"获取思考内容时发生错误: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail="获取思考内容失败")
+
 @app.delete("/history/{session_id}")
 def delete_endpoint(session_id: int, db: Session = Depends(get_db)):
     """
@@ -415,6 +761,22 @@ def delete_endpoint(session_id: int, db: Session = Depends(get_db)):
         logger.error(f"删除聊天会话时发生错误: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail="删除聊天会话失败")
 
+@app.post("/history/delete")
+def bulk_delete_endpoint(request: BulkDeleteRequest, db: Session = Depends(get_db)):
+    """
+    按会话ID列表、创建日期范围或标题关键词批量删除聊天会话
+    分批软删除后立即返回，消息由后台任务清理
+    """
+    if request.session_ids is None and not (request.start or request.end or request.keyword):
+        raise HTTPException(status_code=400, detail="至少需要一个删除条件，删除全部请使用 DELETE /history")
+    try:
+        deleted = soft_delete_sessions(db, session_ids=request.session_ids, start=request.start,
+                                       end=request.end, keyword=request.keyword)
+        return {"ok": True, "deleted": deleted}
+    except Exception as e:
+        logger.error(f"批量删除聊天会话时发生错误: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail="批量删除聊天会话失败")
+
 @app.delete("/history")
 def delete_all_endpoint(db: Session = Depends(get_db)):
     """
@@ -0,0 +1,183 @@
+# backend/metrics.py
+import os
+import time
+from typing import Optional
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram,
+    REGISTRY, generate_latest,
+)
+from prometheus_client import multiprocess
+from sqlalchemy import event
+
+from .timing import RequestTimer
+
+# gunicorn多worker时必须在导入prometheus_client之前设置该目录，
+# 各worker把指标写入该目录下的mmap文件，抓取时由MultiProcessCollector汇总
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+HTTP_REQUESTS = Counter(
+    "http_requests_total", "HTTP请求数", ["method", "route", "status"]
+)
+HTTP_DURATION = Histogram(
+    "http_request_duration_seconds", "HTTP请求耗时（流式响应计算到最后一个字节）",
+    ["method", "route"], buckets=LATENCY_BUCKETS
+)
+CHAT_STREAMS_IN_FLIGHT = Gauge(
+    "chat_streams_in_flight", "正在进行的聊天SSE流", multiprocess_mode="livesum"
+)
+CHAT_ERRORS = Counter(
+    "chat_upstream_errors_total", "RAGFlow上游错误", ["code"]
+)
+CHAT_PHASE_DURATION = Histogram(
+    "chat_phase_duration_seconds", "聊天请求各阶段耗时",
+    ["reasoning_effort", "phase"], buckets=LATENCY_BUCKETS
+)
+CHAT_CHUNKS = Counter(
+    "chat_stream_chunks_total", "上游流式chunk数", ["reasoning_effort"]
+)
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds", "数据库语句耗时", ["operation"], buckets=DB_BUCKETS
+)
+HTTPX_POOL_CONNECTIONS = Gauge(
+    "httpx_pool_connections", "RAGFlow异步客户端连接池中的连接", ["state"],
+    multiprocess_mode="livesum"
+)
+RATE_LIMITED = Counter(
+    "rate_limited_total", "被限流拒绝的聊天请求", ["reason"]
+)
+FAIR_QUEUE_WAIT = Histogram(
+    "fair_queue_wait_seconds", "上游饱和时的公平排队等待时间", buckets=LATENCY_BUCKETS
+)
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds", "事件循环心跳回调的延迟（开启阻塞监控时采集）",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total", "缓存访问次数，命中率 = hit / (hit + miss)", ["cache", "result"]
+)
+
+
+def render_metrics():
+    """
+    生成Prometheus文本格式的指标
+    多进程模式下汇总所有worker，否则返回当前进程的默认注册表
+    :return: (内容, Content-Type)
+    """
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def record_chat(timer: RequestTimer):
+    """
+    将一次聊天请求的阶段耗时计入Prometheus直方图
+    :param timer: 已结束的请求计时器
+    """
+    effort = timer.reasoning_effort
+    for phase, value in timer.phases().items():
+        CHAT_PHASE_DURATION.labels(effort, phase).observe(value / 1000.0)
+    if timer.chunks:
+        CHAT_CHUNKS.labels(effort).inc(timer.chunks)
+
+
+def record_cache(cache: str, hit: bool):
+    """
+    记录一次缓存访问
+    :param cache: 缓存名称
+    :param hit: 是否命中
+    """
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def update_pool_gauges(async_client):
+    """
+    采样httpx连接池状态（依赖httpcore内部属性，取不到时静默跳过）
+    :param async_client: AsyncOpenAI实例
+    """
+    http_client = getattr(async_client, "_client", None)
+    pool = getattr(getattr(http_client, "_transport", None), "_pool", None)
+    connections = getattr(pool, "connections", None)
+    if connections is None:
+        return
+    idle = sum(1 for conn in connections if conn.is_idle())
+    HTTPX_POOL_CONNECTIONS.labels("idle").set(idle)
+    HTTPX_POOL_CONNECTIONS.labels("active").set(len(connections) - idle)
+
+
+def instrument_engine(engine):
+    """
+    为SQLAlchemy引擎挂载语句耗时统计
+    :param engine: SQLAlchemy引擎
+    """
+    # 开始时间保存在本条语句的执行上下文上：语句失败时不会触发 after_cursor_execute，
+    # 保存在连接上的开始时间会残留并错配给该连接之后的语句
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._query_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_execute(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_query_start", None)
+        if started is None:
+            return
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement else "UNKNOWN"
+        DB_QUERY_DURATION.labels(operation).observe(time.perf_counter() - started)
+
+
+def _route_label(scope) -> str:
+    """
+    使用路由模板而不是原始路径作为标签，避免 /history/{uuid} 造成标签爆炸
+    """
+    route = scope.get("route")
+    path = getattr(route, "path", None)
+    if path:
+        return path
+    raw_path = scope.get("path", "")
+    for prefix in ("/static", "/assets", "/vendor"):
+        if raw_path.startswith(prefix + "/"):
+            return prefix
+    return "unmatched"
+
+
+class PrometheusMiddleware:
+    """
+    纯ASGI中间件，统计请求数、状态码和耗时
+    不使用BaseHTTPMiddleware，以免缓冲SSE流
+    """
+
+    def __init__(self, app, skip_paths=("/metrics",)):
+        self.app = app
+        self.skip_paths = skip_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("path") in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status: Optional[int] = None
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            status = 500
+            raise
+        finally:
+            route = _route_label(scope)
+            method = scope.get("method", "GET")
+            HTTP_REQUESTS.labels(method, route, str(status or 500)).inc()
+            HTTP_DURATION.labels(method, route).observe(time.perf_counter() - start)
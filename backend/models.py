@@ -1,5 +1,6 @@
 # backend/models.py
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy import create_engine, event, Column, Integer, String, Text, DateTime, ForeignKey, Date
+from sqlalchemy.schema import CreateTable
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.dialects.postgresql import UUID
@@ -34,11 +35,27 @@ def create_database_engine(database_url):
             logger.info(f"数据库文件路径: {db_path}")
             
         engine = create_engine(database_url, connect_args={"check_same_thread": False})
+        enable_sqlite_pragmas(engine)
         return engine
     except Exception as e:
         logger.error(f"创建数据库引擎失败: {e}")
         raise
 
+def enable_sqlite_pragmas(engine):
+    """
+    SQLite每个连接都需要单独开启外键约束，否则 ON DELETE CASCADE 不生效
+    auto_vacuum 只对尚未建表的新库生效，已有库需执行一次 python -m backend.purger vacuum
+    """
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        cursor.close()
+
 # 尝试创建数据库引擎
 try:
     engine = create_database_engine(DATABASE_URL)
@@ -49,6 +66,7 @@ except Exception as e:
     logger.error(f"数据库连接失败: {e}")
     # 如果连接失败，使用内存数据库作为后备方案
     engine = create_engine("sqlite:///:memory:", connect_args={"check_same_thread": False})
+    enable_sqlite_pragmas(engine)
     SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
     Base = declarative_base()
     logger.info("使用内存数据库作为后备方案")
@@ -60,14 +78,17 @@ class ChatSession(Base):
     title = Column(String(200))
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # 软删除时间，非空的会话不再展示，由后台清理任务分批物理删除
+    deleted_at = Column(DateTime, index=True)
     
-    # 关联的消息
-    messages = relationship("ChatMessage", back_populates="session", order_by="ChatMessage.timestamp")
+    # 关联的消息（由数据库 ON DELETE CASCADE 删除，ORM不再逐条加载）
+    messages = relationship("ChatMessage", back_populates="session", order_by="ChatMessage.timestamp",
+                            cascade="all, delete-orphan", passive_deletes=True)
 
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
     id = Column(Integer, primary_key=True, index=True)
-    session_id = Column(Integer, ForeignKey("chat_sessions.id"))
+    session_id = Column(Integer, ForeignKey("chat_sessions.id", ondelete="CASCADE"), index=True)
     role = Column(String(10))  # user 或 assistant
     content = Column(Text)
     thinking_content = Column(Text)  # 存储思考过程
@@ -75,11 +96,156 @@ class ChatMessage(Base):
     
     # 关联的会话
     session = relationship("ChatSession", back_populates="messages")
+    # token用量（仅助手消息）
+    usage = relationship("MessageUsage", uselist=False, back_populates="message", passive_deletes=True)
+
+class MessageUsage(Base):
+    """
+    助手消息的token用量，与chat_messages一对一
+    单独建表，避免修改已有的chat_messages表结构
+    """
+    __tablename__ = "message_usage"
+    message_id = Column(Integer, ForeignKey("chat_messages.id", ondelete="CASCADE"), primary_key=True)
+    reasoning_effort = Column(String(10))
+    prompt_tokens = Column(Integer)
+    completion_tokens = Column(Integer)
+    reasoning_tokens = Column(Integer)
+    source = Column(String(10))  # upstream: 上游返回；estimate: 按chunk数估算
+
+    message = relationship("ChatMessage", back_populates="usage")
+
+class UsageDaily(Base):
+    """
+    按天（上海时区）和reasoning_effort汇总的token用量，保存消息时增量更新
+    """
+    __tablename__ = "usage_daily"
+    day = Column(Date, primary_key=True)
+    reasoning_effort = Column(String(10), primary_key=True)
+    messages = Column(Integer, default=0, nullable=False)
+    prompt_tokens = Column(Integer, default=0, nullable=False)
+    completion_tokens = Column(Integer, default=0, nullable=False)
+    reasoning_tokens = Column(Integer, default=0, nullable=False)
+
+class QuestionStat(Base):
+    """
+    按规范化问题文本哈希统计的提问次数，用于识别被反复追问的问题
+    """
+    __tablename__ = "question_stats"
+    question_hash = Column(String(64), primary_key=True)
+    question = Column(Text)
+    asks = Column(Integer, default=0, nullable=False)
+    first_asked = Column(DateTime, default=datetime.utcnow)
+    last_asked = Column(DateTime, default=datetime.utcnow)
+
+class StatsHourly(Base):
+    """
+    按小时（上海时区）汇总的使用统计，保存会话和消息时增量更新，/stats 只查询汇总表
+    """
+    __tablename__ = "stats_hourly"
+    hour = Column(DateTime, primary_key=True)  # 上海时区的整点，不带时区信息
+    sessions = Column(Integer, default=0, nullable=False)
+    user_messages = Column(Integer, default=0, nullable=False)
+    assistant_messages = Column(Integer, default=0, nullable=False)
+    answer_chars = Column(Integer, default=0, nullable=False)
+    effort_messages = Column(Integer, default=0, nullable=False)  # 已知reasoning_effort的助手消息数
+    deep_thinking_messages = Column(Integer, default=0, nullable=False)  # reasoning_effort不为low的助手消息数
+
+class StatsLatency(Base):
+    """
+    按小时的延迟直方图，每个桶一行，用原子加一更新，跨小时合并后再计算分位数
+    """
+    __tablename__ = "stats_latency"
+    hour = Column(DateTime, primary_key=True)
+    metric = Column(String(20), primary_key=True)  # latency: 回复总耗时；ttft: 首个回复token耗时
+    bucket = Column(Integer, primary_key=True)  # timing.DEFAULT_BUCKETS_MS 的下标，末位为+Inf
+    count = Column(Integer, default=0, nullable=False)
+
+class StatsState(Base):
+    """
+    后台任务的键值状态，例如统计回填的水位线、推荐问题预计算的运行租约
+    """
+    __tablename__ = "stats_state"
+    key = Column(String(50), primary_key=True)
+    value = Column(Integer, nullable=False)
+
+class SuggestedQuestion(Base):
+    """
+    从聊天记录中挖掘的热门问题及预先生成的回答
+    知识库版本变化或回答过期后清空回答，由后台任务在低峰期重新生成
+    """
+    __tablename__ = "suggested_questions"
+    question_hash = Column(String(64), primary_key=True)
+    question = Column(Text, nullable=False)
+    score = Column(Integer, default=0, nullable=False)
+    asks = Column(Integer, default=0, nullable=False)
+    recent_asks = Column(Integer, default=0, nullable=False)
+    reasoning_effort = Column(String(16))
+    thinking_content = Column(Text)
+    response_content = Column(Text)
+    kb_version = Column(String(64))
+    answered_at = Column(DateTime)
+    hits = Column(Integer, default=0, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+def _rebuild_chat_messages(cursor):
+    """
+    按SQLite官方流程重建chat_messages表以加上 ON DELETE CASCADE：
+    建新表、复制数据、删旧表、改名、重建索引（调用方负责关闭外键检查和事务）
+    """
+    table = ChatMessage.__table__
+    ddl = str(CreateTable(table).compile(dialect=engine.dialect)).strip()
+    columns = ", ".join(column.name for column in table.columns)
+    cursor.execute(ddl.replace("CREATE TABLE chat_messages", "CREATE TABLE chat_messages_new", 1))
+    cursor.execute(f"INSERT INTO chat_messages_new ({columns}) SELECT {columns} FROM chat_messages")
+    cursor.execute("DROP TABLE chat_messages")
+    cursor.execute("ALTER TABLE chat_messages_new RENAME TO chat_messages")
+    for index in table.indexes:
+        columns = ", ".join(column.name for column in index.columns)
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {index.name} ON chat_messages ({columns})")
+    if cursor.execute("PRAGMA foreign_key_check").fetchall():
+        logger.warning("chat_messages中存在引用已删除会话的消息，将由后台清理任务处理")
+
+def migrate_schema():
+    """
+    create_all 不会修改已有的表，这里补齐旧库缺少的列、索引和级联外键（仅SQLite）
+    在 BEGIN IMMEDIATE 事务中检查和修改，多个worker同时启动时只有一个会执行
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        # 外键开关只能在事务外修改，重建表期间关闭以免删除旧表时级联删除其他表的数据
+        cursor.execute("PRAGMA foreign_keys=OFF")
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            columns = {row[1] for row in cursor.execute("PRAGMA table_info(chat_sessions)")}
+            if "deleted_at" not in columns:
+                logger.info("为chat_sessions添加deleted_at列")
+                cursor.execute("ALTER TABLE chat_sessions ADD COLUMN deleted_at DATETIME")
+            cursor.execute("CREATE INDEX IF NOT EXISTS ix_chat_sessions_deleted_at ON chat_sessions (deleted_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS ix_chat_messages_session_id ON chat_messages (session_id)")
+
+            foreign_keys = cursor.execute("PRAGMA foreign_key_list(chat_messages)").fetchall()
+            # 列顺序: id, seq, table, from, to, on_update, on_delete, match
+            if any(row[2] == "chat_sessions" and row[6] != "CASCADE" for row in foreign_keys):
+                logger.info("重建chat_messages表以启用 ON DELETE CASCADE")
+                _rebuild_chat_messages(cursor)
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        finally:
+            cursor.execute("PRAGMA foreign_keys=ON")
+            cursor.close()
+    finally:
+        raw.close()
 
 # 增强表创建的健壮性
 def create_tables():
     try:
         Base.metadata.create_all(bind=engine)
+        migrate_schema()
         logger.info("数据库表创建成功")
         return True
     except Exception as e:
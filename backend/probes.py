@@ -0,0 +1,206 @@
+# backend/probes.py
+"""
+RAGFlow上游后台探测
+
+所有worker都运行探测任务，通过 stats_state 中的租约保证每轮只有一个worker访问上游，
+探测结果写入 stats_state，其余worker读取共享结果，就绪探针只读取本地缓存的状态。
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, Optional
+
+from .crud import claim_lease
+from .models import SessionLocal, StatsState
+
+logger = logging.getLogger(__name__)
+
+PROBE_INTERVAL = float(os.getenv("HEALTH_PROBE_INTERVAL", "30"))
+PROBE_RETRY_INTERVAL = float(os.getenv("HEALTH_PROBE_RETRY_INTERVAL", "5"))
+PROBE_TIMEOUT = float(os.getenv("HEALTH_PROBE_TIMEOUT", "10"))
+PROBE_LEASE_KEY = "rag_probe_until"
+# 共享的探测结果在 stats_state 中的键（整数：时间戳为秒，耗时为毫秒）
+SHARED_KEYS = {
+    "last_check": "rag_probe_checked_at",
+    "last_success": "rag_probe_success_at",
+    "latency_ms": "rag_probe_latency_ms",
+    "consecutive_failures": "rag_probe_failures",
+}
+
+
+class UpstreamProber:
+    """
+    RAGFlow上游后台探测器
+    worker启动时不再同步预热，而是在后台任务里完成首次探测并周期性复查，
+    就绪探针只读取缓存的探测结果，不会在请求路径上访问上游
+    状态：starting（尚无探测结果或结果已过期）、healthy、unhealthy、not_configured（未配置RAGFlow，不探测）
+    """
+
+    def __init__(self, rag, interval: float = PROBE_INTERVAL,
+                 retry_interval: float = PROBE_RETRY_INTERVAL, timeout: float = PROBE_TIMEOUT):
+        """
+        :param rag: RagflowClient实例
+        :param interval: 上游健康时的探测间隔（秒）
+        :param retry_interval: 上游异常或尚未就绪时的探测间隔（秒）
+        :param timeout: 单次探测超时（秒）
+        """
+        self.rag = rag
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+        # 超过这个时长没有新的探测结果，视为结果已过期
+        self.stale_after = interval * 2 + timeout
+        self.started_at = time.time()
+        self.state = "starting" if rag.is_initialized else "not_configured"
+        self.last_check: Optional[float] = None
+        self.last_success: Optional[float] = None
+        self.latency_ms: Optional[float] = None
+        self.consecutive_failures = 0
+        self.probed_here = 0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "healthy"
+
+    def _apply(self, last_check: Optional[float], last_success: Optional[float],
+               latency_ms: Optional[float], consecutive_failures: int):
+        """
+        更新本地缓存的探测结果，并据此推导状态
+        """
+        self.last_check = last_check
+        self.last_success = last_success
+        self.latency_ms = latency_ms
+        self.consecutive_failures = consecutive_failures
+        previous = self.state
+        if last_check is None or time.time() - last_check > self.stale_after:
+            # 没有结果，或共享结果已过期（探测的worker停止了，或是上次运行留下的），按尚未探测处理
+            self.state = "starting"
+        elif consecutive_failures == 0 and last_success is not None:
+            self.state = "healthy"
+        else:
+            self.state = "unhealthy"
+        if self.state != previous:
+            logger.info(f"RAGFlow上游状态变化: {previous} -> {self.state}，耗时: {self.latency_ms}ms")
+
+    async def probe(self) -> bool:
+        """
+        执行一次探测并更新本地缓存的状态
+        绕过RagflowClient的健康缓存：缓存TTL比探测间隔长，复用缓存会让上游故障晚一轮以上才被发现
+        :return: 上游是否健康
+        """
+        start = time.perf_counter()
+        try:
+            healthy = await asyncio.wait_for(self.rag.health_check(timeout=self.timeout, force=True),
+                                             self.timeout + 1)
+        except asyncio.TimeoutError:
+            healthy = False
+        now = time.time()
+        self._apply(now, now if healthy else self.last_success,
+                    round((time.perf_counter() - start) * 1000.0, 2),
+                    0 if healthy else self.consecutive_failures + 1)
+        self.probed_here += 1
+        return healthy
+
+    def _claim(self, hold_seconds: float) -> bool:
+        db = SessionLocal()
+        try:
+            return claim_lease(db, PROBE_LEASE_KEY, hold_seconds)
+        finally:
+            db.close()
+
+    def _publish(self):
+        """
+        探测结果写入 stats_state，供其他worker读取
+        """
+        values = {
+            "last_check": self.last_check,
+            "last_success": self.last_success,
+            "latency_ms": self.latency_ms,
+            "consecutive_failures": self.consecutive_failures,
+        }
+        db = SessionLocal()
+        try:
+            for name, key in SHARED_KEYS.items():
+                if values[name] is not None:
+                    db.merge(StatsState(key=key, value=int(values[name])))
+            db.commit()
+        finally:
+            db.close()
+
+    def _load(self):
+        """
+        读取其他worker写入的探测结果
+        """
+        db = SessionLocal()
+        try:
+            rows = {row.key: row.value for row in
+                    db.query(StatsState).filter(StatsState.key.in_(SHARED_KEYS.values()))}
+        finally:
+            db.close()
+        shared = {name: rows.get(key) for name, key in SHARED_KEYS.items()}
+        self._apply(shared["last_check"], shared["last_success"], shared["latency_ms"],
+                    shared["consecutive_failures"] or 0)
+
+    async def run_once(self) -> bool:
+        """
+        执行一轮：抢到租约时探测上游并共享结果，否则读取共享结果
+        租约时长与下一轮间隔一致，各worker的轮次错开时每个间隔内最多探测一次
+        :return: 上游是否健康
+        """
+        hold = (self.interval if self.ready else self.retry_interval) * 0.9
+        if await asyncio.to_thread(self._claim, hold):
+            await self.probe()
+            await asyncio.to_thread(self._publish)
+        else:
+            await asyncio.to_thread(self._load)
+        return self.ready
+
+    async def _run(self):
+        while True:
+            try:
+                healthy = await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"RAGFlow上游探测异常: {e}", exc_info=True)
+                healthy = False
+            await asyncio.sleep(self.interval if healthy else self.retry_interval)
+
+    def start(self):
+        """
+        在当前事件循环中启动后台探测任务（立即返回），未配置RAGFlow时不启动
+        """
+        if self.state == "not_configured":
+            logger.warning("RAG客户端未初始化，跳过上游探测")
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        停止后台探测任务
+        """
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        当前缓存的探测结果
+        """
+        return {
+            "state": self.state,
+            "configured": self.rag.is_initialized,
+            "last_check": self.last_check,
+            "last_success": self.last_success,
+            "latency_ms": self.latency_ms,
+            "consecutive_failures": self.consecutive_failures,
+            "probed_here": self.probed_here,
+            "uptime_s": round(time.time() - self.started_at, 1),
+        }
@@ -0,0 +1,426 @@
+# backend/profiling.py
+import asyncio
+import contextvars
+import hmac
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+
+from .logging_setup import request_id_var
+from .metrics import EVENT_LOOP_LAG
+from .timing import RequestTimer
+
+logger = logging.getLogger(__name__)
+
+# 管理接口令牌（请求头 X-Admin-Token），未设置时 /admin 接口一律返回404
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+# 单次采样的最长时间（秒）和最小采样间隔（毫秒）
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_MIN_INTERVAL_MS = 1.0
+# 事件循环被阻塞超过这么多毫秒时记录调用栈，0表示不监控（可通过管理接口在单个worker上临时开启）
+LOOP_LAG_MS = float(os.getenv("LOOP_LAG_MS", "0"))
+# 慢请求阈值（毫秒），0表示不采集：/history 按总耗时，/chat 按收到第一个回答token的时间（没有回答时按总耗时）
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))
+SLOW_CHAT_MS = float(os.getenv("SLOW_CHAT_MS", "0"))
+# 慢请求采集的路径前缀
+SLOW_REQUEST_PATHS = ("/chat", "/history")
+# 内存中保留的最近阻塞事件/慢请求数
+PROFILE_KEEP = 50
+# 单个请求时间线最多记录的SQL语句数
+TRACE_MAX_QUERIES = 200
+
+# 采样时视为空闲等待的栈顶函数（文件名, 函数名），默认不计入结果
+IDLE_LEAVES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+    ("thread.py", "_worker"),
+}
+
+
+def check_admin_token(token: Optional[str]) -> bool:
+    """
+    校验管理令牌（常量时间比较）
+    :param token: 请求头中的令牌
+    """
+    if not ADMIN_TOKEN or not token:
+        return False
+    return hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    parts = code.co_filename.replace("\\", "/").rsplit("/", 2)
+    filename = "/".join(parts[-2:])
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({filename}:{code.co_firstlineno})".replace(";", ":")
+
+
+class ProfilerBusy(Exception):
+    """当前worker上已有采样在进行"""
+
+
+class SamplingProfiler:
+    """
+    基于 sys._current_frames() 的采样分析器：在独立线程中按固定间隔抓取所有线程的调用栈，
+    输出 flamegraph.pl / speedscope 可直接读取的折叠栈格式（"线程;外层;...;内层 次数"）
+    不采样时没有任何开销；采样时只占用调用方所在的线程
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.last_run: Optional[Dict[str, Any]] = None
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def run(self, seconds: float, interval_ms: float = 10.0, include_idle: bool = False) -> Tuple[str, Dict[str, Any]]:
+        """
+        阻塞采样指定时间，需在线程中调用（例如 asyncio.to_thread）
+        :param seconds: 采样时长（秒），不超过 PROFILE_MAX_SECONDS
+        :param interval_ms: 采样间隔（毫秒）
+        :param include_idle: 是否包含空闲等待（select、锁等待等）的栈
+        :return: (折叠栈文本, 采样概况)
+        """
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusy()
+        try:
+            seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+            interval = max(interval_ms, PROFILE_MIN_INTERVAL_MS) / 1000.0
+            me = threading.get_ident()
+            names: Dict[int, str] = {}
+            stacks: Counter = Counter()
+            samples = 0
+            started = time.perf_counter()
+            deadline = started + seconds
+            while time.perf_counter() < deadline:
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    if not include_idle and (frame.f_code.co_filename.rsplit("/", 1)[-1], frame.f_code.co_name) in IDLE_LEAVES:
+                        continue
+                    name = names.get(ident)
+                    if name is None:
+                        names.update((thread.ident, thread.name) for thread in threading.enumerate())
+                        name = names.get(ident, str(ident))
+                    labels = []
+                    while frame is not None:
+                        labels.append(_frame_label(frame))
+                        frame = frame.f_back
+                    labels.append(f"thread:{name}")
+                    stacks[";".join(reversed(labels))] += 1
+                samples += 1
+                time.sleep(interval)
+            self.last_run = {
+                "pid": os.getpid(),
+                "finished_at": time.time(),
+                "duration_s": round(time.perf_counter() - started, 2),
+                "samples": samples,
+                "stacks": len(stacks),
+            }
+            collapsed = "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+            return collapsed + "\n", self.last_run
+        finally:
+            self._lock.release()
+
+
+class LoopLagMonitor:
+    """
+    事件循环阻塞监控：事件循环中的心跳回调记录实际延迟，
+    看门狗线程发现心跳超过阈值未执行时抓取事件循环线程当前的调用栈并写日志，
+    可以定位在协程中直接执行的同步调用（例如 chat_sse 中的数据库读写）
+    """
+
+    def __init__(self, threshold_ms: float = LOOP_LAG_MS):
+        """
+        :param threshold_ms: 阻塞阈值（毫秒）
+        """
+        self.threshold_ms = threshold_ms
+        self.events: Deque[Dict[str, Any]] = deque(maxlen=PROFILE_KEEP)
+        self.max_lag_ms = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._expected = 0.0
+        self._blocked: Optional[Dict[str, Any]] = None
+
+    @property
+    def running(self) -> bool:
+        return self._handle is not None
+
+    def start(self, threshold_ms: Optional[float] = None):
+        """
+        在当前事件循环上开始监控（需在事件循环线程中调用）
+        :param threshold_ms: 新的阻塞阈值（毫秒），不传时沿用当前值
+        """
+        if threshold_ms is not None:
+            self.threshold_ms = threshold_ms
+        if self.threshold_ms <= 0 or self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        # 每次开启使用新的停止事件，快速关闭再开启时旧的看门狗线程也能退出
+        self._stop = threading.Event()
+        self._schedule(time.monotonic())
+        self._watchdog = threading.Thread(target=self._watch, args=(self._stop,), name="loop-lag-watchdog", daemon=True)
+        self._watchdog.start()
+        logger.info(f"事件循环阻塞监控已开启，阈值 {self.threshold_ms:.0f} ms")
+
+    def stop(self):
+        """
+        停止监控
+        """
+        if not self.running:
+            return
+        self._handle.cancel()
+        self._handle = None
+        self._stop.set()
+        logger.info("事件循环阻塞监控已关闭")
+
+    def _interval(self) -> float:
+        # 心跳间隔取阈值的一半（最多100ms），阻塞刚超过阈值时也能被发现
+        return min(self.threshold_ms / 2000.0, 0.1)
+
+    def _schedule(self, now: float):
+        interval = self._interval()
+        self._expected = now + interval
+        self._handle = self._loop.call_later(interval, self._beat)
+
+    def _beat(self):
+        now = time.monotonic()
+        lag = max(0.0, now - self._expected)
+        EVENT_LOOP_LAG.observe(lag)
+        lag_ms = lag * 1000.0
+        self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+        blocked, self._blocked = self._blocked, None
+        if blocked is not None:
+            blocked["lag_ms"] = round(lag_ms, 1)
+            logger.warning(f"事件循环阻塞结束，共 {lag_ms:.0f} ms")
+        if self._handle is not None:
+            self._schedule(now)
+
+    def _watch(self, stop: threading.Event):
+        check = max(self._interval() / 2, 0.005)
+        while not stop.wait(check):
+            late_ms = (time.monotonic() - self._expected) * 1000.0
+            if late_ms < self.threshold_ms or self._blocked is not None:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame, limit=30)) if frame is not None else ""
+            blocked = {
+                "at": time.time(),
+                "pid": os.getpid(),
+                "lag_ms": round(late_ms, 1),
+                "stack": stack,
+            }
+            self._blocked = blocked
+            self.events.append(blocked)
+            logger.warning(f"事件循环已阻塞 {late_ms:.0f} ms（阈值 {self.threshold_ms:.0f} ms），当前调用栈:\n{stack}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "threshold_ms": self.threshold_ms,
+            "max_lag_ms": round(self.max_lag_ms, 1),
+            "events": list(self.events),
+        }
+
+
+# 当前请求的时间线，只在开启慢请求采集时由中间件设置
+current_trace: contextvars.ContextVar[Optional["RequestTrace"]] = contextvars.ContextVar("request_trace", default=None)
+
+
+class RequestTrace:
+    """
+    单个请求的时间线：中间件记录响应开始/首字节/结束，数据库钩子记录每条SQL，
+    聊天接口关联的 RequestTimer 提供排队、上游和持久化等阶段
+    """
+    __slots__ = ("method", "path", "start", "events", "queries", "timer", "status")
+
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.start = time.perf_counter()
+        self.events: List[Tuple[float, str, Dict[str, Any]]] = []
+        self.queries = 0
+        self.timer: Optional[RequestTimer] = None
+        self.status: Optional[int] = None
+
+    def add(self, name: str, at: Optional[float] = None, **fields):
+        self.events.append((at if at is not None else time.perf_counter(), name, fields))
+
+    def add_query(self, statement: str, started: float, finished: float):
+        self.queries += 1
+        if self.queries > TRACE_MAX_QUERIES:
+            return
+        self.add("sql", started, statement=" ".join(statement.split())[:200],
+                 duration_ms=round((finished - started) * 1000.0, 2))
+
+    def _offset(self, at: float) -> float:
+        return round((at - self.start) * 1000.0, 2)
+
+    def duration_ms(self) -> float:
+        end = max((at for at, name, _ in self.events if name == "end"), default=time.perf_counter())
+        return self._offset(end)
+
+    def ttft_ms(self) -> Optional[float]:
+        """
+        从请求开始到第一个回答token的时间（毫秒），非聊天请求为None
+        """
+        if self.timer is None or "first_content" not in self.timer.marks:
+            return None
+        return self._offset(self.timer.marks["first_content"])
+
+    def to_dict(self) -> Dict[str, Any]:
+        events = list(self.events)
+        if self.timer is not None:
+            events.extend((at, f"chat:{name}", {}) for name, at in self.timer.marks.items())
+        events.sort(key=lambda item: item[0])
+        record = {
+            "at": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+            "request_id": request_id_var.get(),
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "duration_ms": self.duration_ms(),
+            "ttft_ms": self.ttft_ms(),
+            "queries": self.queries,
+            "query_ms": round(sum(fields.get("duration_ms", 0) for _, name, fields in self.events if name == "sql"), 2),
+            "timeline": [{"t_ms": self._offset(at), "event": name, **fields} for at, name, fields in events],
+        }
+        if self.timer is not None:
+            record["reasoning_effort"] = self.timer.reasoning_effort
+            record["phases_ms"] = self.timer.phases()
+        return record
+
+
+class SlowRequestRecorder:
+    """
+    超过阈值的 /chat、/history 请求记录完整时间线（写WARNING日志并保留最近的记录）
+    两个阈值都为0时不挂载中间件和数据库钩子，没有任何额外开销
+    """
+
+    def __init__(self, request_ms: float = SLOW_REQUEST_MS, chat_ms: float = SLOW_CHAT_MS):
+        self.request_ms = request_ms
+        self.chat_ms = chat_ms
+        self.records: Deque[Dict[str, Any]] = deque(maxlen=PROFILE_KEEP)
+
+    @property
+    def enabled(self) -> bool:
+        return self.request_ms > 0 or self.chat_ms > 0
+
+    def _threshold(self, path: str) -> float:
+        return self.chat_ms if path.startswith("/chat") else self.request_ms
+
+    def finish(self, trace: RequestTrace):
+        """
+        请求结束时判断是否超过阈值
+        :param trace: 已结束的请求时间线
+        """
+        threshold = self._threshold(trace.path)
+        if threshold <= 0:
+            return
+        elapsed = trace.ttft_ms()
+        if elapsed is None:
+            elapsed = trace.duration_ms()
+        if elapsed < threshold:
+            return
+        record = trace.to_dict()
+        self.records.append(record)
+        logger.warning(f"慢请求 {trace.method} {trace.path} {elapsed:.0f} ms（阈值 {threshold:.0f} ms）: "
+                       f"{json.dumps(record, ensure_ascii=False)}")
+
+    def snapshot(self, limit: int = PROFILE_KEEP) -> Dict[str, Any]:
+        return {
+            "request_ms": self.request_ms,
+            "chat_ms": self.chat_ms,
+            "records": list(self.records)[-limit:][::-1],
+        }
+
+
+def attach_timer(timer: RequestTimer):
+    """
+    把聊天请求的阶段计时器关联到当前请求的时间线（未采集时什么也不做）
+    :param timer: 聊天请求计时器
+    """
+    trace = current_trace.get()
+    if trace is not None:
+        trace.timer = timer
+
+
+def trace_engine(engine):
+    """
+    为SQLAlchemy引擎挂载时间线钩子：正在采集的请求中执行的每条SQL计入时间线
+    :param engine: SQLAlchemy引擎
+    """
+    # 与 metrics.instrument_engine 相同，开始时间保存在执行上下文上，失败的语句不会留下残留
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None and current_trace.get() is not None:
+            context._trace_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_execute(conn, cursor, statement, parameters, context, executemany):
+        trace = current_trace.get()
+        started = getattr(context, "_trace_start", None)
+        if trace is not None and started is not None:
+            trace.add_query(statement or "", started, time.perf_counter())
+
+
+class SlowRequestMiddleware:
+    """
+    纯ASGI中间件：为 /chat、/history 请求建立时间线，结束后交给 SlowRequestRecorder 判断
+    记录的路径不含查询参数（聊天内容在查询参数中）
+    """
+
+    def __init__(self, app, recorder: "SlowRequestRecorder", prefixes=SLOW_REQUEST_PATHS):
+        self.app = app
+        self.recorder = recorder
+        self.prefixes = prefixes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope.get("path", "").startswith(self.prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        trace = RequestTrace(scope.get("method", "GET"), scope["path"])
+        token = current_trace.set(trace)
+        first_body = True
+
+        async def send_wrapper(message):
+            nonlocal first_body
+            if message["type"] == "http.response.start":
+                trace.status = message["status"]
+                trace.add("response_start")
+            elif message["type"] == "http.response.body" and first_body and message.get("body"):
+                first_body = False
+                trace.add("first_byte")
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            trace.add("end")
+            current_trace.reset(token)
+            try:
+                self.recorder.finish(trace)
+            except Exception as e:
+                logger.error(f"记录慢请求失败: {e}")
+
+
+profiler = SamplingProfiler()
+loop_lag_monitor = LoopLagMonitor()
+slow_requests = SlowRequestRecorder()
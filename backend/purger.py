@@ -0,0 +1,195 @@
+# backend/purger.py
+"""
+已软删除会话的后台清理
+
+删除接口只设置 chat_sessions.deleted_at，界面立即响应；本模块的后台任务周期性地
+分批物理删除过了保留期的会话和消息，批次之间让出事件循环和数据库写锁，
+清理后用 incremental_vacuum 归还空闲页。多个worker都运行该任务，通过 stats_state 中的租约
+保证每轮只有一个worker执行，一轮在租约到期前结束，剩余数据留给下一轮。
+
+已有数据库需要执行一次（会整库重写，请在低峰期执行）才能启用增量回收：
+    python -m backend.purger vacuum
+
+立即清理全部已软删除的数据：
+    python -m backend.purger purge
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from .crud import DELETE_BATCH_PAUSE, DELETE_BATCH_SIZE, claim_lease, purge_deleted_batch
+from .models import SessionLocal, engine
+
+logger = logging.getLogger(__name__)
+
+PURGE_ENABLED = os.getenv("PURGE_ENABLED", "1") == "1"
+PURGE_INTERVAL = float(os.getenv("PURGE_INTERVAL", "60"))
+# 软删除后保留的秒数，期间可以从数据库中手工恢复
+PURGE_GRACE_SECONDS = float(os.getenv("PURGE_GRACE_SECONDS", "300"))
+# 每轮清理后最多归还的空闲页数
+VACUUM_PAGES = int(os.getenv("VACUUM_PAGES", "2000"))
+RUN_LEASE_KEY = "purge_run_until"
+
+
+def incremental_vacuum(pages: int = VACUUM_PAGES) -> Optional[int]:
+    """
+    归还最多 pages 个空闲页给文件系统
+    :return: 归还的页数；数据库未启用 auto_vacuum=INCREMENTAL 或不是SQLite时为None
+    """
+    if engine.dialect.name != "sqlite":
+        return None
+    raw = engine.raw_connection()
+    try:
+        sqlite_conn = raw.driver_connection
+        if sqlite_conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return None
+        before = sqlite_conn.execute("PRAGMA freelist_count").fetchone()[0]
+        # execute() 只执行一步（归还一页），executescript() 才会执行完毕
+        sqlite_conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        return before - sqlite_conn.execute("PRAGMA freelist_count").fetchone()[0]
+    finally:
+        raw.close()
+
+
+def enable_incremental_vacuum():
+    """
+    为已有数据库启用 auto_vacuum=INCREMENTAL（需要一次完整 VACUUM）
+    """
+    with engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.exec_driver_sql("VACUUM")
+        return conn.exec_driver_sql("PRAGMA auto_vacuum").scalar()
+
+
+class DeletedSessionPurger:
+    """
+    后台分批物理删除已软删除的会话
+    """
+
+    def __init__(self, interval: float = PURGE_INTERVAL, grace_seconds: float = PURGE_GRACE_SECONDS,
+                 batch_size: int = DELETE_BATCH_SIZE, pause: float = DELETE_BATCH_PAUSE):
+        """
+        :param interval: 两轮清理之间的间隔（秒）
+        :param grace_seconds: 软删除后保留的秒数
+        :param batch_size: 每批删除的行数
+        :param pause: 批次之间的间隔（秒）
+        """
+        self.interval = interval
+        self.grace_seconds = grace_seconds
+        self.batch_size = batch_size
+        self.pause = pause
+        self.last_run: Optional[float] = None
+        self.purged_sessions = 0
+        self.purged_messages = 0
+        self.reclaimed_pages = 0
+        self._vacuum_warned = False
+        self._task: Optional[asyncio.Task] = None
+
+    def _claim(self, hold_seconds: float) -> bool:
+        db = SessionLocal()
+        try:
+            return claim_lease(db, RUN_LEASE_KEY, hold_seconds)
+        finally:
+            db.close()
+
+    def _purge_batch(self, deleted_before: datetime):
+        db = SessionLocal()
+        try:
+            return purge_deleted_batch(db, deleted_before, self.batch_size)
+        finally:
+            db.close()
+
+    async def purge(self, force: bool = False) -> Dict[str, int]:
+        """
+        执行一轮清理：分批删除直到没有过期的数据，然后增量回收空闲页
+        :param force: 忽略租约，删除全部过期数据（命令行手动执行）
+        :return: 本轮删除的会话数、消息数和归还的页数；其他worker正在执行本轮时全为0
+        """
+        result = {"sessions": 0, "messages": 0, "pages": 0}
+        hold = self.interval * 0.9
+        if not force and not await asyncio.to_thread(self._claim, hold):
+            return result
+        # 在租约到期前停止删除，避免与下一轮抢到租约的worker同时执行
+        deadline = None if force else time.monotonic() + hold
+        deleted_before = datetime.utcnow() - timedelta(seconds=self.grace_seconds)
+        while deadline is None or time.monotonic() < deadline:
+            sessions, messages = await asyncio.to_thread(self._purge_batch, deleted_before)
+            if not sessions and not messages:
+                break
+            result["sessions"] += sessions
+            result["messages"] += messages
+            await asyncio.sleep(self.pause)
+
+        if result["sessions"] or result["messages"]:
+            pages = await asyncio.to_thread(incremental_vacuum)
+            if pages is None and not self._vacuum_warned:
+                self._vacuum_warned = True
+                logger.warning("数据库未启用 auto_vacuum=INCREMENTAL，删除后的空间不会归还，"
+                               "可执行 python -m backend.purger vacuum 启用")
+            result["pages"] = pages or 0
+            logger.info(f"清理已删除会话: {result['sessions']} 个会话、{result['messages']} 条消息，"
+                        f"归还 {result['pages']} 页")
+
+        self.last_run = time.time()
+        self.purged_sessions += result["sessions"]
+        self.purged_messages += result["messages"]
+        self.reclaimed_pages += result["pages"]
+        return result
+
+    async def _run(self):
+        while True:
+            try:
+                await self.purge()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"清理已删除会话异常: {e}", exc_info=True)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """
+        在当前事件循环中启动后台清理任务（立即返回）
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        停止后台清理任务，进行中的批次在提交后结束
+        """
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "last_run": self.last_run,
+            "purged_sessions": self.purged_sessions,
+            "purged_messages": self.purged_messages,
+            "reclaimed_pages": self.reclaimed_pages,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="已删除会话清理")
+    parser.add_argument("command", choices=["purge", "vacuum"],
+                        help="purge: 立即清理全部已软删除的数据；vacuum: 为已有数据库启用增量回收")
+    args = parser.parse_args()
+    if args.command == "purge":
+        result = asyncio.run(DeletedSessionPurger(grace_seconds=0).purge(force=True))
+        print(f"已清理 {result['sessions']} 个会话、{result['messages']} 条消息，归还 {result['pages']} 页")
+    else:
+        mode = enable_incremental_vacuum()
+        print("已启用增量回收" if mode == 2 else f"启用失败，auto_vacuum={mode}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,15 @@
 # backend/rag_client.py
 import asyncio
+import hashlib
 import httpx
 import logging
 from openai import OpenAI, AsyncOpenAI
 import os
 from typing import Optional, List, Dict, Any, Generator, AsyncGenerator
 import time
+from .timing import RequestTimer
+from .metrics import record_cache
+from .logging_setup import log_sampler
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +27,7 @@ class RagflowClient:
         self.chat_id = os.getenv("RAGFLOW_CHAT_ID")
         base = os.getenv("RAGFLOW_BASE_URL")
         self.base_url = f"{base}/api/v1/chats_openai/{self.chat_id}" if base and self.chat_id else None
+        self.api_root = f"{base.rstrip('/')}/api/v1" if base else None
         self.client = None
         self.async_client = None
         self.is_initialized = False
@@ -72,6 +77,17 @@ class RagflowClient:
             self.async_client = None
             self.is_initialized = False
 
+    def reset_after_fork(self):
+        """
+        fork后重建客户端
+        从父进程继承的httpx连接池与父进程共用socket，不能关闭（会断开父进程的连接），直接丢弃后重新创建
+        """
+        self.client = None
+        self.async_client = None
+        self.is_initialized = False
+        self._health_status = {"last_check": 0, "healthy": False, "ttl": 60}
+        self._initialize_client()
+
     def chat(self, message: str, stream: bool = True, reasoning_effort: Optional[str] = "low"):
         """
         同步聊天方法
@@ -113,11 +129,13 @@ class RagflowClient:
             logger.error(f"RAGFlow聊天请求失败: {str(e)}")
             raise
 
-    async def async_chat(self, messages: List[Dict[str, str]], reasoning_effort: str = "low") -> AsyncGenerator[Dict[str, Any], None]:
+    async def async_chat(self, messages: List[Dict[str, str]], reasoning_effort: str = "low",
+                         timer: Optional[RequestTimer] = None) -> AsyncGenerator[Dict[str, Any], None]:
         """
         异步聊天方法，支持流式输出思考内容和分阶段思考过程
         :param messages: 消息列表
         :param reasoning_effort: 推理努力程度 ("low", "medium", "high")
+        :param timer: 可选的请求计时器，记录上游请求、首token和流结束时间点
         """
         # 如果客户端初始化失败或配置不完整，使用Mock响应
         if not self.async_client or not self.is_initialized:
@@ -147,6 +165,11 @@ class RagflowClient:
         for attempt in range(self._retry_count):
             try:
                 logger.debug(f"发起RAGFlow请求，消息数量: {len(messages)}, 尝试: {attempt + 1}")
+                if timer:
+                    timer.attempts = attempt + 1
+                    # 首个chunk/token只记第一次出现，起点也只记第一次尝试，
+                    # 重试时ttfb/ttft包含失败尝试的耗时（即用户实际等待的时间），不会出现负值
+                    timer.mark_first("upstream_start")
 
                 stream = await self.async_client.chat.completions.create(
                     model="ragflow",
@@ -156,13 +179,16 @@ class RagflowClient:
                     timeout=300,  # 超时时间到3000秒
                     temperature=0.7,
                     reasoning_effort=reasoning_effort,  # 使用传入的参数
-                    stream_options={"include_usage": False}
+                    stream_options={"include_usage": True}  # 最后一个chunk携带token用量
                 )
 
                 assistant_content = ""
                 thinking_content = ""
                 chunk_count = 0
+                thinking_chunks = 0
+                content_chunks = 0
                 first_chunk_time = None
+                usage = None
 
                 async for chunk in stream:
                     chunk_count += 1
@@ -170,36 +196,52 @@ class RagflowClient:
                     # 记录第一个chunk的时间
                     if chunk_count == 1 and first_chunk_time is None:
                         first_chunk_time = asyncio.get_event_loop().time()
+                        if timer:
+                            timer.mark_first("first_chunk")
 
-                    # 减少日志输出频率，只记录关键节点
-                    if chunk_count == 1 or chunk_count == 2 or (chunk_count % 100 == 0):
+                    # 减少日志输出频率，只记录关键节点，并按全局速率采样
+                    if (chunk_count == 1 or chunk_count % 100 == 0) and logger.isEnabledFor(logging.DEBUG) \
+                            and log_sampler.allow("rag_chunk"):
                         logger.debug(f"RAGFlow chunk: {chunk_count}")
 
+                    if getattr(chunk, "usage", None):
+                        usage = chunk.usage
+
                     if chunk.choices and len(chunk.choices) > 0:
                         delta = chunk.choices[0].delta
 
                         # 处理思考内容
                         if hasattr(delta, 'reasoning_content') and delta.reasoning_content:
                             thinking_text = delta.reasoning_content
+                            if timer and not thinking_content:
+                                timer.mark_first("first_thinking")
                             thinking_content += thinking_text
+                            thinking_chunks += 1
                             # 发送思考内容
                             yield {"type": "thinking", "content": thinking_text}
 
                         # 处理正式回复内容
                         if hasattr(delta, 'content') and delta.content:
                             content_text = delta.content
+                            if timer and not assistant_content:
+                                timer.mark_first("first_content")
                             assistant_content += content_text
+                            content_chunks += 1
                             # 发送正式回复内容
                             yield {"type": "content", "content": content_text}
 
+                if timer:
+                    timer.mark("last_chunk")
+                    timer.chunks = chunk_count
                 total_time = (asyncio.get_event_loop().time() - first_chunk_time) if first_chunk_time else 0
                 logger.info(f"RAGFlow响应完成，chunk数: {chunk_count}，耗时: {total_time:.2f}秒")
 
-                # 发送完成消息，包含完整的思考内容和回复内容
+                # 发送完成消息，包含完整的思考内容、回复内容和token用量
                 yield {
                     "type": "complete",
                     "thinking_content": thinking_content,
-                    "response_content": assistant_content
+                    "response_content": assistant_content,
+                    "usage": self._usage_dict(usage, thinking_chunks, content_chunks)
                 }
                 return
 
@@ -234,50 +276,96 @@ class RagflowClient:
                 if attempt < self._retry_count - 1:
                     await asyncio.sleep(0.5)  # 减少等待时间
 
-    async def health_check(self, timeout: int = 30) -> bool:
+    @staticmethod
+    def _usage_dict(usage, thinking_chunks: int, content_chunks: int) -> Dict[str, Any]:
+        """
+        整理token用量
+        上游未返回usage时，按流式chunk数估算（每个chunk约一个token），并标记来源为estimate
+        :param usage: 上游返回的CompletionUsage或None
+        :param thinking_chunks: 思考内容chunk数
+        :param content_chunks: 回复内容chunk数
+        """
+        if usage is not None:
+            details = getattr(usage, "completion_tokens_details", None)
+            return {
+                "prompt_tokens": usage.prompt_tokens,
+                "completion_tokens": usage.completion_tokens,
+                "reasoning_tokens": getattr(details, "reasoning_tokens", None) if details else None,
+                "source": "upstream",
+            }
+        return {
+            "prompt_tokens": None,
+            "completion_tokens": thinking_chunks + content_chunks,
+            "reasoning_tokens": thinking_chunks,
+            "source": "estimate",
+        }
+
+    async def kb_version(self, timeout: float = 10.0) -> Optional[str]:
+        """
+        知识库版本：聊天助手关联的数据集ID、更新时间、文档数和分块数的指纹，
+        上传或重新解析文档后随之变化；设置了环境变量 KB_VERSION 时直接使用该值
+        :param timeout: 请求超时（秒）
+        :return: 版本字符串，无法获取时为None
+        """
+        override = os.getenv("KB_VERSION")
+        if override:
+            return override
+        if not all([self.api_key, self.api_root, self.chat_id]):
+            return None
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        try:
+            async with httpx.AsyncClient(base_url=self.api_root, headers=headers, timeout=timeout) as client:
+                response = await client.get("/chats", params={"id": self.chat_id})
+                response.raise_for_status()
+                chats = response.json().get("data") or []
+                if not chats:
+                    return None
+                dataset_ids = chats[0].get("dataset_ids") or [d.get("id") for d in chats[0].get("datasets") or []]
+                parts = []
+                for dataset_id in sorted(filter(None, dataset_ids)):
+                    response = await client.get("/datasets", params={"id": dataset_id})
+                    response.raise_for_status()
+                    for dataset in response.json().get("data") or []:
+                        parts.append(f"{dataset_id}:{dataset.get('update_time')}:"
+                                     f"{dataset.get('document_count')}:{dataset.get('chunk_count')}")
+            return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()[:16]
+        except Exception as e:
+            logger.warning(f"获取知识库版本失败: {str(e)}")
+            return None
+
+    async def health_check(self, timeout: int = 30, force: bool = False) -> bool:
         """
         检查RAGFlow服务健康状态
+        请求轻量的聊天助手查询接口（GET /chats?id=<chat_id>），同时验证地址、API Key和聊天助手，
+        不触发模型推理；健康结果在TTL内缓存
         :param timeout: 超时时间（秒）
+        :param force: 忽略缓存的健康状态，强制探测上游
         :return: 服务是否健康
         """
         try:
             # 如果配置不完整，返回False
-            if not all([self.api_key, self.base_url, self.chat_id]):
+            if not all([self.api_key, self.api_root, self.chat_id]):
                 logger.debug("RAGFlow配置不完整，健康检查失败")
                 return False
 
             # 检查缓存的健康状态
             current_time = time.time()
-            if (current_time - self._health_status["last_check"] < self._health_status["ttl"] and
-                self._health_status["healthy"]):
-                return True
+            if not force:
+                if (current_time - self._health_status["last_check"] < self._health_status["ttl"] and
+                    self._health_status["healthy"]):
+                    record_cache("rag_health", True)
+                    return True
+                record_cache("rag_health", False)
 
-            # 如果客户端未初始化，则初始化
-            if not self.async_client:
-                self._initialize_client()
-                
-            if not self.async_client:
-                self._health_status.update({
-                    "last_check": current_time,
-                    "healthy": False
-                })
-                return False
+            headers = {"Authorization": f"Bearer {self.api_key}"}
+            async with httpx.AsyncClient(base_url=self.api_root, headers=headers, timeout=timeout) as client:
+                response = await client.get("/chats", params={"id": self.chat_id})
+                response.raise_for_status()
+                body = response.json()
+            # API Key无效或聊天助手不存在时，RAGFlow 仍返回200，通过 code 和 data 判断
+            if body.get("code") != 0 or not body.get("data"):
+                raise ValueError(f"聊天助手查询失败: {body.get('message') or body.get('code')}")
 
-            # 尝试发送一个简单的请求来检查连接
-            test_messages = [
-                {"role": "user", "content": "hi"}
-            ]
-            
-            # 使用较小的max_tokens来快速测试
-            response = await self.async_client.chat.completions.create(
-                model="ragflow",
-                messages=test_messages,
-                max_tokens=5,  # 小的token数用于快速测试
-                timeout=timeout,
-                reasoning_effort="low"
-            )
-            
-            # 如果我们收到响应，则认为服务是健康的
             self._health_status.update({
                 "last_check": current_time,
                 "healthy": True
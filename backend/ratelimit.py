@@ -0,0 +1,315 @@
+# backend/ratelimit.py
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from .metrics import FAIR_QUEUE_WAIT, RATE_LIMITED
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+# 限流状态单独存放，避免与聊天记录库争用写锁；所有gunicorn worker共享同一文件
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB", "./rate_limit.db")
+RATE_LIMIT_RATE = float(os.getenv("RATE_LIMIT_RATE", "0.2"))         # 每个客户端每秒补充的令牌
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "5"))         # 令牌桶容量
+RATE_LIMIT_MAX_STREAMS = int(os.getenv("RATE_LIMIT_MAX_STREAMS", "3"))  # 每个客户端并发流上限
+UPSTREAM_MAX_STREAMS = int(os.getenv("UPSTREAM_MAX_STREAMS", "50"))  # 全部worker合计的上游并发流上限
+FAIR_QUEUE_TIMEOUT = float(os.getenv("FAIR_QUEUE_TIMEOUT", "30"))    # 上游饱和时最长排队时间（秒）
+# 允许作为客户端标识的API令牌（逗号分隔），可写明文或 client_key 生成的 "token:<哈希前缀>"；
+# 不在列表中的令牌被忽略并按IP识别，避免每次请求换一个随机令牌绕过限流
+RATE_LIMIT_TOKENS = {item.strip() for item in os.getenv("RATE_LIMIT_TOKENS", "").split(",") if item.strip()}
+# 客户端权重，例如 {"token:1a2b3c4d5e6f7a8b": 2, "10.0.0.8": 0.5}
+RATE_LIMIT_WEIGHTS: Dict[str, float] = json.loads(os.getenv("RATE_LIMIT_WEIGHTS", "{}"))
+# 流租约最长有效期，超过后视为泄漏并回收（上游超时300秒）
+STREAM_LEASE_TTL = 330.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    client TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS streams (
+    id TEXT PRIMARY KEY,
+    client TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    started REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_streams_client ON streams (client);
+CREATE TABLE IF NOT EXISTS recent_asks (
+    client TEXT NOT NULL,
+    question TEXT NOT NULL,
+    asked REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_recent_asks_client ON recent_asks (client, question);
+CREATE INDEX IF NOT EXISTS ix_recent_asks_asked ON recent_asks (asked);
+CREATE TABLE IF NOT EXISTS waiters (
+    id TEXT PRIMARY KEY,
+    client TEXT NOT NULL,
+    weight REAL NOT NULL,
+    pid INTEGER NOT NULL,
+    enqueued REAL NOT NULL
+);
+"""
+
+
+def _token_key(token: str) -> str:
+    return "token:" + hashlib.sha256(token.encode("utf-8")).hexdigest()[:16]
+
+
+# 白名单统一保存为哈希形式
+_ALLOWED_TOKEN_KEYS = {item if item.startswith("token:") else _token_key(item) for item in RATE_LIMIT_TOKENS}
+
+
+def client_key(headers, client_host: Optional[str]) -> str:
+    """
+    识别客户端：优先使用 RATE_LIMIT_TOKENS 中配置的API令牌，其次是nginx设置的 X-Real-IP / X-Forwarded-For
+    未配置的令牌不作为标识（否则每个随机令牌都会得到独立的令牌桶）
+    令牌只保存哈希前缀，不落盘明文
+    :param headers: 请求头
+    :param client_host: 直连客户端地址
+    """
+    token = headers.get("x-api-key")
+    authorization = headers.get("authorization", "")
+    if not token and authorization.lower().startswith("bearer "):
+        token = authorization[7:].strip()
+    if token:
+        key = _token_key(token)
+        if key in _ALLOWED_TOKEN_KEYS:
+            return key
+    real_ip = headers.get("x-real-ip")
+    if real_ip:
+        return real_ip.strip()
+    forwarded = headers.get("x-forwarded-for")
+    if forwarded:
+        return forwarded.split(",")[0].strip()
+    return client_host or "unknown"
+
+
+@dataclass
+class Admission:
+    """
+    准入结果
+    allowed为False时，reason为 rate / streams / queue_timeout，retry_after为建议重试秒数
+    """
+    allowed: bool
+    reason: Optional[str] = None
+    retry_after: float = 0.0
+    lease_id: Optional[str] = None
+    waited: float = 0.0
+
+
+class ClientLimiter:
+    """
+    基于SQLite的跨worker限流器
+    - 令牌桶：限制每个客户端的请求速率
+    - 并发流：限制每个客户端同时占用的上游流
+    - 加权公平排队：上游并发达到上限时，空出的名额优先给“已占用流数/权重”最小的客户端
+    """
+
+    def __init__(self, path: str = RATE_LIMIT_DB):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        # 每个线程、每个进程（fork后）各自持有连接
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _transaction(self, func, *args):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(conn, *args)
+            conn.execute("COMMIT")
+            return result
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def weight(client: str) -> float:
+        return float(RATE_LIMIT_WEIGHTS.get(client, 1.0))
+
+    def _take_token(self, conn: sqlite3.Connection, client: str, now: float) -> float:
+        """
+        :return: 0表示允许，否则为需要等待的秒数
+        """
+        row = conn.execute("SELECT tokens, updated FROM buckets WHERE client = ?", (client,)).fetchone()
+        tokens = RATE_LIMIT_BURST if row is None else min(
+            RATE_LIMIT_BURST, row[0] + (now - row[1]) * RATE_LIMIT_RATE)
+        retry_after = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            retry_after = (1 - tokens) / RATE_LIMIT_RATE if RATE_LIMIT_RATE > 0 else 60.0
+        conn.execute("INSERT OR REPLACE INTO buckets (client, tokens, updated) VALUES (?, ?, ?)",
+                     (client, tokens, now))
+        if random.random() < 0.01:
+            # 一小时未访问的令牌桶早已回满，删除以控制表大小
+            conn.execute("DELETE FROM buckets WHERE updated < ?", (now - 3600,))
+        return retry_after
+
+    def _reap(self, conn: sqlite3.Connection, now: float):
+        """
+        回收过期租约以及已退出worker遗留的租约和排队记录
+        """
+        conn.execute("DELETE FROM streams WHERE started < ?", (now - STREAM_LEASE_TTL,))
+        conn.execute("DELETE FROM waiters WHERE enqueued < ?", (now - FAIR_QUEUE_TIMEOUT * 2,))
+        own_pid = os.getpid()
+        pids = {row[0] for row in conn.execute("SELECT DISTINCT pid FROM streams UNION SELECT DISTINCT pid FROM waiters")}
+        for pid in pids - {own_pid}:
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                conn.execute("DELETE FROM streams WHERE pid = ?", (pid,))
+                conn.execute("DELETE FROM waiters WHERE pid = ?", (pid,))
+            except PermissionError:
+                pass
+
+    def _try_acquire(self, conn: sqlite3.Connection, client: str, lease_id: str, queued: bool, now: float) -> str:
+        """
+        :return: granted / client_full / wait
+        """
+        active_for_client = conn.execute(
+            "SELECT COUNT(*) FROM streams WHERE client = ?", (client,)).fetchone()[0]
+        if active_for_client >= RATE_LIMIT_MAX_STREAMS:
+            # 先回收过期或所属进程已退出的租约，泄漏的名额不能让客户端永久被拒绝
+            self._reap(conn, now)
+            active_for_client = conn.execute(
+                "SELECT COUNT(*) FROM streams WHERE client = ?", (client,)).fetchone()[0]
+            if active_for_client >= RATE_LIMIT_MAX_STREAMS:
+                return "client_full"
+
+        total = conn.execute("SELECT COUNT(*) FROM streams").fetchone()[0]
+        if total >= UPSTREAM_MAX_STREAMS:
+            self._reap(conn, now)
+            total = conn.execute("SELECT COUNT(*) FROM streams").fetchone()[0]
+
+        if total < UPSTREAM_MAX_STREAMS:
+            # 排在最前的等待者：已占用流数/权重最小，其次是先到先得
+            head = conn.execute(
+                "SELECT w.id FROM waiters w "
+                "LEFT JOIN (SELECT client, COUNT(*) AS n FROM streams GROUP BY client) s ON s.client = w.client "
+                "ORDER BY COALESCE(s.n, 0) / w.weight, w.enqueued LIMIT 1"
+            ).fetchone()
+            if head is None or head[0] == lease_id:
+                conn.execute("INSERT INTO streams (id, client, pid, started) VALUES (?, ?, ?, ?)",
+                             (lease_id, client, os.getpid(), now))
+                if queued:
+                    conn.execute("DELETE FROM waiters WHERE id = ?", (lease_id,))
+                return "granted"
+
+        if not queued:
+            conn.execute("INSERT INTO waiters (id, client, weight, pid, enqueued) VALUES (?, ?, ?, ?, ?)",
+                         (lease_id, client, self.weight(client), os.getpid(), now))
+        return "wait"
+
+    def _record_ask(self, conn: sqlite3.Connection, client: str, question: str, window: float, now: float) -> int:
+        """
+        :return: 记录本次之前，该客户端在窗口内提出同一问题的次数
+        """
+        previous = conn.execute(
+            "SELECT COUNT(*) FROM recent_asks WHERE client = ? AND question = ? AND asked >= ?",
+            (client, question, now - window)).fetchone()[0]
+        conn.execute("INSERT INTO recent_asks (client, question, asked) VALUES (?, ?, ?)", (client, question, now))
+        if random.random() < 0.01:
+            conn.execute("DELETE FROM recent_asks WHERE asked < ?", (now - window,))
+        return previous
+
+    def _dequeue(self, conn: sqlite3.Connection, lease_id: str):
+        conn.execute("DELETE FROM waiters WHERE id = ?", (lease_id,))
+
+    def _release(self, conn: sqlite3.Connection, lease_id: str):
+        conn.execute("DELETE FROM streams WHERE id = ?", (lease_id,))
+
+    async def admit(self, client: str, upstream: bool = True) -> Admission:
+        """
+        为一次聊天流申请准入：先扣令牌，再申请并发流租约（必要时公平排队）
+        成功后必须调用 release(lease_id)
+        :param client: client_key() 的结果
+        :param upstream: 是否访问上游；回放预计算回答时为False，只扣令牌，不占并发流也不排队
+        """
+        if not RATE_LIMIT_ENABLED:
+            return Admission(True)
+        try:
+            retry_after = await asyncio.to_thread(self._transaction, self._take_token, client, time.time())
+            if retry_after:
+                RATE_LIMITED.labels("rate").inc()
+                return Admission(False, "rate", retry_after)
+            if not upstream:
+                return Admission(True)
+
+            lease_id = uuid.uuid4().hex
+            start = time.monotonic()
+            deadline = start + FAIR_QUEUE_TIMEOUT
+            queued = False
+            delay = 0.05
+            try:
+                while True:
+                    outcome = await asyncio.to_thread(
+                        self._transaction, self._try_acquire, client, lease_id, queued, time.time())
+                    if outcome == "granted":
+                        waited = time.monotonic() - start
+                        FAIR_QUEUE_WAIT.observe(waited)
+                        return Admission(True, lease_id=lease_id, waited=waited)
+                    if outcome == "client_full":
+                        RATE_LIMITED.labels("streams").inc()
+                        return Admission(False, "streams", 5.0)
+                    queued = True
+                    if time.monotonic() >= deadline:
+                        RATE_LIMITED.labels("queue_timeout").inc()
+                        return Admission(False, "queue_timeout", 10.0, waited=time.monotonic() - start)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 1.5, 0.5)
+            finally:
+                if queued:
+                    await asyncio.to_thread(self._transaction, self._dequeue, lease_id)
+        except sqlite3.Error as e:
+            # 限流存储异常时放行，避免限流器成为单点故障
+            logger.error(f"限流存储访问失败，放行请求: {e}")
+            return Admission(True)
+
+    async def release(self, lease_id: Optional[str]):
+        """
+        释放并发流租约（幂等）
+        :param lease_id: admit() 返回的租约ID
+        """
+        if not lease_id:
+            return
+        try:
+            await asyncio.to_thread(self._transaction, self._release, lease_id)
+        except sqlite3.Error as e:
+            logger.error(f"释放并发流租约失败，将在过期后回收: {e}")
+
+    def record_ask(self, client: str, question: str, window: float) -> int:
+        """
+        记录客户端的一次提问，并返回此前窗口内同一客户端提出同一问题的次数（跨worker共享）
+        :param client: client_key() 的结果
+        :param question: 规范化问题的哈希
+        :param window: 时间窗口（秒）
+        """
+        return self._transaction(self._record_ask, client, question, window, time.time())
+
+    def active_streams(self) -> int:
+        """全部worker合计的上游并发流数"""
+        return self._conn().execute("SELECT COUNT(*) FROM streams").fetchone()[0]
+
+
+limiter = ClientLimiter()
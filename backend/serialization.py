@@ -0,0 +1,81 @@
+# backend/serialization.py
+import json
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    # 可选依赖：缺失时回退到标准库json，输出内容相同，只是更慢
+    orjson = None
+
+# 上海时区自1991年起没有夏令时，固定偏移即可；数据库中保存的是不带时区的UTC时间
+SHANGHAI_DELTA = timedelta(hours=8)
+SHANGHAI_OFFSET = timezone(SHANGHAI_DELTA)
+
+# SSE 结束标记
+SSE_DONE = b"data: [DONE]\n\n"
+
+
+def shanghai_datetime(moment: Optional[datetime]) -> Optional[datetime]:
+    """
+    数据库中的UTC时间（不带时区）转换为带+08:00偏移的上海时间
+    直接加固定偏移，不经过 astimezone；序列化时由 orjson 格式化为与 isoformat() 相同的字符串
+    """
+    if moment is None:
+        return None
+    return (moment + SHANGHAI_DELTA).replace(tzinfo=SHANGHAI_OFFSET)
+
+
+def shanghai_text(moment: Optional[datetime], sep: str = " ") -> Optional[str]:
+    """
+    UTC时间格式化为上海时间字符串，与 str()/isoformat() 对带时区datetime的输出相同，
+    但直接格式化偏移后的时间并拼接固定后缀，不构造带时区的对象（CSV等需要字符串的场合）
+    :param sep: 日期和时间之间的分隔符，" " 同 str()，"T" 同 isoformat()
+    """
+    if moment is None:
+        return None
+    return (moment + SHANGHAI_DELTA).isoformat(sep) + "+08:00"
+
+
+def _default(obj: Any):
+    """
+    标准库json回退时的类型处理，与orjson的输出保持一致
+    """
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    序列化为UTF-8编码的JSON（中文不转义），datetime按ISO格式输出
+    :param obj: 只包含基本类型、datetime/date的对象
+    :return: JSON字节串
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+
+def sse_event(payload: Dict[str, Any]) -> bytes:
+    """
+    编码一个SSE data帧
+    :param payload: 事件内容
+    :return: b"data: {...}\\n\\n"
+    """
+    return b"data: " + dumps(payload) + b"\n\n"
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    使用 dumps 编码的JSON响应，也接受已编码好的字节串
+    接口直接返回该响应时，FastAPI 不再执行 jsonable_encoder，datetime 可以直接交给 orjson 格式化
+    """
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return dumps(content)
@@ -0,0 +1,274 @@
+# backend/stats.py
+"""
+使用统计的按小时汇总
+
+保存会话和消息时在同一事务中增量更新 stats_hourly，/stats 只读取汇总表，不扫描聊天记录表。
+上线前已有的历史记录通过回填任务补齐：
+
+    python -m backend.stats backfill
+
+回填按消息ID分批处理，每批单独提交并记录水位线，可以随时中断后继续，
+只处理服务启动时已存在的记录（之后的记录已由增量更新统计），不会重复计数。
+"""
+import argparse
+import logging
+from bisect import bisect_left
+from datetime import datetime, date, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import func, insert, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from .models import ChatMessage, ChatSession, MessageUsage, StatsHourly, StatsLatency, StatsState
+from .serialization import SHANGHAI_DELTA
+from .timing import DEFAULT_BUCKETS_MS, LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+# 回填边界：服务首次启动时已存在的最大ID；水位线：已回填到的ID
+BACKFILL_LIMIT_KEYS = {"messages": "backfill_message_limit", "sessions": "backfill_session_limit"}
+BACKFILL_WATERMARK_KEYS = {"messages": "backfill_message_watermark", "sessions": "backfill_session_watermark"}
+
+
+def local_hour(moment: Optional[datetime] = None) -> datetime:
+    """
+    UTC时间（不带时区）转换为上海时区的整点
+    :param moment: 数据库中保存的UTC时间，None表示当前时间
+    """
+    moment = moment or datetime.utcnow()
+    return (moment + SHANGHAI_DELTA).replace(minute=0, second=0, microsecond=0)
+
+
+def increment(db: Session, model, key: Dict[str, Any], deltas: Dict[str, int],
+              assign: Optional[Dict[str, Any]] = None, insert_only: Optional[Dict[str, Any]] = None):
+    """
+    原子地累加计数列（UPDATE ... SET col = col + n），行不存在时先插入
+    多个worker并发写同一行时不会丢失更新，也不会因重复插入报错
+    :param model: ORM模型
+    :param key: 主键列 -> 值
+    :param deltas: 计数列 -> 增量
+    :param assign: 每次都覆盖的列 -> 值
+    :param insert_only: 仅在插入时设置的列 -> 值
+    """
+    conditions = [getattr(model, column) == value for column, value in key.items()]
+    values = {column: getattr(model, column) + delta for column, delta in deltas.items()}
+    values.update(assign or {})
+    if db.execute(update(model).where(*conditions).values(values)).rowcount:
+        return
+    row = {**key, **{column: 0 for column in deltas}, **(assign or {}), **(insert_only or {})}
+    dialect = db.get_bind().dialect.name
+    if dialect == "sqlite":
+        db.execute(sqlite_insert(model).values(row).on_conflict_do_nothing())
+    elif dialect == "postgresql":
+        db.execute(pg_insert(model).values(row).on_conflict_do_nothing())
+    else:
+        db.execute(insert(model).values(row))
+    db.execute(update(model).where(*conditions).values(values))
+
+
+def record_session(db: Session, created_at: Optional[datetime] = None):
+    """
+    计入一个新会话（由调用方提交事务）
+    """
+    increment(db, StatsHourly, {"hour": local_hour(created_at)}, {"sessions": 1})
+
+
+def _observe(db: Session, hour: datetime, metric: str, value: float):
+    bucket = bisect_left(DEFAULT_BUCKETS_MS, value)
+    increment(db, StatsLatency, {"hour": hour, "metric": metric, "bucket": bucket}, {"count": 1})
+
+
+def record_message(db: Session, role: str, content: str, reasoning_effort: Optional[str] = None,
+                   latency_ms: Optional[float] = None, ttft_ms: Optional[float] = None,
+                   created_at: Optional[datetime] = None):
+    """
+    计入一条消息（由调用方提交事务）
+    :param role: user 或 assistant
+    :param content: 消息内容，助手消息用于统计回复长度
+    :param reasoning_effort: 助手消息实际使用的推理努力程度，未知时为None
+    :param latency_ms: 从收到请求到回复完成的耗时
+    :param ttft_ms: 首个回复token耗时
+    :param created_at: 消息时间（UTC），None表示当前时间
+    """
+    hour = local_hour(created_at)
+    if role == "user":
+        increment(db, StatsHourly, {"hour": hour}, {"user_messages": 1})
+        return
+    increment(db, StatsHourly, {"hour": hour}, {
+        "assistant_messages": 1,
+        "answer_chars": len(content or ""),
+        "effort_messages": 1 if reasoning_effort else 0,
+        "deep_thinking_messages": 1 if reasoning_effort and reasoning_effort != "low" else 0,
+    })
+    if latency_ms is not None:
+        _observe(db, hour, "latency", latency_ms)
+    if ttft_ms is not None:
+        _observe(db, hour, "ttft", ttft_ms)
+
+
+def _histogram(counts: Dict[int, int]) -> LatencyHistogram:
+    histogram = LatencyHistogram()
+    for bucket, count in counts.items():
+        if 0 <= bucket < len(histogram.counts):
+            histogram.counts[bucket] += count
+            histogram.count += count
+    return histogram
+
+
+def _bucket_summary(rows: List[StatsHourly], latency: Dict[str, Dict[int, int]]) -> Dict[str, object]:
+    assistant_messages = sum(row.assistant_messages for row in rows)
+    answer_chars = sum(row.answer_chars for row in rows)
+    effort_messages = sum(row.effort_messages for row in rows)
+    deep_thinking = sum(row.deep_thinking_messages for row in rows)
+    total = _histogram(latency.get("latency", {}))
+    ttft = _histogram(latency.get("ttft", {}))
+    return {
+        "sessions": sum(row.sessions for row in rows),
+        "user_messages": sum(row.user_messages for row in rows),
+        "assistant_messages": assistant_messages,
+        "avg_answer_chars": round(answer_chars / assistant_messages, 1) if assistant_messages else None,
+        "deep_thinking_share": round(deep_thinking / effort_messages, 4) if effort_messages else None,
+        "latency_ms": {"count": total.count, "p50": total.quantile(0.5),
+                       "p95": total.quantile(0.95), "p99": total.quantile(0.99)},
+        "ttft_ms": {"count": ttft.count, "p50": ttft.quantile(0.5), "p95": ttft.quantile(0.95)},
+    }
+
+
+def query_stats(db: Session, start: Optional[date] = None, end: Optional[date] = None,
+                granularity: str = "day") -> Dict[str, object]:
+    """
+    按小时或按天查询汇总统计（上海时区）
+    分位数由桶上界估算，跨小时合并直方图后计算，而不是对各小时分位数求平均
+    :param start: 起始日期（含）
+    :param end: 结束日期（含）
+    :param granularity: hour 或 day
+    :return: 各时间段统计和区间合计
+    """
+    lower = datetime.combine(start, datetime.min.time()) if start else None
+    upper = datetime.combine(end + timedelta(days=1), datetime.min.time()) if end else None
+
+    def in_range(query, column):
+        if lower:
+            query = query.filter(column >= lower)
+        if upper:
+            query = query.filter(column < upper)
+        return query
+
+    def period(hour: datetime) -> str:
+        return hour.strftime("%Y-%m-%d %H:00") if granularity == "hour" else hour.date().isoformat()
+
+    groups: Dict[str, List[StatsHourly]] = {}
+    for row in in_range(db.query(StatsHourly), StatsHourly.hour).order_by(StatsHourly.hour):
+        groups.setdefault(period(row.hour), []).append(row)
+
+    latency: Dict[str, Dict[str, Dict[int, int]]] = {}
+    totals: Dict[str, Dict[int, int]] = {}
+    histogram_rows = in_range(db.query(StatsLatency.hour, StatsLatency.metric, StatsLatency.bucket, StatsLatency.count),
+                              StatsLatency.hour)
+    for hour, metric, bucket, count in histogram_rows:
+        counts = latency.setdefault(period(hour), {}).setdefault(metric, {})
+        counts[bucket] = counts.get(bucket, 0) + count
+        counts = totals.setdefault(metric, {})
+        counts[bucket] = counts.get(bucket, 0) + count
+
+    return {
+        "granularity": granularity,
+        "timezone": "Asia/Shanghai",
+        "buckets": [{"period": key, **_bucket_summary(group, latency.get(key, {}))} for key, group in groups.items()],
+        "totals": _bucket_summary([row for group in groups.values() for row in group], totals),
+    }
+
+
+def _state(db: Session, key: str) -> Optional[int]:
+    row = db.get(StatsState, key)
+    return row.value if row else None
+
+
+def _set_state(db: Session, key: str, value: int):
+    row = db.get(StatsState, key)
+    if row is None:
+        db.add(StatsState(key=key, value=value))
+    else:
+        row.value = value
+
+
+def mark_incremental_start(db: Session):
+    """
+    服务启动时记录回填边界：此时已存在的记录由回填任务统计，之后的记录由增量更新统计
+    只在第一次启动时写入，多个worker同时启动时以先写入者为准
+    """
+    for table, model in (("messages", ChatMessage), ("sessions", ChatSession)):
+        key = BACKFILL_LIMIT_KEYS[table]
+        if _state(db, key) is not None:
+            continue
+        try:
+            db.add(StatsState(key=key, value=db.query(func.max(model.id)).scalar() or 0))
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+
+
+def backfill(db: Session, batch_size: int = 500) -> Dict[str, int]:
+    """
+    回填历史记录到 stats_hourly，每批提交一次并推进水位线
+    历史记录没有耗时数据；reasoning_effort 取自 message_usage（如有）
+    :param batch_size: 每批处理的记录数
+    :return: 本次回填的会话数和消息数
+    """
+    mark_incremental_start(db)
+    done = {"sessions": 0, "messages": 0}
+
+    limit = _state(db, BACKFILL_LIMIT_KEYS["sessions"])
+    while True:
+        watermark = _state(db, BACKFILL_WATERMARK_KEYS["sessions"]) or 0
+        batch = db.query(ChatSession.id, ChatSession.created_at) \
+            .filter(ChatSession.id > watermark, ChatSession.id <= limit) \
+            .order_by(ChatSession.id).limit(batch_size).all()
+        if not batch:
+            break
+        for session_id, created_at in batch:
+            record_session(db, created_at)
+        _set_state(db, BACKFILL_WATERMARK_KEYS["sessions"], batch[-1][0])
+        db.commit()
+        done["sessions"] += len(batch)
+
+    limit = _state(db, BACKFILL_LIMIT_KEYS["messages"])
+    while True:
+        watermark = _state(db, BACKFILL_WATERMARK_KEYS["messages"]) or 0
+        batch = db.query(ChatMessage.id, ChatMessage.role, ChatMessage.content, ChatMessage.timestamp,
+                         MessageUsage.reasoning_effort) \
+            .outerjoin(MessageUsage, MessageUsage.message_id == ChatMessage.id) \
+            .filter(ChatMessage.id > watermark, ChatMessage.id <= limit) \
+            .order_by(ChatMessage.id).limit(batch_size).all()
+        if not batch:
+            break
+        for message_id, role, content, timestamp, reasoning_effort in batch:
+            record_message(db, role, content, reasoning_effort, created_at=timestamp)
+        _set_state(db, BACKFILL_WATERMARK_KEYS["messages"], batch[-1][0])
+        db.commit()
+        done["messages"] += len(batch)
+        logger.info(f"统计回填进度: 消息ID {batch[-1][0]} / {limit}")
+    return done
+
+
+def main():
+    from .models import SessionLocal
+
+    parser = argparse.ArgumentParser(description="使用统计汇总")
+    parser.add_argument("command", choices=["backfill"], help="backfill: 回填上线前的历史记录")
+    parser.add_argument("--batch-size", type=int, default=500, help="每批处理的记录数")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        done = backfill(db, args.batch_size)
+        print(f"已回填 {done['sessions']} 个会话、{done['messages']} 条消息")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
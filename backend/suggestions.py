@@ -0,0 +1,438 @@
+# backend/suggestions.py
+"""
+热门问题推荐与回答预计算
+
+后台任务从聊天记录中挖掘高频和近期上升的问题作为欢迎页的推荐问题，
+在低峰期按速率预算通过 RagflowClient 预先生成回答并保存；用户提问命中时直接回放，
+不再访问上游。知识库版本（数据集更新时间、文档数、分块数的指纹）变化后清空已生成的回答。
+
+多个worker都运行该任务，通过 stats_state 中的租约保证每轮只有一个worker执行；
+回放的命中次数在各worker进程内累加，每轮批量写入。
+
+立即执行一轮（忽略低峰时段限制）：
+    python -m backend.suggestions refresh
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from sqlalchemy import func, or_, update
+from sqlalchemy.orm import Session
+
+from .crud import SHANGHAI_OFFSET, claim_lease, normalize_question, question_hash
+from .models import ChatMessage, ChatSession, QuestionStat, SessionLocal, SuggestedQuestion
+from .ratelimit import limiter
+from .timing import RequestTimer
+
+logger = logging.getLogger(__name__)
+
+SUGGEST_ENABLED = os.getenv("SUGGEST_ENABLED", "1") == "1"
+# /suggestions 返回的问题数，以及保留（并预计算回答）的候选问题数
+SUGGEST_COUNT = int(os.getenv("SUGGEST_COUNT", "6"))
+SUGGEST_POOL = int(os.getenv("SUGGEST_POOL", "20"))
+# 统计窗口内至少被问过这么多次才会被推荐
+SUGGEST_MIN_ASKS = int(os.getenv("SUGGEST_MIN_ASKS", "2"))
+SUGGEST_WINDOW_DAYS = int(os.getenv("SUGGEST_WINDOW_DAYS", "30"))
+# 近期趋势：最近这么多条消息中的提问次数，乘以权重计入得分
+SUGGEST_RECENT_MESSAGES = int(os.getenv("SUGGEST_RECENT_MESSAGES", "5000"))
+SUGGEST_TREND_WEIGHT = int(os.getenv("SUGGEST_TREND_WEIGHT", "3"))
+# 检查知识库版本、刷新候选问题的间隔（秒）
+SUGGEST_INTERVAL = float(os.getenv("SUGGEST_INTERVAL", "300"))
+# 允许预计算回答的时段（上海时区小时，含起点不含终点），例如 1-6 表示 1:00~5:59
+SUGGEST_OFFPEAK_HOURS = os.getenv("SUGGEST_OFFPEAK_HOURS", "1-6")
+# 速率预算：每轮最多生成的回答数、两次上游调用之间的间隔（秒）、允许预计算时的最大在途聊天流数
+SUGGEST_BATCH = int(os.getenv("SUGGEST_BATCH", "5"))
+SUGGEST_PAUSE = float(os.getenv("SUGGEST_PAUSE", "10"))
+SUGGEST_MAX_ACTIVE_STREAMS = int(os.getenv("SUGGEST_MAX_ACTIVE_STREAMS", "2"))
+# 回答生成超过这么多天后在低峰期重新生成（知识库版本不变时仍可继续使用）
+SUGGEST_MAX_AGE_DAYS = float(os.getenv("SUGGEST_MAX_AGE_DAYS", "7"))
+# 预计算使用的推理努力程度，与未开启深度思考时的请求一致
+SUGGEST_EFFORT = "low"
+# 回放时每个chunk的字符数
+REPLAY_CHUNK_CHARS = 24
+# 挖掘到的问题不足时用于补齐的默认问题
+DEFAULT_SUGGESTIONS = [
+    "CF 厂长是谁，他的具体信息？",
+    "我是一名Repair站点新人，该如何规划学习线路？",
+    "BM1 Common Defect异常原因有哪些，如何改善？",
+]
+RUN_LEASE_KEY = "suggest_run_until"
+# 回放次数，question_hash -> 次数，见 take_hits()
+_pending_hits: Counter = Counter()
+MIN_CHARS, MAX_CHARS = 4, 100
+
+
+def _offpeak(hours: str = SUGGEST_OFFPEAK_HOURS, now: Optional[datetime] = None) -> bool:
+    """
+    当前（上海时区）是否处于低峰时段，格式为 起始小时-结束小时（不含结束小时），可跨零点（如 22-6），
+    起止相同（如 0-0）表示全天
+    """
+    try:
+        begin, end = (int(part) for part in hours.split("-"))
+    except ValueError:
+        logger.warning(f"SUGGEST_OFFPEAK_HOURS 格式错误: {hours}")
+        return False
+    hour = (now or datetime.now(SHANGHAI_OFFSET)).hour
+    if begin == end:
+        return True
+    return begin <= hour < end if begin < end else (hour >= begin or hour < end)
+
+
+def mine_candidates(db: Session, now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    """
+    挖掘推荐候选问题：统计窗口内的提问次数（question_stats）加上最近消息中提问次数的加权
+    :return: 按得分降序的候选问题，最多 SUGGEST_POOL 个
+    """
+    since = (now or datetime.utcnow()) - timedelta(days=SUGGEST_WINDOW_DAYS)
+    candidates: Dict[str, Dict[str, Any]] = {}
+    frequent = db.query(QuestionStat.question_hash, QuestionStat.question, QuestionStat.asks) \
+        .filter(QuestionStat.last_asked >= since, QuestionStat.asks >= SUGGEST_MIN_ASKS) \
+        .order_by(QuestionStat.asks.desc()).limit(SUGGEST_POOL * 10)
+    for key, question, asks in frequent:
+        candidates[key] = {"question_hash": key, "question": (question or "").strip(), "asks": asks, "recent_asks": 0}
+
+    # 按主键范围只扫描最近的消息，不需要时间索引
+    max_id = db.query(func.max(ChatMessage.id)).scalar() or 0
+    recent = db.query(ChatMessage.content) \
+        .join(ChatSession, ChatSession.id == ChatMessage.session_id) \
+        .filter(ChatMessage.id > max_id - SUGGEST_RECENT_MESSAGES, ChatMessage.role == "user",
+                ChatSession.deleted_at.is_(None))
+    for (content,) in recent:
+        key = question_hash(content)
+        entry = candidates.get(key)
+        if entry is None:
+            entry = candidates[key] = {"question_hash": key, "question": (content or "").strip()[:500],
+                                       "asks": 0, "recent_asks": 0}
+        entry["recent_asks"] += 1
+
+    result = []
+    for entry in candidates.values():
+        entry["asks"] = max(entry["asks"], entry["recent_asks"])
+        if entry["asks"] < SUGGEST_MIN_ASKS or not MIN_CHARS <= len(normalize_question(entry["question"])) <= MAX_CHARS:
+            continue
+        entry["score"] = entry["asks"] + SUGGEST_TREND_WEIGHT * entry["recent_asks"]
+        result.append(entry)
+    result.sort(key=lambda entry: (-entry["score"], entry["question"]))
+    return result[:SUGGEST_POOL]
+
+
+def refresh_candidates(db: Session, candidates: List[Dict[str, Any]]) -> int:
+    """
+    用挖掘结果更新 suggested_questions，不再入选的问题连同回答一起删除
+    :return: 删除的问题数
+    """
+    now = datetime.utcnow()
+    for candidate in candidates:
+        row = db.get(SuggestedQuestion, candidate["question_hash"])
+        if row is None:
+            db.add(SuggestedQuestion(**candidate, updated_at=now))
+        else:
+            row.question, row.score = candidate["question"], candidate["score"]
+            row.asks, row.recent_asks, row.updated_at = candidate["asks"], candidate["recent_asks"], now
+    dropped = db.query(SuggestedQuestion) \
+        .filter(SuggestedQuestion.question_hash.notin_([c["question_hash"] for c in candidates])) \
+        .delete(synchronize_session=False)
+    db.commit()
+    return dropped
+
+
+def invalidate_answers(db: Session, kb_version: str) -> int:
+    """
+    清空基于其他（或未知）知识库版本生成的回答
+    :return: 清空的回答数
+    """
+    cleared = db.query(SuggestedQuestion) \
+        .filter(SuggestedQuestion.response_content.isnot(None),
+                or_(SuggestedQuestion.kb_version.is_(None), SuggestedQuestion.kb_version != kb_version)) \
+        .update({SuggestedQuestion.response_content: None, SuggestedQuestion.thinking_content: None,
+                 SuggestedQuestion.answered_at: None, SuggestedQuestion.kb_version: None},
+                synchronize_session=False)
+    db.commit()
+    return cleared
+
+
+def pending_questions(db: Session, limit: int) -> List[SuggestedQuestion]:
+    """
+    需要（重新）生成回答的问题：尚无回答或回答已过期，按得分降序
+    """
+    expired = datetime.utcnow() - timedelta(days=SUGGEST_MAX_AGE_DAYS)
+    return db.query(SuggestedQuestion) \
+        .filter((SuggestedQuestion.response_content.is_(None)) | (SuggestedQuestion.answered_at < expired)) \
+        .order_by(SuggestedQuestion.score.desc()).limit(limit).all()
+
+
+def list_suggestions(db: Session, limit: int = SUGGEST_COUNT) -> List[Dict[str, Any]]:
+    """
+    欢迎页的推荐问题，按得分降序；不足时用默认问题补齐
+    :return: [{"question": 问题, "cached": 是否已有预计算回答}]
+    """
+    rows = db.query(SuggestedQuestion.question, SuggestedQuestion.response_content.isnot(None)) \
+        .order_by(SuggestedQuestion.score.desc(), SuggestedQuestion.question).limit(limit).all()
+    items = [{"question": question, "cached": bool(cached)} for question, cached in rows]
+    seen = {question_hash(item["question"]) for item in items}
+    for question in DEFAULT_SUGGESTIONS:
+        if len(items) >= limit:
+            break
+        if question_hash(question) not in seen:
+            items.append({"question": question, "cached": False})
+    return items
+
+
+def find_answer(db: Session, question: str, reasoning_effort: str) -> Optional[Dict[str, str]]:
+    """
+    查找问题的预计算回答（只读，命中次数在回放时累计）
+    :param question: 用户问题（规范化后匹配）
+    :param reasoning_effort: 本次请求的推理努力程度，只有与预计算时一致才命中
+    :return: {"question_hash", "thinking_content", "response_content"}，未命中为None
+    """
+    key = question_hash(question)
+    row = db.query(SuggestedQuestion.thinking_content, SuggestedQuestion.response_content) \
+        .filter(SuggestedQuestion.question_hash == key, SuggestedQuestion.response_content.isnot(None),
+                SuggestedQuestion.reasoning_effort == reasoning_effort).first()
+    if row is None:
+        return None
+    return {"question_hash": key, "thinking_content": row[0] or "", "response_content": row[1]}
+
+
+def take_hits() -> Dict[str, int]:
+    """
+    取出并清空本进程累计的命中次数（在事件循环线程中调用，与回放互不干扰）
+    """
+    pending = dict(_pending_hits)
+    _pending_hits.clear()
+    return pending
+
+
+def save_hits(db: Session, pending: Dict[str, int]):
+    """
+    批量累加命中次数
+    :param pending: take_hits() 的结果
+    """
+    for key, count in pending.items():
+        db.execute(update(SuggestedQuestion).where(SuggestedQuestion.question_hash == key)
+                   .values(hits=SuggestedQuestion.hits + count))
+    db.commit()
+
+
+async def replay_answer(answer: Dict[str, str], timer: Optional[RequestTimer] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    按 RagflowClient.async_chat 的chunk格式回放预计算的回答
+    :param answer: find_answer 的返回值
+    :param timer: 可选的请求计时器，记录与上游请求相同的时间点
+    """
+    # 命中次数先在进程内累加，由后台任务每轮批量写入，不在请求路径上写库
+    _pending_hits[answer["question_hash"]] += 1
+    if timer:
+        timer.mark("upstream_start")
+    for kind, text in (("thinking", answer["thinking_content"]), ("content", answer["response_content"])):
+        for start in range(0, len(text), REPLAY_CHUNK_CHARS):
+            if timer:
+                timer.mark_first("first_chunk")
+                timer.mark_first("first_thinking" if kind == "thinking" else "first_content")
+                timer.chunks += 1
+            yield {"type": kind, "content": text[start:start + REPLAY_CHUNK_CHARS]}
+            # 让出事件循环，长回答回放时不阻塞其他请求
+            await asyncio.sleep(0)
+    if timer:
+        timer.mark("last_chunk")
+    yield {"type": "complete", "thinking_content": answer["thinking_content"],
+           "response_content": answer["response_content"], "usage": None}
+
+
+class SuggestionPrecomputer:
+    """
+    推荐问题后台任务：刷新候选问题、检测知识库版本，低峰期按预算预计算回答
+    """
+
+    def __init__(self, rag, interval: float = SUGGEST_INTERVAL, batch: int = SUGGEST_BATCH,
+                 pause: float = SUGGEST_PAUSE):
+        """
+        :param rag: RagflowClient实例
+        :param interval: 两轮之间的间隔（秒）
+        :param batch: 每轮最多生成的回答数
+        :param pause: 两次上游调用之间的间隔（秒）
+        """
+        self.rag = rag
+        self.interval = interval
+        self.batch = batch
+        self.pause = pause
+        self.kb_version: Optional[str] = None
+        self.last_run: Optional[float] = None
+        self.precomputed = 0
+        self.failed = 0
+        self.invalidated = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def _claim(self) -> bool:
+        """
+        抢占本轮执行权；执行中途租约不会过期，下一轮可由任意worker接手
+        """
+        db = SessionLocal()
+        try:
+            return claim_lease(db, RUN_LEASE_KEY, self.interval * 0.9)
+        finally:
+            db.close()
+
+    def _prepare(self, kb_version: Optional[str]) -> List[Dict[str, Any]]:
+        """
+        :return: 待生成回答的问题
+        """
+        db = SessionLocal()
+        try:
+            refresh_candidates(db, mine_candidates(db))
+            if kb_version:
+                cleared = invalidate_answers(db, kb_version)
+                if cleared:
+                    self.invalidated += cleared
+                    logger.info(f"知识库版本变为 {kb_version}，清空 {cleared} 条预计算回答")
+            return [{"question_hash": row.question_hash, "question": row.question}
+                    for row in pending_questions(db, self.batch)]
+        finally:
+            db.close()
+
+    def _save_hits(self, pending: Dict[str, int]):
+        db = SessionLocal()
+        try:
+            save_hits(db, pending)
+        finally:
+            db.close()
+
+    async def flush_hits(self):
+        """
+        写入本worker累计的命中次数（每个worker各自执行，不需要租约）
+        """
+        pending = take_hits()
+        if not pending:
+            return
+        try:
+            await asyncio.to_thread(self._save_hits, pending)
+        except Exception as e:
+            logger.warning(f"保存推荐问题命中次数失败: {e}")
+
+    def _save(self, key: str, thinking_content: str, response_content: str, kb_version: Optional[str]):
+        db = SessionLocal()
+        try:
+            row = db.get(SuggestedQuestion, key)
+            if row is None:
+                return
+            row.reasoning_effort = SUGGEST_EFFORT
+            row.thinking_content = thinking_content
+            row.response_content = response_content
+            row.kb_version = kb_version
+            row.answered_at = datetime.utcnow()
+            db.commit()
+        finally:
+            db.close()
+
+    async def _generate(self, question: str) -> Optional[Dict[str, str]]:
+        async for chunk in self.rag.async_chat([{"role": "user", "content": question}],
+                                               reasoning_effort=SUGGEST_EFFORT):
+            if chunk["type"] == "complete":
+                return chunk
+            if chunk["type"] == "error":
+                logger.warning(f"预计算回答失败: {chunk.get('message')}")
+                return None
+        return None
+
+    async def run_once(self, force: bool = False) -> Dict[str, int]:
+        """
+        执行一轮：刷新候选问题，知识库版本变化时清空旧回答，低峰期生成缺失的回答
+        :param force: 忽略租约、低峰时段和负载限制（命令行手动执行）
+        :return: 本轮生成的回答数
+        """
+        done = {"precomputed": 0}
+        await self.flush_hits()
+        # 先抢租约，只有本轮执行的worker才访问上游获取知识库版本
+        if not force and not await asyncio.to_thread(self._claim):
+            return done
+        kb_version = await self.rag.kb_version()
+        if kb_version:
+            self.kb_version = kb_version
+        pending = await asyncio.to_thread(self._prepare, kb_version)
+        self.last_run = time.time()
+        if not (force or _offpeak()) or not self.rag.is_initialized:
+            return done
+
+        for index, item in enumerate(pending):
+            if not force and limiter.active_streams() > SUGGEST_MAX_ACTIVE_STREAMS:
+                logger.info("在途聊天流较多，暂停预计算回答")
+                break
+            if index:
+                await asyncio.sleep(self.pause)
+            answer = await self._generate(item["question"])
+            if answer is None or not answer.get("response_content"):
+                self.failed += 1
+                continue
+            await asyncio.to_thread(self._save, item["question_hash"], answer.get("thinking_content") or "",
+                                    answer["response_content"], kb_version)
+            self.precomputed += 1
+            done["precomputed"] += 1
+        if done["precomputed"]:
+            logger.info(f"已预计算 {done['precomputed']} 个推荐问题的回答")
+        return done
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"推荐问题任务异常: {e}", exc_info=True)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """
+        在当前事件循环中启动后台任务（立即返回）
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        停止后台任务，生成中的回答被丢弃，累计的命中次数写入数据库
+        """
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush_hits()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "kb_version": self.kb_version,
+            "last_run": self.last_run,
+            "precomputed": self.precomputed,
+            "failed": self.failed,
+            "invalidated": self.invalidated,
+        }
+
+
+def main():
+    from .rag_client import RagflowClient
+
+    parser = argparse.ArgumentParser(description="推荐问题与回答预计算")
+    parser.add_argument("command", choices=["refresh"], help="refresh: 立即刷新候选问题并生成缺失的回答")
+    args = parser.parse_args()
+
+    async def refresh():
+        rag = RagflowClient()
+        try:
+            return await SuggestionPrecomputer(rag, batch=SUGGEST_POOL, pause=1.0).run_once(force=True)
+        finally:
+            await rag.close()
+
+    done = asyncio.run(refresh())
+    print(f"已生成 {done['precomputed']} 个回答")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+# backend/timing.py
+import time
+import threading
+from bisect import bisect_left
+from typing import Dict, Optional, Tuple
+
+# 直方图桶上界（毫秒），覆盖从数据库写入到深度思考长流的全部量级
+DEFAULT_BUCKETS_MS: Tuple[float, ...] = (
+    5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+    10000, 30000, 60000, 120000, 300000,
+)
+
+
+class RequestTimer:
+    """
+    单次聊天请求的阶段计时器
+    只在关键节点调用 time.perf_counter()，热路径上不做日志和字典拷贝
+    """
+    __slots__ = ("reasoning_effort", "start", "marks", "chunks", "attempts")
+
+    def __init__(self, reasoning_effort: str = "low"):
+        self.reasoning_effort = reasoning_effort
+        self.start = time.perf_counter()
+        self.marks: Dict[str, float] = {}
+        self.chunks = 0
+        self.attempts = 0
+
+    def mark(self, name: str):
+        """
+        记录（或覆盖）一个时间点
+        :param name: 时间点名称
+        """
+        self.marks[name] = time.perf_counter()
+
+    def mark_first(self, name: str):
+        """
+        只记录第一次出现的时间点，例如首个思考/回复token
+        :param name: 时间点名称
+        """
+        if name not in self.marks:
+            self.marks[name] = time.perf_counter()
+
+    def elapsed_ms(self) -> float:
+        """
+        从请求开始到现在的耗时（毫秒）
+        """
+        return (time.perf_counter() - self.start) * 1000.0
+
+    def _span(self, begin: Optional[str], end: str) -> Optional[float]:
+        end_at = self.marks.get(end)
+        begin_at = self.start if begin is None else self.marks.get(begin)
+        if end_at is None or begin_at is None:
+            return None
+        return (end_at - begin_at) * 1000.0
+
+    def phases(self) -> Dict[str, float]:
+        """
+        计算各阶段耗时（毫秒），未发生的阶段不出现在结果中
+        :return: 阶段名 -> 耗时
+        """
+        spans = {
+            "fair_queue": self._span(None, "admitted"),
+            "db_prepare": self._span("admitted" if "admitted" in self.marks else None, "db_prepared"),
+            "queue": self._span("db_prepared", "upstream_start"),
+            "ttfb": self._span("upstream_start", "first_chunk"),
+            "ttft_thinking": self._span("upstream_start", "first_thinking"),
+            "ttft_answer": self._span("upstream_start", "first_content"),
+            "stream": self._span("first_chunk", "last_chunk"),
+            "db_persist": self._span("persist_start", "db_persisted"),
+            "total": self._span(None, "end"),
+        }
+        return {name: round(value, 2) for name, value in spans.items() if value is not None}
+
+    def summary(self) -> Dict[str, object]:
+        """
+        生成SSE metrics事件的内容
+        :return: 阶段耗时、chunk数和chunk速率
+        """
+        phases = self.phases()
+        stream_ms = phases.get("stream")
+        rate = round(self.chunks / (stream_ms / 1000.0), 2) if stream_ms else None
+        return {
+            "reasoning_effort": self.reasoning_effort,
+            "phases_ms": phases,
+            "chunks": self.chunks,
+            "chunks_per_s": rate,
+            "attempts": self.attempts,
+        }
+
+
+def format_server_timing(phases: Dict[str, float]) -> str:
+    """
+    将阶段耗时格式化为 Server-Timing 头
+    :param phases: 阶段名 -> 耗时（毫秒）
+    :return: 头部字符串，例如 "db_prepare;dur=1.2, total;dur=30.5"
+    """
+    return ", ".join(f"{name};dur={value:.2f}" for name, value in phases.items())
+
+
+class LatencyHistogram:
+    """
+    固定桶的累积直方图（与Prometheus直方图语义一致）
+    """
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        按桶上界估算分位数
+        :param q: 0~1之间的分位
+        :return: 估算值（毫秒），无数据时为None
+        """
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= target:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def snapshot(self) -> Dict[str, object]:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 2),
+            "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], self.counts)),
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class LatencyStats:
+    """
+    按 reasoning_effort 和阶段聚合的延迟直方图（进程内）
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS_MS):
+        self.buckets = buckets
+        self._histograms: Dict[Tuple[str, str], LatencyHistogram] = {}
+        self._lock = threading.Lock()
+
+    def record(self, timer: RequestTimer):
+        """
+        将一次请求的阶段耗时计入直方图
+        :param timer: 已结束的请求计时器
+        """
+        phases = timer.phases()
+        with self._lock:
+            for phase, value in phases.items():
+                key = (timer.reasoning_effort, phase)
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = LatencyHistogram(self.buckets)
+                histogram.observe(value)
+
+    def items(self):
+        """
+        返回 ((reasoning_effort, phase), 直方图) 的快照列表
+        """
+        with self._lock:
+            return list(self._histograms.items())
+
+    def snapshot(self) -> Dict[str, Dict[str, object]]:
+        result: Dict[str, Dict[str, object]] = {}
+        for (effort, phase), histogram in self.items():
+            result.setdefault(effort, {})[phase] = histogram.snapshot()
+        return result
+
+
+# 全局延迟统计
+latency_stats = LatencyStats()
@@ -0,0 +1,144 @@
+# bench/boot_profile.py
+"""
+测量gunicorn启动耗时和每个worker的内存
+
+用法：
+    python -m bench.boot_profile --workers 4
+    python -m bench.boot_profile --workers 4 --no-preload
+
+从启动master开始计时，直到全部worker输出 "Application startup complete"；
+然后从 /proc/<pid>/smaps_rollup 读取每个进程的 RSS、PSS 和私有内存（USS）。
+preload 时worker与master共享导入的模块页，PSS/USS 比 RSS 更能反映实际占用。
+结果写入 bench/results/boot-<commit>-<时间>.json
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+from bench.run_bench import git_commit
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+READY_MARKER = "Application startup complete"
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def memory_kb(pid: int) -> Optional[Dict[str, int]]:
+    """
+    读取进程的 RSS / PSS / USS（KB）
+    :return: 进程不存在时为None
+    """
+    values = {"rss": 0, "pss": 0, "uss": 0}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                name, _, rest = line.partition(":")
+                if not rest.strip().endswith("kB"):
+                    continue
+                size = int(rest.split()[0])
+                if name == "Rss":
+                    values["rss"] = size
+                elif name == "Pss":
+                    values["pss"] = size
+                elif name in ("Private_Clean", "Private_Dirty"):
+                    values["uss"] += size
+    except OSError:
+        return None
+    return values
+
+
+def _children(pid: int) -> List[int]:
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def profile(workers: int, preload: bool, timeout: float = 120.0) -> Dict[str, object]:
+    """
+    启动一次gunicorn并在全部worker就绪后采样
+    """
+    env = dict(os.environ, GUNICORN_WORKERS=str(workers), GUNICORN_PRELOAD="1" if preload else "0",
+               BIND=f"127.0.0.1:{_free_port()}", LOG_LEVEL=os.getenv("LOG_LEVEL", "INFO"))
+    command = [sys.executable, "-m", "gunicorn", "-c", "backend/gunicorn_conf.py", "--workers", str(workers)]
+    command += (["--preload"] if preload else []) + ["backend.main:app"]
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, text=True, bufsize=1)
+    ready_at: List[float] = []
+    lines: List[str] = []
+
+    def read_output():
+        for line in process.stdout:
+            lines.append(line)
+            if READY_MARKER in line:
+                ready_at.append(time.perf_counter() - start)
+
+    reader = threading.Thread(target=read_output, daemon=True)
+    reader.start()
+    try:
+        deadline = time.monotonic() + timeout
+        while len(ready_at) < workers and time.monotonic() < deadline and process.poll() is None:
+            time.sleep(0.05)
+        if len(ready_at) < workers:
+            raise RuntimeError("worker未在超时内就绪:\n" + "".join(lines[-30:]))
+        time.sleep(1.0)  # 等待启动期间的临时分配回落
+
+        master = memory_kb(process.pid)
+        worker_memory = [m for m in (memory_kb(pid) for pid in _children(process.pid)) if m]
+        return {
+            "workers": workers,
+            "preload": preload,
+            "boot_s": round(max(ready_at), 3),
+            "first_worker_ready_s": round(min(ready_at), 3),
+            "master_kb": master,
+            "worker_kb": worker_memory,
+            "worker_avg_kb": {key: round(sum(m[key] for m in worker_memory) / len(worker_memory))
+                              for key in ("rss", "pss", "uss")} if worker_memory else None,
+            "total_pss_kb": (master["pss"] if master else 0) + sum(m["pss"] for m in worker_memory),
+        }
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="测量gunicorn启动耗时和worker内存")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--preload", dest="preload", action="store_true", default=True)
+    parser.add_argument("--no-preload", dest="preload", action="store_false")
+    parser.add_argument("--runs", type=int, default=3, help="重复次数，取启动耗时中位数")
+    args = parser.parse_args()
+
+    runs = [profile(args.workers, args.preload) for _ in range(args.runs)]
+    runs.sort(key=lambda run: run["boot_s"])
+    result = {"commit": git_commit() or "nogit", "median": runs[len(runs) // 2], "runs": runs}
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"boot-{result['commit']}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    median = result["median"]
+    print(f"workers={median['workers']} preload={median['preload']} 启动耗时={median['boot_s']}s "
+          f"worker平均 RSS={median['worker_avg_kb']['rss']}KB PSS={median['worker_avg_kb']['pss']}KB "
+          f"USS={median['worker_avg_kb']['uss']}KB 合计PSS={median['total_pss_kb']}KB")
+    print(f"结果已写入 {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+# bench/mock_ragflow.py
+"""
+本地Mock RAGFlow服务（OpenAI兼容的 chats_openai 接口）
+
+用法：
+    python -m bench.mock_ragflow --port 9380 --ttft 0.8 --tps 40 --reasoning-chars 400
+
+然后让后端指向它：
+    RAGFLOW_BASE_URL=http://127.0.0.1:9380 RAGFLOW_CHAT_ID=mock RAGFLOW_API_KEY=mock
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+REASONING_TEXT = "先检查涂布膜厚与曝光能量，再对比显影时间和Oven温度曲线，排除光阻批次差异。"
+ANSWER_TEXT = "## 结论\n\n该缺陷主要与**曝光能量偏移**有关，建议复核机台参数并追踪同批次基板。\n\n"
+
+
+@dataclass
+class MockConfig:
+    """
+    Mock服务行为配置，可通过 /mock/config 在运行时修改
+    """
+    ttft: float = 0.5               # 首token延迟（秒）
+    tps: float = 50.0               # 每秒token（chunk）数
+    reasoning_chars: int = 200      # reasoning_content 字符数（reasoning_effort=low 时减半）
+    answer_chars: int = 300         # content 字符数
+    chars_per_chunk: int = 2        # 每个chunk包含的字符数
+    error_rate: float = 0.0         # 直接返回500的概率
+    timeout_rate: float = 0.0       # 挂起不响应的概率
+    hang_seconds: float = 600.0     # 挂起时长
+    disconnect_rate: float = 0.0    # 流中途断开的概率
+    seed: int = 0                   # 随机种子，0表示不固定
+    kb_version: int = 1             # 知识库数据集的 update_time，修改后模拟知识库更新
+
+
+config = MockConfig()
+stats = {"requests": 0, "errors": 0, "timeouts": 0, "disconnects": 0, "completed": 0}
+app = FastAPI(title="Mock RAGFlow")
+
+
+def _take(text: str, length: int) -> str:
+    """
+    循环拼接示例文本到指定长度
+    """
+    if length <= 0:
+        return ""
+    return (text * (length // len(text) + 1))[:length]
+
+
+def _chunk(completion_id: str, created: int, delta: dict, finish_reason=None) -> str:
+    payload = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": "ragflow",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+async def _stream(reasoning: str, answer: str, disconnect_at: int, usage: Optional[dict] = None):
+    """
+    按配置的TTFT和token速率输出chunk，disconnect_at>=0时在该chunk处断开连接
+    usage不为空时（请求了 stream_options.include_usage）在结束前追加用量chunk
+    """
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    step = max(1, config.chars_per_chunk)
+    pieces = [("reasoning_content", reasoning[i:i + step]) for i in range(0, len(reasoning), step)]
+    pieces += [("content", answer[i:i + step]) for i in range(0, len(answer), step)]
+
+    await asyncio.sleep(config.ttft)
+    start = time.perf_counter()
+    interval = 1.0 / config.tps if config.tps > 0 else 0.0
+    for index, (field, text) in enumerate(pieces):
+        if index == disconnect_at:
+            stats["disconnects"] += 1
+            raise ConnectionResetError("mock mid-stream disconnect")
+        # 按绝对时间表节流，避免sleep误差累积
+        delay = start + index * interval - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        yield _chunk(completion_id, created, {field: text})
+    yield _chunk(completion_id, created, {}, finish_reason="stop")
+    if usage is not None:
+        payload = {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                   "model": "ragflow", "choices": [], "usage": usage}
+        yield f"data: {json.dumps(payload)}\n\n"
+    yield "data: [DONE]\n\n"
+    stats["completed"] += 1
+
+
+@app.post("/api/v1/chats_openai/{chat_id}/chat/completions")
+async def chat_completions(chat_id: str, request: Request):
+    """
+    OpenAI兼容的聊天补全接口，支持流式与非流式
+    """
+    body = await request.json()
+    stats["requests"] += 1
+    rng = random.random
+
+    if rng() < config.error_rate:
+        stats["errors"] += 1
+        return JSONResponse(status_code=500, content={"error": {"message": "mock injected error"}})
+    if rng() < config.timeout_rate:
+        stats["timeouts"] += 1
+        await asyncio.sleep(config.hang_seconds)
+
+    reasoning_chars = config.reasoning_chars
+    if body.get("reasoning_effort") == "low":
+        reasoning_chars //= 2
+    reasoning = _take(REASONING_TEXT, reasoning_chars)
+    answer = _take(ANSWER_TEXT, config.answer_chars)
+
+    if not body.get("stream"):
+        await asyncio.sleep(config.ttft)
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "ragflow",
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": answer, "reasoning_content": reasoning},
+                "finish_reason": "stop",
+            }],
+        }
+
+    step = max(1, config.chars_per_chunk)
+    reasoning_chunks = -(-len(reasoning) // step)
+    total_chunks = reasoning_chunks + -(-len(answer) // step)
+    disconnect_at = random.randint(0, max(0, total_chunks - 1)) if rng() < config.disconnect_rate else -1
+    usage = None
+    if (body.get("stream_options") or {}).get("include_usage"):
+        prompt_chars = sum(len(str(m.get("content", ""))) for m in body.get("messages", []))
+        usage = {
+            "prompt_tokens": prompt_chars,
+            "completion_tokens": total_chunks,
+            "total_tokens": prompt_chars + total_chunks,
+            "completion_tokens_details": {"reasoning_tokens": reasoning_chunks},
+        }
+    return StreamingResponse(_stream(reasoning, answer, disconnect_at, usage), media_type="text/event-stream")
+
+
+@app.get("/api/v1/chats")
+async def list_chats(id: Optional[str] = None):
+    """聊天助手列表，只返回关联的数据集，用于计算知识库版本"""
+    return {"code": 0, "data": [{"id": id or "mock", "datasets": [{"id": "mock-kb", "name": "Mock知识库"}]}]}
+
+
+@app.get("/api/v1/datasets")
+async def list_datasets(id: Optional[str] = None):
+    """数据集列表，update_time 取 kb_version 配置"""
+    return {"code": 0, "data": [{"id": id or "mock-kb", "update_time": config.kb_version,
+                                 "document_count": 10, "chunk_count": 1000}]}
+
+
+@app.get("/mock/config")
+async def get_config():
+    """当前配置和累计统计"""
+    return {"config": asdict(config), "stats": stats}
+
+
+@app.post("/mock/config")
+async def update_config(request: Request):
+    """运行时修改配置，例如在压测中途注入错误"""
+    for key, value in (await request.json()).items():
+        if hasattr(config, key):
+            setattr(config, key, type(getattr(config, key))(value))
+    return {"config": asdict(config)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地Mock RAGFlow服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9380)
+    for field, default in asdict(MockConfig()).items():
+        parser.add_argument(f"--{field.replace('_', '-')}", type=type(default), default=default)
+    args = parser.parse_args()
+
+    for field in asdict(config):
+        setattr(config, field, getattr(args, field))
+    if config.seed:
+        random.seed(config.seed)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
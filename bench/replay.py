@@ -0,0 +1,194 @@
+# bench/replay.py
+"""
+回放 chat_history.db 中的历史提问，用真实的问题分布和到达间隔压测目标部署
+
+用法：
+    python -m bench.replay --db chat_history.db --target http://127.0.0.1:8000 --speed 10
+    python -m bench.replay --db chat_history.db --sample 200 --speed 0 --max-inflight 20
+
+--speed 为回放倍速（1=按原始间隔，0=不等待），数据库以只读方式打开，不影响线上写入。
+回放从单个客户端发起，目标后端需设置 RATE_LIMIT_ENABLED=0，否则请求会被客户端限流拒绝（429）。
+每条请求记录延迟、TTFT、缓存命中（X-Cache 响应头）以及与历史回答的长度/耗时对比。
+"""
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime
+from statistics import median
+from typing import Dict, Iterator, List, Optional
+
+import httpx
+
+from .run_bench import chat_once, git_commit, summarize, warn_rate_limited
+
+QUESTION_SQL = """
+SELECT u.id, s.session_id, u.content, u.timestamp,
+       a.content, a.thinking_content, a.timestamp
+FROM chat_messages u
+JOIN chat_sessions s ON s.id = u.session_id
+LEFT JOIN chat_messages a ON a.id = (
+    SELECT id FROM chat_messages
+    WHERE session_id = u.session_id AND role = 'assistant' AND id > u.id
+    ORDER BY id LIMIT 1
+)
+WHERE u.role = 'user' AND u.timestamp >= ? AND u.timestamp < ?
+"""
+
+
+def _parse_ts(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    return datetime.fromisoformat(value)
+
+
+def load_questions(db_path: str, since: str, until: str,
+                   sample: Optional[int], limit: Optional[int]) -> Iterator[Dict[str, object]]:
+    """
+    以只读方式流式读取历史提问及其对应的助手回答
+    :param sample: 随机抽样条数（抽样后仍按时间排序）
+    :param limit: 按时间顺序取前N条
+    """
+    conn = sqlite3.connect(f"file:{os.path.abspath(db_path)}?mode=ro", uri=True)
+    try:
+        sql = QUESTION_SQL
+        # 统一成与存储一致的 "YYYY-MM-DD HH:MM:SS" 文本，避免被列的NUMERIC亲和性转换成数字比较
+        params: List[object] = [datetime.fromisoformat(since).isoformat(sep=" "),
+                                datetime.fromisoformat(until).isoformat(sep=" ")]
+        if sample:
+            sql = f"SELECT * FROM ({sql} ORDER BY RANDOM() LIMIT ?)"
+            params.append(sample)
+        sql += " ORDER BY 4" if sample else " ORDER BY u.timestamp"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        for row in conn.execute(sql, params):
+            asked_at = _parse_ts(row[3])
+            answered_at = _parse_ts(row[6])
+            yield {
+                "message_id": row[0],
+                "session_id": row[1],
+                "question": row[2],
+                "asked_at": asked_at,
+                "stored_answer_chars": len(row[4]) if row[4] else None,
+                "stored_thinking": bool(row[5]),
+                "stored_latency_ms": (answered_at - asked_at).total_seconds() * 1000.0
+                if asked_at and answered_at else None,
+            }
+    finally:
+        conn.close()
+
+
+async def replay(args) -> Dict[str, object]:
+    questions = load_questions(args.db, args.since, args.until, args.sample, args.limit)
+    limits = httpx.Limits(max_connections=args.max_inflight, max_keepalive_connections=args.max_inflight)
+    timeout = httpx.Timeout(args.timeout, connect=10.0)
+    inflight = asyncio.Semaphore(args.max_inflight)
+    records: List[Dict[str, object]] = []
+
+    async def fire(item: Dict[str, object], client: httpx.AsyncClient):
+        if args.deep_thinking == "auto":
+            deep = item["stored_thinking"]
+        else:
+            deep = args.deep_thinking == "on"
+        async with inflight:
+            result = await chat_once(client, item["question"], deep)
+        stored_chars = item["stored_answer_chars"]
+        records.append({
+            "message_id": item["message_id"],
+            "deep_thinking": deep,
+            "latency_ms": round(result["latency_ms"], 2),
+            "ttft_ms": round(result["ttft_ms"], 2) if result["ttft_ms"] is not None else None,
+            "error": result["error"],
+            "cache": result["cache"],
+            "answer_chars": result["answer_chars"],
+            "stored_answer_chars": stored_chars,
+            "length_ratio": round(result["answer_chars"] / stored_chars, 3) if stored_chars else None,
+            "stored_latency_ms": item["stored_latency_ms"],
+            "phases_ms": (result["metrics"] or {}).get("phases_ms"),
+        })
+
+    tasks = []
+    async with httpx.AsyncClient(base_url=args.target, limits=limits, timeout=timeout) as client:
+        start = time.perf_counter()
+        offset = 0.0
+        previous_at = None
+        for item in questions:
+            # 按原始到达间隔（除以倍速，单个间隔不超过max_gap）调度
+            if args.speed > 0 and previous_at is not None and item["asked_at"]:
+                gap = (item["asked_at"] - previous_at).total_seconds() / args.speed
+                offset += min(max(gap, 0.0), args.max_gap)
+                delay = start + offset - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            previous_at = item["asked_at"] or previous_at
+            tasks.append(asyncio.create_task(fire(item, client)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "target": args.target,
+        "speed": args.speed,
+        "summary": summarize_records(records, elapsed),
+        "requests": sorted(records, key=lambda r: r["message_id"]),
+    }
+
+
+def summarize_records(records: List[Dict[str, object]], elapsed: float) -> Dict[str, object]:
+    """
+    汇总回放结果：延迟分布、缓存命中率、与历史回答的长度和耗时对比
+    """
+    ok = [r for r in records if not r["error"]]
+    cached = [r for r in records if r["cache"]]
+    ratios = [r["length_ratio"] for r in ok if r["length_ratio"] is not None]
+    stored_latency = [r["stored_latency_ms"] for r in records if r["stored_latency_ms"] is not None]
+    return {
+        "requests": len(records),
+        "errors": len(records) - len(ok),
+        "rate_limited": sum(1 for r in records if r["error"] == "429"),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(records) / elapsed, 2) if elapsed else None,
+        "latency_ms": summarize([r["latency_ms"] for r in ok]),
+        "ttft_ms": summarize([r["ttft_ms"] for r in ok if r["ttft_ms"] is not None]),
+        "stored_latency_ms": summarize(stored_latency),
+        "cache_hit_ratio": round(sum(1 for r in cached if r["cache"] == "hit") / len(cached), 3)
+        if cached else None,
+        "answer_length_ratio_median": round(median(ratios), 3) if ratios else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="回放历史提问")
+    parser.add_argument("--db", default="chat_history.db", help="SQLite数据库路径（只读打开）")
+    parser.add_argument("--target", default="http://127.0.0.1:8000")
+    parser.add_argument("--since", default="1970-01-01", help="起始时间（UTC，含），如 2025-08-01")
+    parser.add_argument("--until", default="9999-12-31", help="结束时间（UTC，不含）")
+    parser.add_argument("--sample", type=int, help="随机抽样条数")
+    parser.add_argument("--limit", type=int, help="按时间顺序最多回放条数")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放倍速，0表示不等待")
+    parser.add_argument("--max-gap", type=float, default=60.0, help="两次请求间最长等待（秒）")
+    parser.add_argument("--max-inflight", type=int, default=50, help="最大并发请求数")
+    parser.add_argument("--deep-thinking", choices=["off", "on", "auto"], default="auto",
+                        help="auto：历史回答带思考过程时开启深度思考")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--output", help="结果JSON路径")
+    args = parser.parse_args()
+
+    result = asyncio.run(replay(args))
+    output = args.output or os.path.join(
+        os.path.dirname(__file__), "results",
+        f"replay-{result['commit'] or 'nogit'}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(json.dumps(result["summary"], ensure_ascii=False, indent=2))
+    warn_rate_limited(result["summary"]["rate_limited"])
+    print(f"结果已写入 {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+# bench/run_bench.py
+"""
+端到端压测：以指定并发驱动 /chat、/history、/export，输出吞吐、TTFT分位数和服务RSS
+
+用法：
+    python -m bench.mock_ragflow --port 9380 &
+    RATE_LIMIT_ENABLED=0 RAGFLOW_BASE_URL=http://127.0.0.1:9380 RAGFLOW_CHAT_ID=mock RAGFLOW_API_KEY=mock \\
+        gunicorn -c backend/gunicorn_conf.py backend.main:app &
+    python -m bench.run_bench --target http://127.0.0.1:8000 --concurrency 20 --chat 200 \\
+        --server-pid $(pgrep -f "gunicorn.*backend.main" | head -1)
+
+压测从单个客户端发起，后端需关闭客户端限流（RATE_LIMIT_ENABLED=0），否则大部分 /chat 请求会被429拒绝；
+结果中 rate_limited 不为0时会打印提示。
+结果写入 JSON（默认 bench/results/<commit>-<时间>.json），可用于不同提交间对比。
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import subprocess
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import httpx
+
+DEFAULT_QUESTIONS = [
+    "BM1 Common Defect异常原因有哪些，如何改善？",
+    "涂布膜厚不均匀的常见原因？",
+    "曝光机照度异常如何排查？",
+    "Oven温度曲线漂移会导致哪些缺陷？",
+    "MURA缺陷的分类和判定标准是什么？",
+]
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """
+    最近秩法计算分位数
+    :param values: 样本
+    :param q: 0~100
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(q / 100.0 * len(ordered)) - 1))
+    return round(ordered[index], 2)
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": round(max(values), 2) if values else None,
+    }
+
+
+def process_tree_rss_kb(pid: int) -> Optional[int]:
+    """
+    读取 /proc 统计进程及其子进程（gunicorn worker）的RSS总和
+    :param pid: 服务主进程号
+    :return: KB，无法读取时为None
+    """
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    total = 0
+    for each in pids:
+        try:
+            with open(f"/proc/{each}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+                        break
+        except OSError:
+            if each == pid:
+                return None
+    return total
+
+
+class RssSampler:
+    """
+    后台周期采样服务RSS，记录起始、结束和峰值
+    """
+
+    def __init__(self, pid: Optional[int], interval: float = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self.samples: List[int] = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            value = process_tree_rss_kb(self.pid)
+            if value is not None:
+                self.samples.append(value)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.pid:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> Optional[Dict[str, int]]:
+        if not self._task:
+            return None
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        if not self.samples:
+            return None
+        return {"start_kb": self.samples[0], "end_kb": self.samples[-1], "peak_kb": max(self.samples)}
+
+
+async def chat_once(client: httpx.AsyncClient, question: str, deep_thinking: bool) -> Dict[str, object]:
+    """
+    发起一次 /chat 请求并解析SSE，记录首token时间、总耗时、回答长度和服务端metrics事件
+    """
+    start = time.perf_counter()
+    ttft = None
+    error = None
+    answer_chars = 0
+    metrics = None
+    cache = None
+    params = {"message": question, "deep_thinking": str(deep_thinking).lower()}
+    try:
+        async with client.stream("GET", "/chat", params=params) as response:
+            cache = response.headers.get("X-Cache")
+            if response.status_code >= 400:
+                # nginx 或后端在进入SSE前直接返回的错误
+                await response.aread()
+                error = str(response.status_code)
+            else:
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: "):
+                        continue
+                    data = line[6:]
+                    if data == "[DONE]":
+                        break
+                    event = json.loads(data)
+                    event_type = event.get("type")
+                    if ttft is None and event_type in ("thinking", "content"):
+                        ttft = (time.perf_counter() - start) * 1000.0
+                    if event_type == "content":
+                        answer_chars += len(event.get("content", ""))
+                    elif event_type == "metrics":
+                        metrics = event
+                    elif event_type == "error":
+                        # 限流和排队超时以200响应中的错误事件返回，用事件的 code 区分
+                        error = str(event["code"]) if event.get("code") in (429, 503) else event.get("message")
+    except (httpx.HTTPError, json.JSONDecodeError) as e:
+        error = type(e).__name__
+    return {
+        "latency_ms": (time.perf_counter() - start) * 1000.0,
+        "ttft_ms": ttft,
+        "error": error,
+        "answer_chars": answer_chars,
+        "cache": cache,
+        "metrics": metrics,
+    }
+
+
+async def get_once(client: httpx.AsyncClient, path: str) -> Dict[str, object]:
+    start = time.perf_counter()
+    error = None
+    try:
+        response = await client.get(path)
+        await response.aread()
+        if response.status_code >= 400:
+            error = str(response.status_code)
+    except httpx.HTTPError as e:
+        error = type(e).__name__
+    return {"latency_ms": (time.perf_counter() - start) * 1000.0, "ttft_ms": None, "error": error}
+
+
+async def run_scenario(name: str, make_request, total: int, concurrency: int) -> Dict[str, object]:
+    """
+    以固定并发执行total次请求
+    :param make_request: 接收序号、返回协程的函数
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    for index in range(total):
+        queue.put_nowait(index)
+    results: List[Dict[str, object]] = []
+
+    async def worker():
+        while True:
+            try:
+                index = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            results.append(await make_request(index))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [r["latency_ms"] for r in results]
+    ttfts = [r["ttft_ms"] for r in results if r["ttft_ms"] is not None]
+    errors = [r["error"] for r in results if r["error"]]
+    return {
+        "scenario": name,
+        "requests": total,
+        "concurrency": concurrency,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 2) if elapsed else None,
+        "latency_ms": summarize(latencies),
+        "ttft_ms": summarize(ttfts) if ttfts else None,
+        "errors": len(errors),
+        "rate_limited": errors.count("429"),
+        "error_samples": sorted(set(errors))[:5],
+    }
+
+
+def warn_rate_limited(count: int):
+    """
+    有请求被后端限流时提示：单客户端压测会被令牌桶和并发上限拦截，结果不代表服务能力
+    """
+    if count:
+        print(f"警告：有 {count} 个请求被后端限流（429），压测结果无效；"
+              f"启动后端时设置 RATE_LIMIT_ENABLED=0 后重新压测")
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main_async(args) -> Dict[str, object]:
+    questions = DEFAULT_QUESTIONS
+    if args.questions:
+        with open(args.questions, encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip()]
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    timeout = httpx.Timeout(args.timeout, connect=10.0)
+    sampler = RssSampler(args.server_pid)
+    sampler.start()
+    scenarios = []
+    async with httpx.AsyncClient(base_url=args.target, limits=limits, timeout=timeout) as client:
+        if args.chat:
+            scenarios.append(await run_scenario(
+                "chat",
+                lambda i: chat_once(client, questions[i % len(questions)], args.deep_thinking),
+                args.chat, args.concurrency))
+        if args.history:
+            scenarios.append(await run_scenario(
+                "history", lambda i: get_once(client, "/history"), args.history, args.concurrency))
+        if args.export:
+            scenarios.append(await run_scenario(
+                "export", lambda i: get_once(client, "/export"), args.export, args.concurrency))
+    rss = await sampler.stop()
+
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "target": args.target,
+        "deep_thinking": args.deep_thinking,
+        "scenarios": scenarios,
+        "server_rss": rss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAGFlow Chatbot 端到端压测")
+    parser.add_argument("--target", default="http://127.0.0.1:8000")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--chat", type=int, default=50, help="/chat 请求数")
+    parser.add_argument("--history", type=int, default=100, help="/history 请求数")
+    parser.add_argument("--export", type=int, default=10, help="/export 请求数")
+    parser.add_argument("--deep-thinking", action="store_true")
+    parser.add_argument("--questions", help="问题文件，每行一个")
+    parser.add_argument("--server-pid", type=int, help="服务主进程号，用于采样RSS")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--output", help="结果JSON路径")
+    args = parser.parse_args()
+
+    result = asyncio.run(main_async(args))
+    output = args.output or os.path.join(
+        os.path.dirname(__file__), "results",
+        f"{result['commit'] or 'nogit'}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    warn_rate_limited(sum(scenario["rate_limited"] for scenario in result["scenarios"]))
+    print(f"结果已写入 {output}")
+
+
+if __name__ == "__main__":
+    main()
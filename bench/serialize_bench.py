@@ -0,0 +1,187 @@
+# bench/serialize_bench.py
+"""
+序列化微基准：对比逐行 astimezone + isoformat + jsonable_encoder + json.dumps 的旧路径
+和 backend.serialization（固定偏移 + orjson）的新路径
+
+用法：
+    python -m bench.serialize_bench --messages 1000 --repeat 20
+
+每个场景编码 --messages 条合成消息（中文内容、思考内容和时间戳），输出每千条消息的：
+    encode_ms      最快一轮的编码耗时
+    peak_kib       编码过程中的内存分配峰值（tracemalloc）
+    blocks         编码结束时仍存活的分配块数（主要是输出对象）
+    output_kib     输出字节数
+结果写入 bench/results/serialize-<commit>-<时间>.json
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import time
+import tracemalloc
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from io import StringIO
+from typing import Callable, Dict, List
+
+from fastapi.encoders import jsonable_encoder
+
+from backend.serialization import SHANGHAI_OFFSET, dumps, orjson, shanghai_datetime, shanghai_text, sse_event
+from bench.run_bench import git_commit
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+Row = namedtuple("Row", ["role", "content", "thinking_content", "timestamp"])
+
+SAMPLE_TEXT = "BM1 缺陷的常见原因包括曝光能量不足、显影液浓度异常和基板清洗不彻底，建议依次检查。"
+
+
+def make_rows(count: int, seed: int = 1) -> List[Row]:
+    """
+    生成合成消息：用户/助手交替，助手消息带思考内容，时间为不带时区的UTC
+    """
+    rng = random.Random(seed)
+    start = datetime(2025, 8, 1, 8, 0, 0)
+    rows = []
+    for index in range(count):
+        assistant = index % 2 == 1
+        content = SAMPLE_TEXT * (rng.randint(2, 8) if assistant else 1)
+        thinking = SAMPLE_TEXT * rng.randint(1, 4) if assistant else None
+        moment = start + timedelta(seconds=index * 37, microseconds=rng.randint(0, 999999))
+        rows.append(Row("assistant" if assistant else "user", content, thinking, moment))
+    return rows
+
+
+def old_iso(moment: datetime) -> str:
+    return moment.replace(tzinfo=timezone.utc).astimezone(SHANGHAI_OFFSET).isoformat()
+
+
+def old_json_response(content) -> bytes:
+    # 接口返回字典时 FastAPI 先执行 jsonable_encoder，再由 Starlette JSONResponse 编码
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, allow_nan=False,
+                      indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def history_old(rows: List[Row]) -> bytes:
+    return old_json_response({"messages": [{
+        "role": row.role,
+        "content": row.content,
+        "thinking_content": row.thinking_content,
+        "timestamp": old_iso(row.timestamp),
+    } for row in rows], "session_id": "bench", "title": "bench"})
+
+
+def history_new(rows: List[Row]) -> bytes:
+    return dumps({"messages": [{
+        "role": role,
+        "content": content,
+        "thinking_content": thinking_content,
+        "timestamp": shanghai_datetime(timestamp),
+    } for role, content, thinking_content, timestamp in rows], "session_id": "bench", "title": "bench"})
+
+
+def sse_old(rows: List[Row]) -> bytes:
+    # 每条消息作为一个content帧，str 帧由 StreamingResponse 编码为UTF-8
+    return b"".join(f"data: {json.dumps({'type': 'content', 'content': row.content})}\n\n".encode("utf-8")
+                    for row in rows)
+
+
+def sse_new(rows: List[Row]) -> bytes:
+    return b"".join(sse_event({"type": "content", "content": row.content}) for row in rows)
+
+
+def export_old(rows: List[Row]) -> bytes:
+    output = StringIO()
+    writer = csv.writer(output)
+    for row in rows:
+        local_timestamp = row.timestamp.replace(tzinfo=timezone.utc).astimezone(SHANGHAI_OFFSET)
+        writer.writerow(["bench", "bench", row.role, row.content, row.thinking_content or "", local_timestamp])
+    return output.getvalue().encode("utf-8")
+
+
+def export_new(rows: List[Row]) -> bytes:
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerows(("bench", "bench", role, content, thinking_content or "", shanghai_text(timestamp))
+                     for role, content, thinking_content, timestamp in rows)
+    return output.getvalue().encode("utf-8")
+
+
+SCENARIOS: Dict[str, Dict[str, Callable[[List[Row]], bytes]]] = {
+    "history": {"old": history_old, "new": history_new},
+    "sse": {"old": sse_old, "new": sse_new},
+    "export": {"old": export_old, "new": export_new},
+}
+
+
+def same_output(old: bytes, new: bytes) -> bool:
+    """
+    新旧输出是否等价：SSE帧逐帧比较解析后的内容（旧路径转义了中文），其余按字节比较
+    """
+    if old.startswith(b"data: "):
+        frames = lambda data: [json.loads(frame[6:]) for frame in data.split(b"\n\n") if frame]
+        return frames(old) == frames(new)
+    return old == new
+
+
+def measure(func: Callable[[List[Row]], bytes], rows: List[Row], repeat: int) -> Dict[str, float]:
+    """
+    :return: 每千条消息的最快耗时、分配峰值、存活块数和输出大小
+    """
+    scale = 1000.0 / len(rows)
+    func(rows)
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(rows)
+        best = min(best, time.perf_counter() - started)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    output = func(rows)
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+    return {
+        "encode_ms": round(best * 1000.0 * scale, 3),
+        "peak_kib": round(peak / 1024.0 * scale, 1),
+        "blocks": round(blocks * scale),
+        "output_kib": round(len(output) / 1024.0 * scale, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="历史记录/SSE/导出序列化微基准")
+    parser.add_argument("--messages", type=int, default=1000, help="每轮编码的消息数")
+    parser.add_argument("--repeat", type=int, default=20, help="计时轮数，取最快一轮")
+    args = parser.parse_args()
+
+    rows = make_rows(args.messages)
+    for name, variants in SCENARIOS.items():
+        if not same_output(variants["old"](rows[:50]), variants["new"](rows[:50])):
+            raise SystemExit(f"{name}: 新旧路径输出不一致")
+
+    result = {
+        "commit": git_commit(),
+        "orjson": getattr(orjson, "__version__", None),
+        "messages": args.messages,
+        "scenarios": {name: {variant: measure(func, rows, args.repeat) for variant, func in variants.items()}
+                      for name, variants in SCENARIOS.items()},
+    }
+    for name, variants in result["scenarios"].items():
+        old, new = variants["old"], variants["new"]
+        speedup = old["encode_ms"] / new["encode_ms"] if new["encode_ms"] else float("inf")
+        print(f"{name:8s} 旧: {old['encode_ms']:8.3f} ms {old['peak_kib']:8.1f} KiB 峰值 | "
+              f"新: {new['encode_ms']:8.3f} ms {new['peak_kib']:8.1f} KiB 峰值 | {speedup:.1f}x（每千条消息）")
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"serialize-{result['commit']}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -58,6 +58,7 @@ const ChatApp = (function() {
     
     adjustTextareaHeight();
     loadHistory();
+    loadSuggestions();
     setupEventListeners();
     
     // 等待highlight.js加载完成后初始化
@@ -130,13 +131,38 @@ const ChatApp = (function() {
     elements.chatInput.value = '';
     adjustTextareaHeight();
     currentSessionId = null;
+    loadSuggestions();
   }
   
-  // 插入建议
+  // 加载推荐问题（热门问题，已预计算回答的点击后立即返回）；失败时保留页面中的默认问题
+  async function loadSuggestions() {
+    try {
+      const response = await fetch('/suggestions');
+      if (!response.ok) return;
+      const data = await response.json();
+      const container = elements.chatBody.querySelector('.welcome-message .suggestions');
+      if (!container || !data.suggestions || data.suggestions.length === 0) return;
+      
+      container.innerHTML = '';
+      data.suggestions.forEach(item => {
+        const suggestion = document.createElement('div');
+        suggestion.className = item.cached ? 'suggestion cached' : 'suggestion';
+        suggestion.dataset.suggestion = item.question;
+        suggestion.textContent = item.question;
+        if (item.cached) suggestion.title = '已准备好回答';
+        container.appendChild(suggestion);
+      });
+    } catch (error) {
+      console.error('加载推荐问题失败:', error);
+    }
+  }
+  
+  // 点击建议直接发送
   function insertSuggestion(element) {
+    if (elements.sendBtn.disabled) return;
     elements.chatInput.value = element.dataset.suggestion || element.textContent;
-    elements.chatInput.focus();
     adjustTextareaHeight();
+    sendMessage();
   }
   
   // 发送消息
@@ -210,9 +236,23 @@ const ChatApp = (function() {
             currentSessionId = data.session_id || null;
           }
           else if (data.type === 'error') {
-            appendErrorMessage(data.message || '发生未知错误');
+            // 限流（429）和排队超时（503）也以错误事件返回，不自动重试，避免继续消耗限流配额
+            const hint = data.retry_after ? `（约 ${data.retry_after} 秒后可重试）` : '';
+            appendErrorMessage((data.message || '发生未知错误') + hint);
             eventSource.close();
           }
+          else if (data.type === 'reconnect') {
+            // 服务正在重启：尚未输出内容时稍后重新连接（由nginx分配到其他实例），已输出部分回答时提示用户
+            eventSource.close();
+            if (!data.partial && retryCount < maxRetries) {
+              retryCount++;
+              setTimeout(connectEventSource, (data.retry_after || 1) * 1000);
+            } else {
+              appendErrorMessage(data.message || '服务正在重启，请稍后重试');
+              finalizeResponse(thinkingCard, answerPanel);
+              loadHistory();
+            }
+          }
         } catch (error) {
           console.error('Error parsing message:', error);
         }
@@ -578,47 +618,29 @@ function updateThinkingContent(thinkingCard, content) {
     }
   }
   
-  // 查看聊天历史
+  // 查看聊天历史（分页加载，思考内容在展开时再获取）
   async function viewChatHistory(sessionUuid) {
     try {
-      const response = await fetch(`/history/${sessionUuid}`);
-      if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
-      const chat = await response.json();
-      
-      if (!chat || !Array.isArray(chat.messages)) {
-        throw new Error('Invalid chat data structure');
-      }
-      
-      startNewChat();
-      currentSessionId = sessionUuid;
-      
-      chat.messages.forEach(msg => {
-        if (!msg || !msg.role || !msg.content) {
-          console.warn('Invalid message:', msg);
-          return;
+      let cursor = 0;
+      let firstPage = true;
+      do {
+        const response = await fetch(`/history/${sessionUuid}/transcript?cursor=${cursor}&limit=50`);
+        if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+        const chat = await response.json();
+        
+        if (!chat || !Array.isArray(chat.messages)) {
+          throw new Error('Invalid chat data structure');
         }
         
-        if (msg.role === 'user') {
-          appendUserMessage(msg.content);
-        } else {
-          // 修复思考卡片初始化
-          if (msg.thinking_content) {
-            const thinkingCard = createThinkingCard();
-            if (thinkingCard) { // 确保卡片创建成功
-              updateThinkingContent(thinkingCard, msg.thinking_content);
-              thinkingCard.classList.remove('collapsed');
-              // 标记为已完成状态
-              const progressStages = thinkingCard.querySelectorAll('.progress-stage');
-              progressStages.forEach(stage => stage.classList.add('completed'));
-            }
-          }
-          
-          const assistantDiv = createAssistantMessage();
-          assistantDiv.classList.add('no-cursor'); // 添加no-cursor类
-          updateAssistantMessage(assistantDiv, msg.content);
-          addResponseEndMarker(assistantDiv);
+        if (firstPage) {
+          startNewChat();
+          currentSessionId = sessionUuid;
+          firstPage = false;
         }
-      });
+        
+        chat.messages.forEach(msg => renderHistoryMessage(sessionUuid, msg));
+        cursor = chat.next_cursor;
+      } while (cursor);
       
       toggleSidebar();
       scrollToBottom();
@@ -628,6 +650,50 @@ function updateThinkingContent(thinkingCard, content) {
     }
   }
   
+  // 渲染一条历史消息
+  function renderHistoryMessage(sessionUuid, msg) {
+    if (!msg || !msg.role || !msg.content) {
+      console.warn('Invalid message:', msg);
+      return;
+    }
+    
+    if (msg.role === 'user') {
+      appendUserMessage(msg.content);
+      return;
+    }
+    
+    if (msg.has_thinking) {
+      const thinkingCard = createThinkingCard();
+      if (thinkingCard) { // 确保卡片创建成功
+        // 默认折叠，第一次展开时再加载思考内容
+        thinkingCard.classList.add('collapsed', 'completed');
+        thinkingCard.querySelectorAll('.progress-stage').forEach(stage => stage.classList.add('completed'));
+        const toggleBtn = thinkingCard.querySelector('.thinking-toggle-btn');
+        if (toggleBtn) {
+          toggleBtn.addEventListener('click', () => loadThinkingContent(thinkingCard, sessionUuid, msg.id), { once: true });
+        }
+      }
+    }
+    
+    const assistantDiv = createAssistantMessage();
+    assistantDiv.classList.add('no-cursor'); // 添加no-cursor类
+    updateAssistantMessage(assistantDiv, msg.content);
+    addResponseEndMarker(assistantDiv);
+  }
+  
+  // 加载单条消息的思考内容
+  async function loadThinkingContent(thinkingCard, sessionUuid, messageId) {
+    try {
+      const response = await fetch(`/history/${sessionUuid}/messages/${messageId}/thinking`);
+      if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+      const data = await response.json();
+      updateThinkingContent(thinkingCard, data.thinking_content || '');
+    } catch (error) {
+      console.error('Error loading thinking content:', error);
+      updateThinkingContent(thinkingCard, '思考内容加载失败');
+    }
+  }
+  
   // 删除历史记录
   async function deleteChatHistory(event, chatId) {
     event.stopPropagation();